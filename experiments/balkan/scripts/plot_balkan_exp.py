@@ -1,63 +1,34 @@
 """ Testing class Plot (plot.py) on balkan results """
 
 import warnings
-from sbayes.plot import Plot
+from sbayes.tools.plot_batch import plot_batch
 
 warnings.simplefilter(action='ignore', category=UserWarning)
 warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=RuntimeWarning)
 
 if __name__ == '__main__':
-    results_per_model = {}
-    plot = Plot(simulated_data=False)
-    plot.load_config(config_file='../results/scaled_prior/config_plot.json')
-    plot.read_data()
+    plots = []
 
-    # Get model names
-    names = plot.get_model_names()
+    # Plot maps for different minimum posterior frequencies
+    min_posterior_frequency = [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3]
+    for mpf in min_posterior_frequency:
+        plots.append({'type': 'posterior_map',
+                      'file_name': 'posterior_map_{model}_' + str(mpf),
+                      'config': {'map': {'content': {'min_posterior_frequency': mpf}}}})
 
-    for m in names:
+    # Plot weights
+    plots.append({'type': 'plot_weights_grid', 'file_name': 'weights_grid_{model}'})
 
-        # Read results for each model
-        plot.read_results(model=m)
-
-        print('Plotting for the model', m)
-
-        # Config has a value 0.5 (just to avoid errors)
-        min_posterior_frequency = [0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3]
-
-        mpf_counter = 1
-        print('Plotting results for ' + str(len(min_posterior_frequency)) + ' different mpf values')
-
-        for mpf in min_posterior_frequency:
-
-            print('Current mpf: ' + str(mpf) + ' (' + str(mpf_counter) + ' out of ' +
-                  str(len(min_posterior_frequency)) + ')')
-
-            # Assign new mpf values
-            plot.config['map']['content']['min_posterior_frequency'] = mpf
-
-            # Plot maps
-            try:
-                plot.posterior_map(file_name='posterior_map_' + m + '_' + str(mpf), return_correspondence=True)
-            except ValueError:
-                pass
-
-            mpf_counter += 1
-
-        results_per_model[m] = plot.results
-
-        # Plot weights
-        plot.plot_weights_grid(file_name='weights_grid_' + m)
-
-        # Plot probability grids
-        parameter = ["gamma_a1", "gamma_a2", "gamma_a3", "gamma_a4", "gamma_a5"]
-        for p in parameter:
-            try:
-                plot.config['probabilities_plot']['parameter'] = p
-                plot.plot_probability_grid(file_name='prob_grid_' + m + '_' + p)
-            except ValueError:
-                pass
+    # Plot probability grids
+    parameter = ["gamma_a1", "gamma_a2", "gamma_a3", "gamma_a4", "gamma_a5"]
+    for p in parameter:
+        plots.append({'type': 'plot_probability_grid',
+                      'file_name': 'prob_grid_{model}_' + p,
+                      'config': {'probabilities_plot': {'parameter': p}}})
 
     # Plot DIC over all models
-    plot.plot_dic(results_per_model, file_name='dic')
+    plots.append({'type': 'plot_dic', 'file_name': 'dic'})
+
+    # Read the results of each model once and render all plots in parallel
+    plot_batch(config_file='../results/scaled_prior/config_plot.json', plots=plots, n_jobs=8)
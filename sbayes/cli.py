@@ -1,7 +1,5 @@
 import argparse
 from pathlib import Path
-import tkinter as tk
-from tkinter import filedialog
 
 from sbayes.experiment_setup import Experiment
 from sbayes.load_data import Data
@@ -38,6 +36,9 @@ def main(config=None, experiment_name=None):
 
     # 0. Ask for config file via files-dialog, if not provided as argument.
     if config is None:
+        import tkinter as tk
+        from tkinter import filedialog
+
         tk.Tk().withdraw()
         config = filedialog.askopenfilename(
             title='Select a config file in JSON format.',
@@ -49,6 +50,15 @@ def main(config=None, experiment_name=None):
     experiment = Experiment(experiment_name=experiment_name,
                             config_file=config, log=True)
 
+    data = init_data(experiment)
+
+    # Rerun experiment to check for consistency
+    for run in range(experiment.config['mcmc']['N_RUNS']):
+        run_experiments(experiment, data, run)
+
+
+def init_data(experiment):
+    """Simulate or load the data of an experiment, as specified in its config."""
     if experiment.is_simulation():
         # The data is defined by a ´Simulation´ object
         data = Simulation(experiment=experiment)
@@ -63,26 +73,33 @@ def main(config=None, experiment_name=None):
         # Counts for priors
         data.load_universal_counts()
         data.load_inheritance_counts()
+        data.load_geo_cost_matrix()
 
         # Log
         data.log_loading()
 
-    # Rerun experiment to check for consistency
-    for run in range(experiment.config['mcmc']['N_RUNS']):
-        n_areas = experiment.config['model']['N_AREAS']
-        if isinstance(n_areas, list):
-            # Run the experiment multiple times to determine the number of areas.
-            for N in n_areas:
-                # Update config information according to the current setup
-                experiment.config['model']['N_AREAS'] = N
-
-                # Run the experiment with the specified number of areas
-                run_experiment(experiment, data, run)
-        else:
-            # Run the experiment once, with the specified settings
-            assert isinstance(n_areas, int)
+    return data
+
+
+def run_experiments(experiment, data, run):
+    """Run the experiment once, or once for each number of areas if N_AREAS is a list."""
+    n_areas = experiment.config['model']['N_AREAS']
+    if isinstance(n_areas, list):
+        # Run the experiment multiple times to determine the number of areas.
+        for N in n_areas:
+            # Update config information according to the current setup
+            experiment.config['model']['N_AREAS'] = N
+
+            # Run the experiment with the specified number of areas
             run_experiment(experiment, data, run)
 
+        # Restore the list for the next run
+        experiment.config['model']['N_AREAS'] = n_areas
+    else:
+        # Run the experiment once, with the specified settings
+        assert isinstance(n_areas, int)
+        run_experiment(experiment, data, run)
+
 
 if __name__ == '__main__':
     main()
@@ -17,8 +17,6 @@ except ImportError:
 import typing
 from pathlib import Path
 
-import pycldf
-
 from sbayes.util import set_experiment_name
 from sbayes import config
 
@@ -151,6 +149,8 @@ class Experiment:
                     raise NameError(f"scale for geo prior is not defined in {self.config_file}.")
                 if 'file' in prior:
                     prior['file'] = self.fix_relative_path(prior['file'])
+                if prior.get('sparse', False) not in [False, 'delaunay', 'knn']:
+                    raise NameError(f"sparse for geo prior must be \"delaunay\" or \"knn\" in {self.config_file}.")
             if prior['type'] == 'counts':
                 if 'file_type' not in prior:
                     raise NameError(f"counts file for prior \'{key}\' is not defined in {self.config_file}.")
@@ -251,6 +251,8 @@ class Experiment:
         if 'data' not in self.config:
             raise NameError("Provide file paths to data.")
         elif type(self.config['data']) == str:
+            import pycldf
+
             # TODO: type comparison is considered bad form in Python. What to
             # use instead?
             self.config['data'] = {
@@ -265,6 +267,7 @@ class Experiment:
 
             if not self.config['data']['simulated']:
                 if 'cldf_dataset' in self.config['data']:
+                    import pycldf
                     self.config['data']['cldf_dataset'] = pycldf.StructureDataset.from_metadata(
                         self.base_directory / self.config['data']
                     )
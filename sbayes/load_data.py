@@ -3,7 +3,13 @@
 
 """ Imports the real world data """
 
-import pyproj
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
 from dataclasses import dataclass
 import typing as t
 try:
@@ -14,13 +20,18 @@ except ImportError:
 import logging
 
 import numpy
+from scipy.sparse import csr_matrix
 
-from sbayes.util import read_features_from_csv
+from sbayes.util import read_features_from_csv, hash_inputs, memmap_features, set_default_permissions
 from sbayes.preprocessing import (compute_network,
                                   read_inheritance_counts,
                                   read_universal_counts,
                                   read_geo_cost_matrix)
 
+CACHE_VERSION = 1
+'''int: Version of the format of the cached preprocessing results. Increase it whenever the
+cached arrays or the preprocessing change, so that existing caches are not used anymore.'''
+
 
 class Data:
     def __init__(self, experiment):
@@ -35,12 +46,14 @@ class Data:
         if proj4_string is None:
             self.crs = None
         else:
+            import pyproj
             self.crs = pyproj.CRS(proj4_string)
 
         # Features to be imported
         self.sites = None
         self.site_names = None
         self.features = None
+        self.na_features = None
         self.feature_names = None
         self.states = None
         self.state_names = None
@@ -48,6 +61,9 @@ class Data:
         self.family_names = None
         self.network = None
 
+        # Time (in seconds) spent building the network, or restoring it from the cache
+        self.time_network = 0.
+
         # Logs
         self.log_load_features = None
         self.log_load_universal_counts = None
@@ -62,12 +78,176 @@ class Data:
         # Not a simulation
         self.is_simulated = False
 
+    def get_cache_dir(self, name, files, config=None):
+        """Get the directory for caching preprocessed data, identified by the content of the
+        input files and the relevant config values. Caching is activated by data.CACHE in the config.
+
+        Args:
+            name (str): the name of the cached data (e.g. 'features').
+            files (list): paths to the input files.
+            config (dict): config values which influence the preprocessing.
+        Returns:
+            Path: the cache directory (None if caching is deactivated).
+        """
+        if not self.config['data'].get('CACHE', False):
+            return None
+
+        return self.get_cache_root() / f'{name}_{hash_inputs(files, {"config": config, "version": CACHE_VERSION})}'
+
+    def get_cache_root(self):
+        """The directory containing all cached data (next to the features file)."""
+        return Path(self.config['data']['FEATURES']).parent / '.sbayes_cache'
+
+    @staticmethod
+    def write_cache(cache_dir, arrays, meta):
+        """Write arrays (as .npy files) and meta information (as JSON) to the cache directory.
+        The files are written to a temporary directory first, so that parallel runs never read
+        an incomplete cache.
+
+        Args:
+            cache_dir (Path): the cache directory.
+            arrays (dict): the arrays to cache (name -> np.array).
+            meta (dict): JSON serializable meta information.
+        """
+        cache_dir.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir.parent))
+        for name, array in arrays.items():
+            numpy.save(tmp_dir / f'{name}.npy', array)
+        with open(tmp_dir / 'meta.json', 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        # mkdtemp makes the directory private, but the cache is shared with other users
+        set_default_permissions(tmp_dir)
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            # Another run wrote the same cache in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def read_cache(cache_dir, mmap_arrays=()):
+        """Read the arrays and meta information from the cache directory.
+
+        Args:
+            cache_dir (Path): the cache directory.
+            mmap_arrays (iterable): names of arrays which are memory-mapped instead of loaded to RAM.
+        Returns:
+            (dict, dict): the cached arrays and the meta information.
+        """
+        arrays = {}
+        for path in cache_dir.glob('*.npy'):
+            mmap_mode = 'r' if path.stem in mmap_arrays else None
+            arrays[path.stem] = numpy.load(path, mmap_mode=mmap_mode)
+        with open(cache_dir / 'meta.json') as meta_file:
+            meta = json.load(meta_file)
+        return arrays, meta
+
     def load_features(self):
+        dist_options = self.get_distance_matrix_options()
+        cache_dir = self.get_cache_dir(
+            name='features',
+            files=[self.config['data']['FEATURES'], self.config['data']['FEATURE_STATES']],
+            config={'CRS': self.config['data'].get('CRS'),
+                    'DIST_MAT_DTYPE': str(dist_options['dist_dtype'])}
+        )
+
+        mmap_features = self.config['data'].get('FEATURES_MEMMAP', False)
+
+        if cache_dir is not None and cache_dir.exists():
+            self.load_features_from_cache(cache_dir, mmap_dist_mat=dist_options['dist_file'] is not None,
+                                          mmap_features=mmap_features)
+            return
+
         (self.sites, self.site_names, self.features, self.feature_names,
          self.state_names, self.states, self.families, self.family_names,
          self.log_load_features) = read_features_from_csv(file=self.config['data']['FEATURES'],
                                                           feature_states_file=self.config['data']['FEATURE_STATES'])
-        self.network = compute_network(self.sites, crs=self.crs)
+        self.na_features = (numpy.sum(self.features, axis=-1) == 0)
+        t_start = time.perf_counter()
+        self.network = compute_network(self.sites, crs=self.crs, **dist_options)
+        self.time_network += time.perf_counter() - t_start
+
+        # Store the features (and NA mask) in memory-mapped files, shared by all processes on the node
+        if mmap_features:
+            self.features, self.na_features = memmap_features(self.features, self.na_features,
+                                                              self.get_cache_root())
+
+        if cache_dir is not None:
+            self.save_features_to_cache(cache_dir)
+
+    def save_features_to_cache(self, cache_dir):
+        """Store the encoded features, names and the network in the cache."""
+        adj_mat = self.network['adj_mat'].tocsr()
+        arrays = {'features': self.features,
+                  'na_features': self.na_features,
+                  'states': self.states,
+                  'families': self.families,
+                  'locations': self.sites['locations'],
+                  'edges': self.network['edges'],
+                  'adj_data': adj_mat.data,
+                  'adj_indices': adj_mat.indices,
+                  'adj_indptr': adj_mat.indptr,
+                  'dist_mat': self.network['dist_mat']}
+        meta = {'site_names': list(self.site_names['external']),
+                'names': list(self.sites['names']),
+                'feature_names': list(self.feature_names['external']),
+                'state_names': self.state_names['external'],
+                'family_names': list(self.family_names['external']),
+                'log': self.log_load_features}
+        self.write_cache(cache_dir, arrays, meta)
+
+    def load_features_from_cache(self, cache_dir, mmap_dist_mat=False, mmap_features=False):
+        """Restore the encoded features, names and the network from the cache."""
+        mmap_arrays = []
+        if mmap_dist_mat:
+            mmap_arrays.append('dist_mat')
+        if mmap_features:
+            mmap_arrays += ['features', 'na_features']
+        arrays, meta = self.read_cache(cache_dir, mmap_arrays=mmap_arrays)
+
+        n_sites, n_features, _ = arrays['features'].shape
+        n_families = len(meta['family_names'])
+        names = numpy.array(meta['names'], dtype=object)
+
+        self.features = arrays['features']
+        if 'na_features' in arrays:
+            self.na_features = arrays['na_features']
+        else:
+            self.na_features = (numpy.sum(self.features, axis=-1) == 0)
+        self.states = arrays['states']
+        self.families = arrays['families']
+        self.sites = {'locations': arrays['locations'],
+                      'id': list(range(n_sites)),
+                      'cz': None,
+                      'names': names}
+        self.site_names = {'external': numpy.array(meta['site_names'], dtype=object),
+                           'internal': list(range(n_sites))}
+        self.feature_names = {'external': numpy.array(meta['feature_names'], dtype=object),
+                              'internal': list(range(n_features))}
+        self.state_names = {'external': meta['state_names'],
+                            'internal': [list(range(len(s))) for s in meta['state_names']]}
+        self.family_names = {'external': meta['family_names'],
+                             'internal': list(range(n_families))}
+        self.log_load_features = meta['log'] + f' (loaded from cache {cache_dir})'
+
+        t_start = time.perf_counter()
+        adj_mat = csr_matrix((arrays['adj_data'], arrays['adj_indices'], arrays['adj_indptr']),
+                             shape=(n_sites, n_sites))
+        self.network = compute_network.from_arrays(vertices=self.sites['id'], edges=arrays['edges'],
+                                                   locations=arrays['locations'], names=names,
+                                                   adj_mat=adj_mat, dist_mat=arrays['dist_mat'])
+        self.time_network += time.perf_counter() - t_start
+
+    def get_distance_matrix_options(self):
+        """Read the (optional) data type, memory-mapping and number of processes for computing
+        the distance matrix from the config."""
+        dist_dtype = numpy.dtype(self.config['data'].get('DIST_MAT_DTYPE', 'float64'))
+        if self.config['data'].get('DIST_MAT_MEMMAP', False):
+            dist_file = self.path_results / 'dist_mat.npy'
+        else:
+            dist_file = None
+        n_jobs = self.config['data'].get('DIST_MAT_N_JOBS', 1)
+        return {'dist_dtype': dist_dtype, 'dist_file': dist_file, 'n_jobs': n_jobs}
 
     def load_universal_counts(self):
         config_universal = self.config['model']['PRIOR']['universal']
@@ -76,12 +256,24 @@ class Data:
             # universal prior does not use counts -> nothing to do
             return
 
-        counts, self.log_load_universal_counts = \
-            read_universal_counts(feature_names=self.feature_names,
-                                  state_names=self.state_names,
-                                  file=config_universal['file'],
-                                  file_type=config_universal['file_type'],
-                                  feature_states_file=self.config['data']['FEATURE_STATES'])
+        cache_dir = self.get_cache_dir(
+            name='universal_counts',
+            files=[config_universal['file'], self.config['data']['FEATURES'], self.config['data']['FEATURE_STATES']],
+            config={'file_type': config_universal['file_type']}
+        )
+
+        if cache_dir is not None and cache_dir.exists():
+            arrays, meta = self.read_cache(cache_dir)
+            counts, self.log_load_universal_counts = arrays['counts'], meta['log']
+        else:
+            counts, self.log_load_universal_counts = \
+                read_universal_counts(feature_names=self.feature_names,
+                                      state_names=self.state_names,
+                                      file=config_universal['file'],
+                                      file_type=config_universal['file_type'],
+                                      feature_states_file=self.config['data']['FEATURE_STATES'])
+            if cache_dir is not None:
+                self.write_cache(cache_dir, {'counts': counts}, {'log': self.log_load_universal_counts})
 
         self.prior_universal = {'counts': counts,
                                 'states': self.states}
@@ -102,13 +294,27 @@ class Data:
             # Inheritance prior does not use counts -> nothing to do
             return
 
-        counts, self.log_load_inheritance_counts = \
-            read_inheritance_counts(family_names=self.family_names,
-                                    feature_names=self.feature_names,
-                                    state_names=self.state_names,
-                                    files=config_inheritance['files'],
-                                    file_type=config_inheritance['file_type'],
-                                    feature_states_file=self.config['data']['FEATURE_STATES'])
+        families_with_files = sorted(config_inheritance['files'])
+        cache_dir = self.get_cache_dir(
+            name='inheritance_counts',
+            files=([config_inheritance['files'][fam] for fam in families_with_files]
+                   + [self.config['data']['FEATURES'], self.config['data']['FEATURE_STATES']]),
+            config={'file_type': config_inheritance['file_type'], 'families': families_with_files}
+        )
+
+        if cache_dir is not None and cache_dir.exists():
+            arrays, meta = self.read_cache(cache_dir)
+            counts, self.log_load_inheritance_counts = arrays['counts'], meta['log']
+        else:
+            counts, self.log_load_inheritance_counts = \
+                read_inheritance_counts(family_names=self.family_names,
+                                        feature_names=self.feature_names,
+                                        state_names=self.state_names,
+                                        files=config_inheritance['files'],
+                                        file_type=config_inheritance['file_type'],
+                                        feature_states_file=self.config['data']['FEATURE_STATES'])
+            if cache_dir is not None:
+                self.write_cache(cache_dir, {'counts': counts}, {'log': self.log_load_inheritance_counts})
 
         self.prior_inheritance = {'counts': counts,
                                   'states': self.state_names['internal']}
@@ -124,10 +330,24 @@ class Data:
             geo_cost_matrix = self.network['dist_mat']
 
         else:
-            # Read cost matrix from data
-            geo_cost_matrix, self.log_load_geo_cost_matrix =\
-                read_geo_cost_matrix(site_names=self.site_names,
-                                     file=self.config['model']['PRIOR']['geo']['file'])
+            # Read cost matrix from data (or from the cache)
+            cost_file = self.config['model']['PRIOR']['geo']['file']
+            if str(cost_file).endswith('.csv'):
+                cache_dir = self.get_cache_dir(name='geo_cost_matrix',
+                                               files=[cost_file, self.config['data']['FEATURES']])
+            else:
+                # Binary files are read directly
+                cache_dir = None
+
+            if cache_dir is not None and cache_dir.exists():
+                arrays, meta = self.read_cache(cache_dir)
+                geo_cost_matrix, self.log_load_geo_cost_matrix = arrays['cost_matrix'], meta['log']
+            else:
+                geo_cost_matrix, self.log_load_geo_cost_matrix =\
+                    read_geo_cost_matrix(site_names=self.site_names, file=cost_file)
+                if cache_dir is not None:
+                    self.write_cache(cache_dir, {'cost_matrix': geo_cost_matrix},
+                                     {'log': self.log_load_geo_cost_matrix})
 
         self.geo_prior = {'cost_matrix': geo_cost_matrix}
 
@@ -218,7 +438,9 @@ class CLDFData(Data):
         self.sites = Sites(*zip(*
             [(site[c_id], (site[c_lon], site[c_lat]), site[c_name])
              for site in self.ds["LanguageTable"]]))
-        self.network = compute_network(self.sites)
+        t_start = time.perf_counter()
+        self.network = compute_network(self.sites, **self.get_distance_matrix_options())
+        self.time_network += time.perf_counter() - t_start
 
     def load_universal_counts(self):
         config_universal = self.config['model']['PRIOR']['universal']
@@ -35,6 +35,9 @@ class MCMC:
         self.ops = {}
         self.steps_per_operator()
 
+        # Precision of the proposal distributions (can be tuned in the warm-up)
+        self.proposal_precision = self.config['mcmc']['PROPOSAL_PRECISION']
+
         # Samples
         self.sampler = None
         self.samples = None
@@ -56,6 +59,9 @@ MCMC SETUP
 ##########################################
 MCMC with {mcmc_config['N_STEPS']} steps and {mcmc_config['N_SAMPLES']} samples
 Warm-up: {mcmc_config['WARM_UP']['N_WARM_UP_CHAINS']} chains exploring the parameter space in {mcmc_config['WARM_UP']['N_WARM_UP_STEPS']} steps
+Adapt operator weights in the warm-up: {mcmc_config['WARM_UP']['ADAPT_OPERATORS']}
+Tune the precision of the proposal distributions in the warm-up: {mcmc_config['WARM_UP']['TUNE_PROPOSAL_PRECISION']}
+Batch the steps of all chains in the warm-up: {mcmc_config['WARM_UP']['BATCH_CHAINS']}
 Pseudocounts for tuning the width of the proposal distribution for weights: {mcmc_config['PROPOSAL_PRECISION']['weights']}
 Pseudocounts for tuning the width of the proposal distribution for universal pressure (alpha): {mcmc_config['PROPOSAL_PRECISION']['universal']}
 {msg_inherit_precision}\
@@ -105,7 +111,7 @@ Ratio of contact steps (changing gamma): {mcmc_config['STEPS']['contact']}
                                 n_chains=mcmc_config['N_CHAINS'],
                                 initial_sample=initial_sample,
                                 operators=self.ops,
-                                var_proposal=mcmc_config['PROPOSAL_PRECISION'],
+                                var_proposal=self.proposal_precision,
                                 p_grow_connected=mcmc_config['P_GROW_CONNECTED'],
                                 initial_size=mcmc_config['M_INITIAL'],
                                 logger=self.logger)
@@ -180,6 +186,8 @@ Ratio of contact steps (changing gamma): {mcmc_config['STEPS']['contact']}
                                 var_proposal=mcmc_config['PROPOSAL_PRECISION'],
                                 p_grow_connected=mcmc_config['P_GROW_CONNECTED'],
                                 initial_size=mcmc_config['M_INITIAL'],
+                                tune_proposal_precision=mcmc_config['WARM_UP']['TUNE_PROPOSAL_PRECISION'],
+                                batch_chains=mcmc_config['WARM_UP']['BATCH_CHAINS'],
                                 logger=self.logger)
 
         self.sample_from_warm_up = warmup.generate_samples(n_steps=0,
@@ -187,11 +195,31 @@ Ratio of contact steps (changing gamma): {mcmc_config['STEPS']['contact']}
                                                            warm_up=True,
                                                            warm_up_steps=mcmc_config['WARM_UP']['N_WARM_UP_STEPS'])
 
+        # Tune the operator weights in the warm-up and keep them fixed in the main run
+        if mcmc_config['WARM_UP']['ADAPT_OPERATORS']:
+            self.ops = warmup.tune_operator_weights()
+
+            msg_ops = '\n'.join(f'\t{name}: {w:.3f}' for name, w in self.ops.items())
+            self.logger.info(f'Operator weights tuned in the warm-up:\n{msg_ops}')
+
+        # Use the tuned precision of the proposal distributions in the main run
+        if mcmc_config['WARM_UP']['TUNE_PROPOSAL_PRECISION']:
+            self.proposal_precision = warmup.get_proposal_precision()
+
+            msg_precision = '\n'.join(f'\t{block}: median {np.median(p):.1f} (range {np.min(p):.1f} - {np.max(p):.1f})'
+                                      for block, p in self.proposal_precision.items() if p is not None)
+            self.logger.info(f'Proposal precision tuned in the warm-up:\n{msg_precision}')
+
     def save_samples(self, run=1):
+        self.postprocess_samples()
+        self.write_samples(run=run)
 
+    def postprocess_samples(self):
+        """Match the areas across samples and rank them by their posterior."""
         self.samples = match_areas(self.samples)
         self.samples = rank_areas(self.samples)
 
+    def write_samples(self, run=1):
         file_info = self.config['results']['FILE_INFO']
 
         if file_info == "n":
@@ -220,7 +248,8 @@ Ratio of contact steps (changing gamma): {mcmc_config['STEPS']['contact']}
         paths = {'parameters': pth / ('stats_' + fi + run + ext),
                  'areas': pth / ('areas_' + fi + run + ext),
                  'gt': gt_pth / ('stats' + ext),
-                 'gt_areas': gt_pth / ('areas' + ext)}
+                 'gt_areas': gt_pth / ('areas' + ext),
+                 'operators': pth / ('operators_' + fi + run + '.json')}
 
         pth.mkdir(exist_ok=True)
 
@@ -229,6 +258,7 @@ Ratio of contact steps (changing gamma): {mcmc_config['STEPS']['contact']}
             gt_pth.mkdir(exist_ok=True)
 
         samples2file(self.samples, self.data, self.config, paths)
+        self.sampler.write_statistics(self.samples, paths['operators'])
 
     def log_statistics(self):
         self.sampler.print_statistics(self.samples)
@@ -1,16 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import itertools
+from collections import defaultdict
+from copy import copy
 from enum import Enum
 
 import numpy as np
 
 import scipy.stats as stats
-from scipy.sparse.csgraph import minimum_spanning_tree, csgraph_from_dense
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.csgraph import minimum_spanning_tree, csgraph_from_dense, connected_components, dijkstra
 
 from sbayes.util import (compute_delaunay, n_smallest_distances, log_binom,
                          counts_to_dirichlet, inheritance_counts_to_dirichlet,
-                         dirichlet_logpdf, scale_counts)
+                         dirichlet_logpdf, scale_counts, sparse_cost_matrix)
 EPS = np.finfo(float).eps
 
 
@@ -52,7 +55,12 @@ class Model(object):
         return log_likelihood + log_prior
 
     def __copy__(self):
-        return Model(self.data, self.config)
+        """Copy the model for a new chain. The copy shares all constant attributes (data, prior
+        counts, dirichlet distributions, cost matrix) with the original, but has its own caches."""
+        model_copy = copy_without_cache(self)
+        model_copy.likelihood = copy(self.likelihood)
+        model_copy.prior = copy(self.prior)
+        return model_copy
 
     def get_setup_message(self):
         """Compile a set-up message for logging."""
@@ -109,7 +117,11 @@ class Likelihood(object):
 
         # Store relevant dimensions for convenience
         self.n_sites, self.n_features, self.n_categories = data.features.shape
-        self.na_features = (np.sum(self.features, axis=-1) == 0)
+
+        # Use the NA mask of the data loader (possibly memory-mapped), if available
+        self.na_features = getattr(data, 'na_features', None)
+        if self.na_features is None:
+            self.na_features = (np.sum(self.features, axis=-1) == 0)
 
         # Initialize attributes for caching
 
@@ -130,6 +142,33 @@ class Likelihood(object):
         # Weights
         self.weights = None
 
+        # Statistics on how often the cached values could be reused
+        self.cache_calls = defaultdict(int)
+        self.cache_hits = defaultdict(int)
+
+    def __copy__(self):
+        """Copy the likelihood, sharing the data (features, families, ...) but not the caches."""
+        likelihood_copy = copy_without_cache(self, cache_attributes=[
+            'has_zone', 'has_components', 'global_lh', 'family_lh', 'zone_lh', 'all_lh', 'weights'
+        ])
+        likelihood_copy.cache_calls = defaultdict(int)
+        likelihood_copy.cache_hits = defaultdict(int)
+        return likelihood_copy
+
+    def count_cache_usage(self, component, outdated):
+        """Keep track of whether the cached value of a component was reused or had to be recomputed.
+
+        Args:
+            component (str): name of the cached component.
+            outdated (bool): whether the cached value needs to be recomputed.
+        Returns:
+            bool: the unchanged ´outdated´ flag (for convenience).
+        """
+        self.cache_calls[component] += 1
+        if not outdated:
+            self.cache_hits[component] += 1
+        return outdated
+
     def reset_cache(self):
         # The assignment (global, zone, family) combined and weighted and the non-normalized likelihood
         self.has_components = None
@@ -192,7 +231,8 @@ class Likelihood(object):
             sample.what_changed['lh']['p_families'].clear()
 
     def get_global_lh(self, sample):
-        if (self.global_lh is None) or (sample.what_changed['lh']['p_global']):
+        outdated = (self.global_lh is None) or bool(sample.what_changed['lh']['p_global'])
+        if self.count_cache_usage('global_lh', outdated):
 
             self.global_lh = compute_global_likelihood(features=self.features,
                                                        p_global=sample.p_global,
@@ -207,7 +247,8 @@ class Likelihood(object):
             return None
 
         # Family lh is evaluated when initialized and when p_families is changed
-        if self.family_lh is None or sample.what_changed['lh']['p_families']:
+        outdated = self.family_lh is None or bool(sample.what_changed['lh']['p_families'])
+        if self.count_cache_usage('family_lh', outdated):
             # assert np.allclose(a=np.sum(sample.p_families, axis=-1), b=1., rtol=EPS)
             self.family_lh = compute_family_likelihood(features=self.features, families=self.families,
                                                        p_families=sample.p_families,
@@ -218,7 +259,9 @@ class Likelihood(object):
 
     def get_zone_lh(self, sample):
         # Zone lh is evaluated when initialized, or when zones or p_zones change
-        if self.zone_lh is None or sample.what_changed['lh']['zones'] or sample.what_changed['lh']['p_zones']:
+        outdated = (self.zone_lh is None or bool(sample.what_changed['lh']['zones'])
+                    or bool(sample.what_changed['lh']['p_zones']))
+        if self.count_cache_usage('zone_lh', outdated):
             # assert np.allclose(a=np.sum(p_zones, axis=-1), b=1., rtol=EPS)
             self.zone_lh = compute_zone_likelihood(features=self.features, zones=sample.zones,
                                                    p_zones=sample.p_zones,
@@ -234,9 +277,10 @@ class Likelihood(object):
         zone_lh = self.get_zone_lh(sample)
 
         # Merge the component likelihoods into one array (if something has changed)
-        if ((not caching) or (self.all_lh is None)
-                or sample.what_changed['lh']['zones'] or sample.what_changed['lh']['p_global']
-                or sample.what_changed['lh']['p_zones'] or sample.what_changed['lh']['p_families']):
+        outdated = bool((not caching) or (self.all_lh is None)
+                        or sample.what_changed['lh']['zones'] or sample.what_changed['lh']['p_global']
+                        or sample.what_changed['lh']['p_zones'] or sample.what_changed['lh']['p_families'])
+        if self.count_cache_usage('all_lh', outdated):
 
             # Structure of likelihood depends on whether inheritance is considered or not
             if self.inheritance:
@@ -281,7 +325,9 @@ class Likelihood(object):
                                                 self.has_zone]).T
 
         # weights are evaluated when initialized, when weights change or when assignment to zones changes
-        if self.weights is None or sample.what_changed['lh']['weights'] or sample.what_changed['lh']['zones']:
+        outdated = (self.weights is None or sample.what_changed['lh']['weights']
+                    or bool(sample.what_changed['lh']['zones']))
+        if self.count_cache_usage('weights', outdated):
 
             abnormal_weights = sample.weights
 
@@ -433,6 +479,65 @@ def compute_family_likelihood(features, families, p_families=None,
     return lh_families
 
 
+def compute_feature_log_likelihood_batch(features, na_features, families, zones, weights,
+                                         p_global, p_zones, p_families=None, source=None):
+    """Computes the log-likelihood of a subset of features for a batch of samples (e.g. the
+    current samples of all chains) in one go. The arguments are gathered per sample, such that
+    each sample can refer to different features.
+
+    Args:
+        features (np.array): The feature values of the selected features for each sample.
+            shape: (n_batch, n_selected, n_sites, n_categories)
+        na_features (np.array): Indicator for missing observations in the selected features.
+            shape: (n_batch, n_selected, n_sites)
+        families (np.array): Assignment of sites to families.
+            shape: (n_families, n_sites)
+        zones (np.array): Assignment of sites to zones in each sample.
+            shape: (n_batch, n_zones, n_sites)
+        weights (np.array): The (non-normalized) weights of the selected features.
+            shape: (n_batch, n_selected, n_components)
+        p_global (np.array): The global probabilities of the selected features.
+            shape: (n_batch, n_selected, n_categories)
+        p_zones (np.array): The zone probabilities of the selected features.
+            shape: (n_batch, n_selected, n_zones, n_categories)
+    Kwargs:
+        p_families (np.array): The family probabilities of the selected features (if inheritance is modelled).
+            shape: (n_batch, n_selected, n_families, n_categories)
+        source (np.array): The source assignment of the selected features (if the source is sampled).
+            shape: (n_batch, n_selected, n_sites, n_components)
+
+    Returns:
+        np.array: The log-likelihood of each selected feature in each sample.
+            shape: (n_batch, n_selected)
+    """
+    n_batch, _, n_sites, _ = features.shape
+
+    # The likelihood per site and feature according to each component
+    global_lh = np.einsum('bfsk,bfk->bfs', features, p_global)
+    zone_lh = np.einsum('bzs,bfsk,bfzk->bfs', zones, features, p_zones)
+    has_zone = np.any(zones, axis=1)
+    if p_families is None:
+        all_lh = np.stack([global_lh, zone_lh], axis=-1)
+        has_components = np.stack([np.ones((n_batch, n_sites), dtype=bool), has_zone], axis=-1)
+    else:
+        family_lh = np.einsum('ms,bfsk,bfmk->bfs', families, features, p_families)
+        has_family = np.broadcast_to(np.any(families, axis=0), (n_batch, n_sites))
+        all_lh = np.stack([global_lh, zone_lh, family_lh], axis=-1)
+        has_components = np.stack([np.ones((n_batch, n_sites), dtype=bool), has_zone, has_family], axis=-1)
+    all_lh[na_features] = 1.
+
+    # Normalize the weights per site (only components present at a site get a weight)
+    weights_per_site = weights[:, :, np.newaxis, :] * has_components[:, np.newaxis, :, :]
+    weights_per_site /= weights_per_site.sum(axis=-1, keepdims=True)
+
+    with np.errstate(divide='ignore'):
+        if source is None:
+            return np.sum(np.log(np.sum(weights_per_site * all_lh, axis=-1)), axis=-1)
+        else:
+            observation_lh = np.log(weights_per_site * all_lh)
+            return np.sum(np.where(source, observation_lh, 0.), axis=(-2, -1))
+
+
 def normalize_weights(weights, has_components):
     """This function assigns each site a weight if it has a likelihood and zero otherwise
 
@@ -481,6 +586,25 @@ class Prior(object):
         if self.inheritance:
             self.prior_p_families = PFamiliesPrior(config=prior_config['inheritance'], data=data)
 
+        # Statistics on how often the cached values could be reused
+        self.cache_calls = defaultdict(int)
+        self.cache_hits = defaultdict(int)
+
+    def evaluate_component(self, name, component, sample):
+        """Evaluate one component of the prior and keep track of whether its cache was used.
+
+        Args:
+            name (str): name of the prior component (used in the statistics).
+            component (callable): the prior component, e.g. self.geo_prior.
+            sample (Sample): the current MCMC sample.
+        Returns:
+            float: the (log)prior of the component.
+        """
+        self.cache_calls[name] += 1
+        if not component.is_outdated(sample):
+            self.cache_hits[name] += 1
+        return component(sample)
+
     def __call__(self, sample):
         """Compute the prior of the current sample.
         Args:
@@ -492,13 +616,13 @@ class Prior(object):
         log_prior = 0
 
         # Sum all prior components (in log-space)
-        log_prior += self.size_prior(sample)
-        log_prior += self.geo_prior(sample)
-        log_prior += self.prior_weights(sample)
-        log_prior += self.prior_p_global(sample)
-        log_prior += self.prior_p_zones(sample)
+        log_prior += self.evaluate_component('size', self.size_prior, sample)
+        log_prior += self.evaluate_component('geo', self.geo_prior, sample)
+        log_prior += self.evaluate_component('weights', self.prior_weights, sample)
+        log_prior += self.evaluate_component('p_global', self.prior_p_global, sample)
+        log_prior += self.evaluate_component('p_zones', self.prior_p_zones, sample)
         if self.inheritance:
-            log_prior += self.prior_p_families(sample)
+            log_prior += self.evaluate_component('p_families', self.prior_p_families, sample)
 
         self.everything_updated(sample)
 
@@ -525,9 +649,36 @@ class Prior(object):
         return setup_msg
 
     def __copy__(self):
-        return Prior(data=self.data,
-                     inheritance=self.inheritance,
-                     prior_config=self.config)
+        """Copy the prior, sharing the constant attributes of all components but not the caches."""
+        prior_copy = copy_without_cache(self, cache_attributes=[])
+        prior_copy.size_prior = copy(self.size_prior)
+        prior_copy.geo_prior = copy(self.geo_prior)
+        prior_copy.prior_weights = copy(self.prior_weights)
+        prior_copy.prior_p_global = copy(self.prior_p_global)
+        prior_copy.prior_p_zones = copy(self.prior_p_zones)
+        if self.inheritance:
+            prior_copy.prior_p_families = copy(self.prior_p_families)
+
+        prior_copy.cache_calls = defaultdict(int)
+        prior_copy.cache_hits = defaultdict(int)
+        return prior_copy
+
+
+def copy_without_cache(obj, cache_attributes=('cached',)):
+    """Create a shallow copy of a model component. All attributes are shared with the
+    original (they are constant during sampling), except for the cached values, which are reset.
+
+    Args:
+        obj (object): the model component to copy.
+        cache_attributes (iterable): names of the attributes holding cached values.
+    Returns:
+        object: the copy.
+    """
+    obj_copy = object.__new__(type(obj))
+    obj_copy.__dict__.update(obj.__dict__)
+    for attr in cache_attributes:
+        setattr(obj_copy, attr, None)
+    return obj_copy
 
 
 class DirichletPrior(object):
@@ -552,6 +703,9 @@ class DirichletPrior(object):
     def parse_attributes(self, config):
         raise NotImplementedError()
 
+    def __copy__(self):
+        return copy_without_cache(self)
+
     def is_outdated(self, sample):
         return self.cached is None
 
@@ -579,10 +733,12 @@ class PGlobalPrior(DirichletPrior):
 
         elif config['type'] == 'counts':
             self.prior_type = self.TYPES.COUNTS
+
+            # The counts are scaled locally, the data is not changed
+            counts = self.data.prior_universal['counts']
             if config['scale_counts'] is not None:
-                self.data.prior_universal['counts'] = scale_counts(counts=self.data.prior_universal['counts'],
-                                                                   scale_to=config['scale_counts'])
-            self.counts = self.initial_counts + self.data.prior_universal['counts']
+                counts = scale_counts(counts=counts, scale_to=config['scale_counts'])
+            self.counts = self.initial_counts + counts
             self.dirichlet = counts_to_dirichlet(self.counts,
                                                  self.data.states)
 
@@ -638,6 +794,14 @@ class PFamiliesPrior(DirichletPrior):
         UNIVERSAL = 'universal'
         COUNTS_AND_UNIVERSAL = 'counts_and_universal'
 
+    def __init__(self, config, data, initial_counts=1.):
+        # The dirichlet distribution depending on p_global (for the universal hyperprior) is cached per chain
+        self.prior_p_families_distr = None
+        super(PFamiliesPrior, self).__init__(config, data, initial_counts=initial_counts)
+
+    def __copy__(self):
+        return copy_without_cache(self, cache_attributes=['cached', 'prior_p_families_distr'])
+
     def parse_attributes(self, config):
         if config['type'] == 'uniform':
             n_families, _ = self.data.families.shape
@@ -655,13 +819,11 @@ class PFamiliesPrior(DirichletPrior):
         elif config['type'] == 'counts':
             self.prior_type = self.TYPES.COUNTS
 
+            # The counts are scaled locally, the data is not changed
+            counts = self.data.prior_inheritance['counts']
             if config['scale_counts'] is not None:
-                self.data.prior_inheritance['counts'] = scale_counts(
-                    counts=self.data.prior_inheritance['counts'],
-                    scale_to=config['scale_counts'],
-                    prior_inheritance=True
-                )
-            self.counts = self.initial_counts + self.data.prior_inheritance['counts']
+                counts = scale_counts(counts=counts, scale_to=config['scale_counts'], prior_inheritance=True)
+            self.counts = self.initial_counts + counts
             self.dirichlet = inheritance_counts_to_dirichlet(
                 counts=self.counts,
                 states=self.states
@@ -671,13 +833,11 @@ class PFamiliesPrior(DirichletPrior):
         elif config['type'] == 'counts_and_universal':
             self.prior_type = self.TYPES.COUNTS_AND_UNIVERSAL
 
+            # The counts are scaled locally, the data is not changed
+            counts = self.data.prior_inheritance['counts']
             if config['scale_counts'] is not None:
-                self.data.prior_inheritance['counts'] = scale_counts(
-                    counts=self.data.prior_inheritance['counts'],
-                    scale_to=config['scale_counts'],
-                    prior_inheritance=True
-                )
-            # self.counts = self.initial_counts + self.data.prior_inheritance['counts']
+                counts = scale_counts(counts=counts, scale_to=config['scale_counts'], prior_inheritance=True)
+            self.counts = self.initial_counts + counts
             self.strength = config['scale_counts']
             # self.states = self.data.prior_inheritance['states']
         else:
@@ -915,6 +1075,9 @@ class ZoneSizePrior(object):
         valid_types = ','.join([str(t.value) for t in self.TYPES])
         return f'Invalid prior type {s} for size prior (choose from [{valid_types}]).'
 
+    def __copy__(self):
+        return copy_without_cache(self)
+
     def parse_attributes(self, config):
         size_prior_type = config['type']
         if size_prior_type == 'none':
@@ -991,6 +1154,7 @@ class GeoPrior(object):
 
         self.prior_type = None
         self.cost_matrix = None
+        self.fallback_costs = None
         self.scale = None
         self.cached = None
 
@@ -1009,9 +1173,25 @@ class GeoPrior(object):
             self.cost_matrix = self.data.geo_prior['cost_matrix']
             self.scale = config['scale']
 
+            # Costs for connecting the components of a zone which is not connected in a sparse
+            # cost matrix: the dense costs (or, if the costs are only given sparse, the shortest
+            # paths in the sparse cost matrix)
+            if issparse(self.cost_matrix):
+                self.fallback_costs = None
+            else:
+                self.fallback_costs = self.cost_matrix
+
+            # Optionally, only keep the costs between neighbouring sites (Delaunay or k-NN graph)
+            if config.get('sparse') and not issparse(self.cost_matrix):
+                self.cost_matrix = sparse_cost_matrix(self.cost_matrix, self.data.network['locations'],
+                                                      graph=config['sparse'], k=config.get('k', 8))
+
         else:
             raise ValueError('Geo prior not supported')
 
+    def __copy__(self):
+        return copy_without_cache(self)
+
     def is_outdated(self, sample):
         return self.cached is None or sample.what_changed['prior']['zones']
 
@@ -1033,7 +1213,8 @@ class GeoPrior(object):
             #                                    self.config['gaussian'])
 
             elif self.prior_type == self.TYPES.COST_BASED:
-                geo_prior = geo_prior_distance(sample.zones, self.cost_matrix, self.scale)
+                geo_prior = geo_prior_distance(sample.zones, self.cost_matrix, self.scale,
+                                               fallback_costs=self.fallback_costs)
 
             else:
                 raise ValueError('geo_prior must be either \"uniform\", \"gaussian\" or \"cost_based\".')
@@ -1051,6 +1232,8 @@ class GeoPrior(object):
         msg = f'Geo-prior: {self.prior_type.value}\n'
         if self.prior_type == self.TYPES.COST_BASED:
             msg += f'\tScale: {self.scale}\n'
+            if issparse(self.cost_matrix):
+                msg += f'\tSparse cost-matrix: {self.cost_matrix.nnz // 2} edges\n'
             if 'file' in self.config:
                 msg += f'\tCost-matrix file: {self.config["file"]}\n'
         return msg
@@ -1093,13 +1276,16 @@ def geo_prior_gaussian(zones: np.array, network: dict, cov: np.array):
     return np.mean(log_prior)
 
 
-def geo_prior_distance(zones: np.array, cost_mat: np.array, scale: float):
+def geo_prior_distance(zones: np.array, cost_mat: np.array, scale: float, fallback_costs=None):
 
     """ This function computes the geo prior for the sum of all distances of the mst of a zone
     Args:
         zones (np.array): The current zones (boolean array)
-        cost_mat (np.array): The cost matrix between locations
+        cost_mat (np.array or csr_matrix): The cost matrix between locations (dense or sparse)
         scale (float): The scale parameter of an exponential distribution
+        fallback_costs (np.array): Dense (possibly memory-mapped) costs between all locations,
+            used between sites of a zone which are not connected in a sparse cost matrix
+            (default: the shortest paths in the sparse cost matrix)
 
     Returns:
         float: the geo-prior of the zones
@@ -1107,6 +1293,12 @@ def geo_prior_distance(zones: np.array, cost_mat: np.array, scale: float):
 
     log_prior = np.ndarray([])
     for z in zones:
+        if issparse(cost_mat):
+            # Sparse costs: MST on the subgraph of the zone
+            distances = sparse_mst_distances(cost_mat, np.flatnonzero(z), fallback_costs)
+            log_prior = stats.expon.logpdf(distances, loc=0, scale=scale)
+            continue
+
         cost_mat_z = cost_mat[z][:, z]
 
         # if len(locations) > 3:
@@ -1139,6 +1331,52 @@ def geo_prior_distance(zones: np.array, cost_mat: np.array, scale: float):
     return np.mean(log_prior)
 
 
+def sparse_mst_distances(cost_mat, idx, fallback_costs=None):
+    """Compute the edge costs of the minimum spanning tree of a zone on a sparse cost matrix.
+    If the zone is not connected in the sparse graph, the components are connected using
+    the dense fallback costs between their sites or, without fallback costs, the costs of the
+    shortest paths between them in the sparse graph (through sites outside the zone).
+
+    Args:
+        cost_mat (csr_matrix): The sparse cost matrix between all locations
+        idx (np.array): The indices of the sites in the zone
+        fallback_costs (np.array): The dense (possibly memory-mapped) costs between all locations.
+            Only the rows and columns of the zone are read.
+
+    Returns:
+        np.array: the costs of all edges in the minimum spanning tree
+    """
+    if len(idx) < 2:
+        raise ValueError("Too few locations to compute distance.")
+
+    graph = cost_mat[idx][:, idx]
+    n_components, labels = connected_components(graph, directed=False)
+
+    if n_components > 1:
+        # Fallback costs for all pairs of sites in different components
+        if fallback_costs is None:
+            fallback = dijkstra(cost_mat, directed=False, indices=idx)[:, idx]
+        else:
+            fallback = np.array(fallback_costs[np.ix_(idx, idx)], dtype=float)
+        fallback[labels[:, np.newaxis] == labels[np.newaxis, :]] = 0.
+
+        # Sites without a path between them in the sparse cost matrix stay unconnected
+        fallback[np.isinf(fallback)] = 0.
+        graph = graph + csr_matrix(fallback)
+
+        if connected_components(graph, directed=False)[0] > 1:
+            raise ValueError("The zone is not connected in the sparse cost matrix and there are "
+                             "no fallback costs to connect it.")
+
+    mst = minimum_spanning_tree(graph)
+
+    # When there are zero costs between languages the MST might be 0
+    if mst.nnz > 0:
+        return mst.data
+    else:
+        return 0
+
+
 def prior_p_global_dirichlet(p_global, dirichlet, states, outdated_features, cached_prior=None):
     """" This function evaluates the prior for p_families
     Args:
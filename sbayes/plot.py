@@ -4,6 +4,7 @@ import math
 import os
 from copy import deepcopy
 from itertools import compress
+from pathlib import Path
 from statistics import median
 
 import pandas as pd
@@ -15,18 +16,21 @@ import numpy as np
 import seaborn as sns
 from descartes import PolygonPatch
 from matplotlib import patches
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
 from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
 from matplotlib.ticker import AutoMinorLocator
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+from scipy.sparse import csr_matrix, triu
 from scipy.spatial import Delaunay
 from shapely import geometry
-from shapely.ops import cascaded_union, polygonize
+from shapely.ops import polygonize, unary_union
 
 from sbayes.postprocessing import compute_dic
 from sbayes.preprocessing import compute_network, read_sites, assign_family
-from sbayes.util import add_edge, compute_delaunay
-from sbayes.util import fix_default_config
+from sbayes.util import compute_delaunay
+from sbayes.util import fix_default_config, hash_inputs
 from sbayes.util import gabriel_graph_from_delaunay
 from sbayes.util import parse_area_columns, read_features_from_csv
 
@@ -100,6 +104,9 @@ class Plot:
         self.world = None
         self.rivers = None
 
+        # Projected base map layers, by file, CRS and extent (shared by all maps of this object)
+        self.geo_layers = {}
+
     # From plot_setup:
 
     ####################################
@@ -465,40 +472,33 @@ class Plot:
 
         tri = Delaunay(points, qhull_options="QJ Pp")
 
-        edges = set()
-        edge_nodes = []
-
-        # loop over triangles:
-        # ia, ib, ic = indices of corner points of the triangle
-        for ia, ib, ic in tri.vertices:
-            pa = points[ia]
-            pb = points[ib]
-            pc = points[ic]
-
-            # Lengths of sides of triangle
-            a = math.sqrt((pa[0] - pb[0]) ** 2 + (pa[1] - pb[1]) ** 2)
-            b = math.sqrt((pb[0] - pc[0]) ** 2 + (pb[1] - pc[1]) ** 2)
-            c = math.sqrt((pc[0] - pa[0]) ** 2 + (pc[1] - pa[1]) ** 2)
+        # Lengths of the sides of all triangles
+        pa, pb, pc = np.moveaxis(points[tri.simplices], 1, 0)
+        a = np.linalg.norm(pa - pb, axis=-1)
+        b = np.linalg.norm(pb - pc, axis=-1)
+        c = np.linalg.norm(pc - pa, axis=-1)
 
-            # Semiperimeter of triangle
-            s = (a + b + c) / 2.0
-
-            # Area of triangle by Heron's formula
-            area = math.sqrt(s * (s - a) * (s - b) * (s - c))
+        # Semiperimeter and area (by Heron's formula) of all triangles
+        s = (a + b + c) / 2.0
+        area = np.sqrt(np.maximum(s * (s - a) * (s - b) * (s - c), 0.))
+        with np.errstate(divide='ignore', invalid='ignore'):
             circum_r = a * b * c / (4.0 * area)
 
-            "alpha value to influence the shape of the convex hull Smaller numbers don't fall inward "
-            "as much as larger numbers. Too large, and you lose everything!"
-
-            if circum_r < 1.0 / alpha_shape:
-                add_edge(edges, edge_nodes, points, ia, ib)
-                add_edge(edges, edge_nodes, points, ib, ic)
-                add_edge(edges, edge_nodes, points, ic, ia)
+        # alpha value to influence the shape of the convex hull Smaller numbers don't fall inward
+        # as much as larger numbers. Too large, and you lose everything!
+        in_shape = circum_r < 1.0 / alpha_shape
 
-        m = geometry.MultiLineString(edge_nodes)
+        # The boundary of the alpha shape consists of the edges which belong to exactly one triangle
+        triangles = tri.simplices[in_shape]
+        edges = np.sort(np.concatenate([triangles[:, [0, 1]],
+                                        triangles[:, [1, 2]],
+                                        triangles[:, [2, 0]]]), axis=1)
+        edges, counts = np.unique(edges, axis=0, return_counts=True)
+        boundary = edges[counts == 1]
 
-        triangles = list(polygonize(m))
-        polygon = cascaded_union(triangles)
+        # Polygonize the boundary (enclosed holes are filled, as in the union of all triangles and holes)
+        m = geometry.MultiLineString(list(points[boundary]))
+        polygon = unary_union(list(polygonize(m)))
 
         return polygon
 
@@ -563,15 +563,18 @@ class Plot:
         n_graph = len(locations)
 
         # getting indices of points in area
-        area_indices = np.argwhere(in_graph)
+        area_indices = np.flatnonzero(in_graph)
 
-        # For density map: plot all edges
-        if self.content_config['type'] == 'density_map':
+        # Count how often each pair of points is together in the posterior of the area
+        # (co-occurrence matrix of the points in the graph over all samples)
+        area_samples = csr_matrix(area[:, in_graph], dtype=int)
+        together = (area_samples.T @ area_samples).tocsr()
 
-            a = np.arange(area.shape[1])
-            b = np.array(np.meshgrid(a, a))
-            c = b.T.reshape(-1, 2)
-            graph_connections = c[c[:, 0] < c[:, 1]]
+        # For density map: plot all edges (edges which never occur have zero weight and are dropped)
+        if self.content_config['type'] == 'density_map':
+            together = triu(together, k=1).tocoo()
+            graph_connections = np.column_stack([together.row, together.col])
+            together_count = together.data
 
         # For consensus map plot Gabriel graph
         else:
@@ -589,15 +592,11 @@ class Plot:
             else:
                 return in_graph, [], []
 
-        lines = []
-        line_weights = []
+            graph_connections = np.asarray(graph_connections, dtype=int).reshape(-1, 2)
+            together_count = np.asarray(together[graph_connections[:, 0], graph_connections[:, 1]]).ravel()
 
-        for index in graph_connections:
-            # count how often p0 and p1 are together in the posterior of the area
-            p = [area_indices[index[0]][0], area_indices[index[1]][0]]
-            together_in_area = np.sum(np.all(area[:, p], axis=1)) / n_samples
-            lines.append(self.locations[[*p]])
-            line_weights.append(together_in_area)
+        lines = self.locations[area_indices[graph_connections]]
+        line_weights = together_count / n_samples
 
         return in_graph, lines, line_weights
 
@@ -688,9 +687,11 @@ class Plot:
             in_graph, lines, line_w = self.areas_to_graph(area)
 
             if self.content_config['type'] == 'density_map':
-                for li in range(len(lines)):
-                    self.ax.plot(*lines[li].T, color=current_color, lw=line_w[li] * self.graphic_config['line_width'],
-                                 alpha=line_w[li])
+                # Draw all edges at once, with the co-occurrence frequency as line width and opacity
+                line_colors = np.tile(to_rgba(current_color), (len(lines), 1))
+                line_colors[:, 3] = line_w
+                self.ax.add_collection(LineCollection(lines, colors=line_colors,
+                                                      linewidths=line_w * self.graphic_config['line_width']))
 
             else:
                 self.ax.scatter(*self.locations[in_graph].T, s=self.graphic_config['point_size'], c=current_color)
@@ -975,19 +976,56 @@ class Plot:
             raise Exception('If you want to use a map, provide a geojson and a crs!')
 
         # Adds the geojson map provided by user as background map
-        self.world = gpd.read_file(self.geo_config['base_map']['geojson_map'])
-        self.world = self.world.to_crs(self.geo_config['proj4'])
-        # self.world = gpd.clip(self.world, self.bbox)
+        self.world = self.load_geo_layer(self.geo_config['base_map']['geojson_map'], ax)
         self.world.plot(ax=ax, color='w', edgecolor='black', zorder=-100000)
 
     # Add rivers
     def add_rivers(self, ax):
         # The user can also provide river data. Looks good on a map :)
         if self.geo_config['base_map']['geojson_river'] is not None:
-            self.rivers = gpd.read_file(self.geo_config['base_map']['geojson_river'])
-            self.rivers = self.rivers.to_crs(self.geo_config['proj4'])
+            self.rivers = self.load_geo_layer(self.geo_config['base_map']['geojson_river'], ax)
             self.rivers.plot(ax=ax, color=None, edgecolor="skyblue", zorder=-10000)
 
+    def load_geo_layer(self, file, ax):
+        """Load a geojson layer, projected to the CRS of the map and reduced to the features
+        within the extent of the axes. Layers are kept in memory for all maps of this object
+        and, if geo.base_map.cache is set in the config, stored on disk between sessions.
+
+        Args:
+            file (str): path to the geojson file.
+            ax (plt.Axes): the axes of the map (defining the extent).
+        Returns:
+            gpd.GeoDataFrame: the projected layer.
+        """
+        extent = (*ax.get_xlim(), *ax.get_ylim())
+        key = (str(file), self.geo_config['proj4'], extent)
+        if key in self.geo_layers:
+            return self.geo_layers[key]
+
+        cache_file = None
+        if self.geo_config['base_map'].get('cache', False):
+            cache_hash = hash_inputs([file], {'crs': self.geo_config['proj4'], 'extent': extent})
+            cache_file = Path(file).parent / '.sbayes_cache' / f'geo_{cache_hash}.pkl'
+
+        if cache_file is not None and cache_file.exists():
+            layer = pd.read_pickle(cache_file)
+        else:
+            layer = gpd.read_file(file).to_crs(self.geo_config['proj4'])
+
+            # Only keep the features which are visible on the map
+            x_min, x_max, y_min, y_max = extent
+            layer = layer.cx[x_min:x_max, y_min:y_max]
+
+            if cache_file is not None:
+                # Write to a temporary file first, so that parallel processes never read an incomplete cache
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+                layer.to_pickle(tmp_file)
+                os.replace(tmp_file, cache_file)
+
+        self.geo_layers[key] = layer
+        return layer
+
     # Add likelihood info box
     def add_likelihood_info(self, legend_area_patches):
         extra = patches.Rectangle((0, 0), 1, 1, fc="w", fill=False, edgecolor='none', linewidth=0)
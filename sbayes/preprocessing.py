@@ -6,15 +6,20 @@ except ImportError:
     from typing_extensions import Literal
 
 import csv
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import pyproj
+from scipy.sparse import load_npz
 
 from sbayes.model import normalize_weights
 from sbayes.util import (compute_delaunay,
+                         compute_distance_matrix,
                          read_feature_occurrence_from_csv,
                          read_features_from_csv,
-                         read_costs_from_csv)
+                         read_costs_from_csv,
+                         read_costs_from_binary,
+                         is_symmetric,
+                         symmetrize)
 
 EPS = np.finfo(float).eps
 
@@ -98,12 +103,81 @@ def read_sites(file, retrieve_family=False, retrieve_subset=False):
     log = str(len(name)) + " locations read from " + str(file)
     return sites, site_names, log
 
+def geodesic_distance_block(lon, lat, start, end):
+    """Compute the geodesic distances between the sites in rows start:end and all sites
+    from index ´start´ onwards (i.e. one block of the upper triangle of the distance matrix).
+
+    Args:
+        lon (np.array): longitudes of all sites.
+        lat (np.array): latitudes of all sites.
+        start (int): first row of the block.
+        end (int): end of the block (exclusive).
+    Returns:
+        np.array: the geodesic distances in meters.
+            shape: (end - start, n_sites - start)
+    """
+    import pyproj
+
+    geod = pyproj.Geod(ellps='WGS84')
+    rows, cols = np.meshgrid(np.arange(start, end), np.arange(start, len(lon)), indexing='ij')
+    _, _, dist = geod.inv(lon[rows.ravel()], lat[rows.ravel()],
+                          lon[cols.ravel()], lat[cols.ravel()])
+    return dist.reshape(rows.shape)
+
+
+def compute_geodesic_distance_matrix(lon, lat, dtype=np.float64, out_file=None, block_size=500, n_jobs=1):
+    """Compute the matrix of geodesic distances (on the WGS84 ellipsoid) between all sites.
+    The upper triangle is computed in blocks of rows, each block in one vectorized call, and
+    mirrored to the lower triangle. The blocks can be distributed over a pool of processes.
+
+    Args:
+        lon (np.array): longitudes of all sites.
+        lat (np.array): latitudes of all sites.
+        dtype (np.dtype): data type of the distance matrix.
+        out_file (Path): path of a .npy file to memory-map the distance matrix to (optional).
+        block_size (int): number of rows computed in one block.
+        n_jobs (int): number of processes to use.
+    Returns:
+        np.array: the distance matrix in meters.
+            shape: (n_sites, n_sites)
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    n = len(lon)
+
+    if out_file is None:
+        dist_mat = np.empty((n, n), dtype=dtype)
+    else:
+        dist_mat = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=(n, n))
+
+    starts = list(range(0, n, block_size))
+    ends = [min(start + block_size, n) for start in starts]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            blocks = executor.map(geodesic_distance_block,
+                                  [lon] * len(starts), [lat] * len(starts), starts, ends)
+            for start, end, block in zip(starts, ends, blocks):
+                dist_mat[start:end, start:] = block
+                dist_mat[start:, start:end] = block.T
+    else:
+        for start, end in zip(starts, ends):
+            block = geodesic_distance_block(lon, lat, start, end)
+            dist_mat[start:end, start:] = block
+            dist_mat[start:, start:end] = block.T
+
+    return dist_mat
+
+
 class compute_network:
     def __init__(
             self,
             sites,
             subset=None,
-            crs=None):
+            crs=None,
+            dist_dtype=np.float64,
+            dist_file=None,
+            n_jobs=1):
         """Convert a set of sites into a network.
 
         This function converts a set of language locations, with their attributes,
@@ -113,18 +187,14 @@ class compute_network:
         Args:
             sites(dict): a dict of sites with keys "locations", "id"
             subset(list): boolean assignment of sites to subset
+            crs(pyproj.CRS): coordinate reference system of the locations
+            dist_dtype(np.dtype): data type of the distance matrix
+            dist_file(Path): path of a .npy file to memory-map the distance matrix to (optional)
+            n_jobs(int): number of processes used to compute geodesic distances
         Returns:
             dict: a network
 
         """
-        if crs is not None:
-            try:
-                from cartopy import crs as ccrs, geodesic
-            except ImportError as e:
-                print("Using a coordinate reference system (crs) requires the ´cartopy´ library:")
-                print("pip install cartopy")
-                raise e
-
         if subset is None:
             # Define vertices and edges
             vertices = sites['id']
@@ -146,24 +216,23 @@ class compute_network:
         # Delaunay triangulation
 
         delaunay = compute_delaunay(locations)
-        v1, v2 = delaunay.toarray().nonzero()
+        delaunay.sort_indices()
+        v1, v2 = delaunay.nonzero()
         edges = np.column_stack((v1, v2))
 
         # Adjacency Matrix
         adj_mat = delaunay.tocsr()
 
         if crs is None:
-            loc = np.asarray(sites['locations'])
-            diff = loc[:, None] - loc
-            dist_mat = np.linalg.norm(diff, axis=-1)
+            dist_mat = compute_distance_matrix(locations, dtype=dist_dtype, out_file=dist_file)
         else:
+            import pyproj
+
             transformer = pyproj.transformer.Transformer.from_crs(
-                crs_from=crs, crs_to=pyproj.crs.CRS("epsg:4326"))
-            w_locations = np.vstack(
-                transformer.transform(locations[:, 0], locations[:, 1])
-            ).T
-            geod = geodesic.Geodesic()
-            dist_mat = np.hstack([geod.inverse(location, w_locations)[:, :2] for location in w_locations])
+                crs_from=crs, crs_to=pyproj.crs.CRS("epsg:4326"), always_xy=True)
+            lon, lat = transformer.transform(locations[:, 0], locations[:, 1])
+            dist_mat = compute_geodesic_distance_matrix(lon, lat, dtype=dist_dtype,
+                                                        out_file=dist_file, n_jobs=n_jobs)
 
         self.vertices = vertices
         self.edges = edges
@@ -173,6 +242,20 @@ class compute_network:
         self.m = edges.shape[0]
         self.dist_mat = dist_mat
 
+    @classmethod
+    def from_arrays(cls, vertices, edges, locations, names, adj_mat, dist_mat):
+        """Create a network from precomputed components (e.g. loaded from a cache)."""
+        network = cls.__new__(cls)
+        network.vertices = vertices
+        network.edges = edges
+        network.locations = locations
+        network.names = names
+        network.adj_mat = adj_mat
+        network.n = len(vertices)
+        network.m = edges.shape[0]
+        network.dist_mat = dist_mat
+        return network
+
     def __getitem__(self, key: Literal['vertices', 'edges', 'locations', 'names', 'adj_mat', 'n', 'm', 'dist_mat']):
         if key == "vertices":
             return self.vertices
@@ -230,7 +313,8 @@ def subset_features(features, subset):
     return features[sub, :, :]
 
 
-def simulate_features(areas,  p_universal, p_contact, weights, inheritance, p_inheritance=None, families=None):
+def simulate_features(areas,  p_universal, p_contact, weights, inheritance, p_inheritance=None, families=None,
+                      one_hot=True):
     """Simulate features for of all sites from the likelihood.
 
     Args:
@@ -248,10 +332,13 @@ def simulate_features(areas,  p_universal, p_contact, weights, inheritance, p_in
             by universal pressure, contact, and inheritance.
             shape: (n_features, 3)
         inheritance(bool): Is inheritance (family membership) considered when simulating features?
+        one_hot(bool): Return the features one-hot encoded (otherwise as state indices)?
 
     Returns:
         np.array: The sampled categories for all sites and features and states
         shape:  n_sites, n_features, n_categories
+            or (if not one_hot)
+        shape:  n_sites, n_features
     """
     n_areas, n_sites = areas.shape
     n_features, n_categories = p_universal.shape
@@ -259,57 +346,68 @@ def simulate_features(areas,  p_universal, p_contact, weights, inheritance, p_in
     # Are the weights fine?
     assert np.allclose(a=np.sum(weights, axis=-1), b=1., rtol=EPS)
 
-    # Compute the universal assignment and the assignment of sites to areas and families
-    universal_assignment = np.ones(n_sites)
-    area_assignment = np.any(areas, axis=0)
+    # Sites with the same assignment to areas and families share the same likelihood
+    # -> compute the likelihood once per group of sites
+    if not inheritance:
+        membership = areas.T
+    else:
+        membership = np.hstack([areas.T, families.T])
+    groups, group_idx = np.unique(membership, axis=0, return_inverse=True)
+    group_idx = group_idx.ravel()
+    group_areas = groups[:, :n_areas].astype(float)
+    n_groups = len(groups)
+
+    # Compute the universal assignment and the assignment of groups to areas and families
+    universal_assignment = np.ones(n_groups)
+    area_assignment = np.any(group_areas, axis=-1)
 
     if not inheritance:
         assignment = np.array([universal_assignment, area_assignment]).T
 
     else:
-        family_assignment = np.any(families, axis=0)
+        group_families = groups[:, n_areas:].astype(float)
+        family_assignment = np.any(group_families, axis=-1)
         assignment = np.array([universal_assignment, area_assignment, family_assignment]).T
 
-    # Normalize the weights for each site depending on whether areas or families are relevant for that site
+    # Normalize the weights for each group depending on whether areas or families are relevant for that group
     # Order of columns in weights: universal, contact, (inheritance if available)
-    weights = np.repeat(weights[np.newaxis, :, :], n_sites, axis=0)
+    weights = np.repeat(weights[np.newaxis, :, :], n_groups, axis=0)
     normed_weights = normalize_weights(weights, assignment)
-    normed_weights = np.transpose(normed_weights, (1, 0, 2))
-
-    features = np.zeros((n_sites, n_features), dtype=int)
-
-    for i_feat in range(n_features):
 
-        # Compute the feature likelihood matrix (for all sites and all categories)
-        lh_universal = p_universal[np.newaxis, i_feat, :].T
-        lh_area = areas.T.dot(p_contact[:, i_feat, :]).T
+    # Compute the feature likelihood for all groups, features and categories
+    lh_universal = p_universal[np.newaxis, :, :]
+    lh_area = np.einsum('ga,afk->gfk', group_areas, p_contact)
+    lh_features = normed_weights[:, :, [0]] * lh_universal + normed_weights[:, :, [1]] * lh_area
 
-        lh_feature = normed_weights[i_feat, :, 0] * lh_universal + normed_weights[i_feat, :, 1] * lh_area
-
-        # Families
-        if inheritance:
-            lh_family = families.T.dot(p_inheritance[:, i_feat, :]).T
-            lh_feature += normed_weights[i_feat, :, 2] * lh_family
+    # Families
+    if inheritance:
+        lh_family = np.einsum('gh,hfk->gfk', group_families, p_inheritance)
+        lh_features += normed_weights[:, :, [2]] * lh_family
 
-        # Sample from the categorical distribution defined by lh_feature
-        features[:, i_feat] = sample_categorical(lh_feature.T)
+    # Sample all sites and features at once from the categorical distribution defined by lh_features
+    # (inverse CDF: the sampled state is the number of states whose cumulative probability is below z)
+    cdf = np.cumsum(lh_features, axis=-1)
+    z = np.random.random((n_sites, n_features))
+    features = np.zeros((n_sites, n_features), dtype=int)
+    for i_cat in range(n_categories - 1):
+        features += (cdf[group_idx, :, i_cat] <= z)
 
-    # Restructure features
-    states = np.unique(features)
-    features_states = np.zeros((n_sites, n_features, len(states)), dtype=int)
-    for st in states:
-        features_states[:, :, st] = np.where(features == st, 1, 0)
+    if not one_hot:
+        features_states = features
+    else:
+        # Restructure features
+        n_states = np.max(features) + 1
+        features_states = np.eye(n_states, dtype=int)[features]
 
     # State names
-    state_names = []
-    for f in range(n_features):
-        applicable = np.unique(features.transpose()[f])
-        state_names.append(applicable.tolist())
+    observed = np.zeros((n_features, n_categories), dtype=bool)
+    observed[np.arange(n_features)[np.newaxis, :], features] = True
+    state_names = [np.flatnonzero(observed_f).tolist() for observed_f in observed]
 
     applicable_states = p_universal > 0.0
 
-    feature_names = {'external': ['f' + str(f+1) for f in range(features_states.shape[1])],
-                     'internal': [f for f in range(features_states.shape[1])]}
+    feature_names = {'external': ['f' + str(f+1) for f in range(n_features)],
+                     'internal': [f for f in range(n_features)]}
 
     state_names = {'external': state_names,
                    'internal': state_names}
@@ -449,11 +547,29 @@ def simulate_weights(i_universal, i_contact,  inheritance, n_features, i_inherit
     return weights
 
 
-def simulate_assignment_probabilities(n_features, p_number_categories, inheritance, areas, e_universal,
-                                      e_contact, e_inheritance=None, families=None):
-    """ Simulates the categories and then the assignment probabilities to categories in areas, families and universally
+def simulate_dirichlet(alpha, applicable):
+    """Sample from symmetric Dirichlet distributions over the applicable states (via normalized
+    gamma variates), for all features (and candidates) at once.
+
+    Args:
+        alpha (float): the concentration parameter
+        applicable (np.array): the applicable states
+            shape: (*output_dims, n_states)
+    Returns:
+        np.array: the sampled probabilities (zero for states which are not applicable)
+            shape: (*output_dims, n_states)
+    """
+    gamma = np.random.gamma(alpha, size=applicable.shape) * applicable
+    return gamma / np.sum(gamma, axis=-1, keepdims=True)
+
+
+def simulate_assignment_probabilities_batch(n_candidates, n_features, p_number_categories, inheritance, areas,
+                                            e_universal, e_contact, e_inheritance=None, families=None):
+    """ Simulates a batch of candidate sets of categories and assignment probabilities to categories in areas,
+    families and universally
 
        Args:
+           n_candidates(int): number of candidate sets to simulate
            n_features(int): number of features to simulate
            p_number_categories(dict): probability of simulating a feature with k categories
            inheritance(bool): Simulate probability ofr inheritance?
@@ -465,7 +581,12 @@ def simulate_assignment_probabilities(n_features, p_number_categories, inheritan
            e_contact(float): controls the entropy of the simulated contact effect in the areas
            e_inheritance(float): controls the entropy of the simulated inheritance in the families
        Returns:
-           (np.array, np.array, np.array): The assignment probabilities (universal, areal, inheritance) per feature
+           (np.array, np.array, np.array, np.array): The assignment probabilities (universal, areal, inheritance)
+                per candidate and feature and the number of categories per candidate and feature
+                shapes: (n_candidates, n_features, max_categories),
+                        (n_candidates, n_areas, n_features, max_categories),
+                        (n_candidates, n_families, n_features, max_categories),
+                        (n_candidates, n_features)
        """
     cat = []
     p_cat = []
@@ -474,46 +595,51 @@ def simulate_assignment_probabilities(n_features, p_number_categories, inheritan
         p_cat.append(v)
 
     # Simulate categories
-    n_categories = np.random.choice(a=cat, size=n_features, p=p_cat)
-
-    n_features = len(n_categories)
-    max_categories = max(n_categories)
+    n_categories = np.random.choice(a=cat, size=(n_candidates, n_features), p=p_cat)
+    max_categories = np.max(n_categories)
+    applicable = np.arange(max_categories) < n_categories[..., np.newaxis]
     n_areas = len(areas)
 
-    # Initialize empty assignment probabilities
-    p_universal = np.zeros((n_features, max_categories), dtype=float)
-    p_contact = np.zeros((n_areas, n_features, max_categories), dtype=float)
-
-    # Simulate assignment to categories
-    for f in range(n_features):
-        cat_f = n_categories[f]
+    # Simulate assignment to categories (universal and in areas)
+    p_universal = simulate_dirichlet(e_universal, applicable)
+    p_contact = simulate_dirichlet(e_contact, np.repeat(applicable[:, np.newaxis], n_areas, axis=1))
 
-        # Universal assignment
-        alpha_p_universal = np.full(shape=cat_f, fill_value=e_universal)
-        p_universal[f, range(cat_f)] = np.random.dirichlet(alpha_p_universal, size=1)
-
-        # Assignment in areas
-        alpha_p_contact = np.full(shape=cat_f, fill_value=e_contact)
-        for z in range(n_areas):
-            p_contact[z, f, range(cat_f)] = np.random.dirichlet(alpha_p_contact, size=1)
     # Simulate Inheritance?
     if not inheritance:
-        return p_universal, p_contact, None
+        return p_universal, p_contact, None, n_categories
 
     else:
         n_families = len(families)
-        p_inheritance = np.zeros((n_families, n_features, max_categories), dtype=float)
+        p_inheritance = simulate_dirichlet(e_inheritance, np.repeat(applicable[:, np.newaxis], n_families, axis=1))
+        return p_universal, p_contact, p_inheritance, n_categories
 
-        for f in range(n_features):
-            cat_f = n_categories[f]
 
-            # Assignment in families
-            alpha_p_inheritance = [e_inheritance] * cat_f
+def simulate_assignment_probabilities(n_features, p_number_categories, inheritance, areas, e_universal,
+                                      e_contact, e_inheritance=None, families=None):
+    """ Simulates the categories and then the assignment probabilities to categories in areas, families and universally
 
-            for fam in range(n_families):
-                p_inheritance[fam, f, range(cat_f)] = np.random.dirichlet(alpha_p_inheritance, size=1)
+       Args:
+           n_features(int): number of features to simulate
+           p_number_categories(dict): probability of simulating a feature with k categories
+           inheritance(bool): Simulate probability ofr inheritance?
+           areas (np.array): assignment of sites to areas (Boolean)
+                shape(n_areas, n_sites)
+           families(np.array): assignment of sites to families
+                shape(n_families, n_sites)
+           e_universal (float): controls the entropy of the simulated universal pressure
+           e_contact(float): controls the entropy of the simulated contact effect in the areas
+           e_inheritance(float): controls the entropy of the simulated inheritance in the families
+       Returns:
+           (np.array, np.array, np.array): The assignment probabilities (universal, areal, inheritance) per feature
+       """
+    p_universal, p_contact, p_inheritance, _ = simulate_assignment_probabilities_batch(
+        n_candidates=1, n_features=n_features, p_number_categories=p_number_categories, inheritance=inheritance,
+        areas=areas, e_universal=e_universal, e_contact=e_contact, e_inheritance=e_inheritance, families=families)
 
-        return p_universal, p_contact, p_inheritance
+    if not inheritance:
+        return p_universal[0], p_contact[0], None
+    else:
+        return p_universal[0], p_contact[0], p_inheritance[0]
 
 
 def read_universal_counts(feature_names, state_names, file, file_type, feature_states_file):
@@ -674,28 +800,65 @@ def read_inheritance_counts(family_names, feature_names, state_names, files, fil
     return counts_all.astype(int), log
 
 
-def read_geo_cost_matrix(site_names, file):
-    """ This is a helper function to import the geographical cost matrix.
+def read_sparse_geo_cost_matrix(site_names, file):
+    """ Import a sparse geographical cost matrix, stored with scipy.sparse.save_npz. Missing
+    entries are pairs of sites without a direct connection.
 
     Args:
         site_names (dict): the names of the sites or languages (external and internal)
         file: path to the file location
 
     Returns:
+        (csr_matrix, str): the cost matrix and log information
+    """
+    cost_matrix = load_npz(file).tocsr()
+    n_sites = len(site_names['external'])
+    if cost_matrix.shape != (n_sites, n_sites):
+        raise ValueError(f'The sparse cost matrix in {file} has shape {cost_matrix.shape}, '
+                         f'but there are {n_sites} sites.')
+
+    log = f"Sparse geographical cost matrix with {cost_matrix.nnz} entries read from {file}."
+
+    # Check if matrix is symmetric, if not make symmetric
+    if (abs(cost_matrix - cost_matrix.T) > 1e-8).nnz > 0:
+        cost_matrix = (cost_matrix + cost_matrix.T) / 2
+        log += f" The cost matrix is not symmetric. It was made symmetric by averaging the original" \
+               f" costs along the upper and lower triangle."
+    return cost_matrix, log
 
+
+def read_geo_cost_matrix(site_names, file):
+    """ This is a helper function to import the geographical cost matrix. The costs are either
+    read from a csv file (dense, with site names as index and columns), from a binary numpy file
+    (.npy ordered like the sites in the features file, or .npz with `costs` and `site_ids`) or from
+    a sparse matrix in scipy's .npz format (ordered like the sites in the features file).
+
+    Args:
+        site_names (dict): the names of the sites or languages (external and internal)
+        file: path to the file location
+
+    Returns:
+        (np.array or csr_matrix, str): the cost matrix and log information
     """
-    costs, log = read_costs_from_csv(file)
-    assert set(costs.columns) == set(site_names['external'])
+    site_ids = [str(s) for s in site_names['external']]
 
-    # Sort the data by site names
-    sorted_costs = costs.loc[site_names['external'], site_names['external']]
+    if str(file).endswith('.npz'):
+        with np.load(file, allow_pickle=False) as npz:
+            is_sparse = 'costs' not in npz.files
+        if is_sparse:
+            return read_sparse_geo_cost_matrix(site_names, file)
+        cost_matrix, log = read_costs_from_binary(file, site_ids)
 
-    cost_matrix = np.asarray(sorted_costs).astype(float)
+    elif str(file).endswith('.npy'):
+        cost_matrix, log = read_costs_from_binary(file, site_ids)
+
+    else:
+        cost_matrix, log = read_costs_from_csv(file, site_ids)
 
     # Check if matrix is symmetric, if not make symmetric
-    if not np.allclose(cost_matrix, cost_matrix.T):
-        cost_matrix = (cost_matrix + cost_matrix.T)/2
-        log += f".The cost matrix is not symmetric. It was made symmetric by averaging the original" \
+    if not is_symmetric(cost_matrix):
+        cost_matrix = symmetrize(cost_matrix)
+        log += f" The cost matrix is not symmetric. It was made symmetric by averaging the original" \
                f" costs along the upper and lower triangle."
     return cost_matrix, log
 
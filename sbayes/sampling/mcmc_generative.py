@@ -4,6 +4,7 @@ from __future__ import absolute_import, division, print_function, \
     unicode_literals
 import math as _math
 import abc as _abc
+import json as _json
 import random as _random
 import time as _time
 import numpy as _np
@@ -33,7 +34,7 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
     def __init__(self, model, data, operators, n_chains,
                  mc3=False, swap_period=None, chain_swaps=None,
                  sample_from_prior=False, show_screen_log=False,
-                 logger=None, **kwargs):
+                 batch_chains=False, logger=None, **kwargs):
 
         # The model and data defining the posterior distribution
         self.model = model
@@ -44,6 +45,12 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
         self.chain_idx = list(range(self.n_chains))
         self.sample_from_prior = sample_from_prior
 
+        # Perform the steps of all chains in one batch (vectorized over chains, where possible)
+        if batch_chains and not hasattr(self, 'likelihood_batch'):
+            raise ValueError(f'{type(self).__name__} does not support batching the steps of all '
+                             f'chains (BATCH_CHAINS), since it has no batched likelihood.')
+        self.batch_chains = batch_chains
+
         # Operators
         self.fn_operators, self.p_operators = self.get_operators(operators)
 
@@ -68,7 +75,11 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
                            'accepted_swaps': 0,
                            'swap_ratio': [],
                            'accept_operator': defaultdict(int),
-                           'reject_operator': defaultdict(int)}
+                           'reject_operator': defaultdict(int),
+                           'time_proposal': defaultdict(float),
+                           'time_likelihood': defaultdict(float),
+                           'time_prior': defaultdict(float),
+                           'cache_usage': {}}
 
         # State attributes
         self._ll = _np.full(self.n_chains, -_np.inf)
@@ -188,8 +199,11 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
                 warmup_progress = (i_warmup / warm_up_steps) * 100
                 if warmup_progress % 10 == 0:
                     print("warm-up", int(warmup_progress), "%")
-                for c in self.chain_idx:
-                    sample[c] = self.step(sample[c], c)
+                if self.batch_chains:
+                    sample = self.step_batch(sample)
+                else:
+                    for c in self.chain_idx:
+                        sample[c] = self.step(sample[c], c)
 
             # For the last sample find the best chain (highest posterior)
             posterior_samples = [self._ll[c] + self._prior[c] for c in self.chain_idx]
@@ -231,6 +245,7 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
                     self.log_last_sample(sample[self.chain_idx[0]])
 
             t_end = _time.time()
+            self.statistics['cache_usage'] = self.get_cache_usage()
             self.statistics['sampling_time'] = t_end - t_start
             self.statistics['time_per_sample'] = (t_end - t_start) / n_samples
             self.statistics['acceptance_ratio'] = (self.statistics['accepted_steps'] / n_steps)
@@ -279,7 +294,7 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
         for s in sample:
             s.everything_changed()
 
-    def step(self, sample, c):
+    def step(self, sample, c, propose_step=None):
         """This function performs a full MH step: first, a new candidate sample is proposed
         for either the zones or the weights, then the candidate is evaluated against the current sample
         and accepted with metropolis hastings acceptance probability
@@ -287,32 +302,47 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
         Args:
             sample(Sample): A Sample object consisting of zones and weights
             c(int): the current chain
+            propose_step(callable): the operator to use (chosen randomly if None)
         Returns:
             Sample: A Sample object consisting of zones and weights"""
 
         # Randomly choose one operator to propose new sample (grow/shrink/swap zones, alter weights/p_zones/p_families)
-        propose_step = _np.random.choice(self.fn_operators, 1, p=self.p_operators)[0]
+        if propose_step is None:
+            propose_step = _np.random.choice(self.fn_operators, 1, p=self.p_operators)[0]
+        operator_name = propose_step.__name__
+        t_start = _time.perf_counter()
 
         if self.IS_WARMUP:
             candidate, log_q, log_q_back = propose_step(sample, c=c)
         else:
             candidate, log_q, log_q_back = propose_step(sample)
+        t_proposal = _time.perf_counter()
 
         # Compute the log-likelihood of the candidate
         ll_candidate = self.likelihood(candidate, c)
+        t_likelihood = _time.perf_counter()
 
         # Compute the prior of the candidate
         prior_candidate = self.prior(candidate, c)
+        t_prior = _time.perf_counter()
+
+        # Keep track of the time spent in each phase of the step
+        self.statistics['time_proposal'][operator_name] += t_proposal - t_start
+        self.statistics['time_likelihood'][operator_name] += t_likelihood - t_proposal
+        self.statistics['time_prior'][operator_name] += t_prior - t_likelihood
 
         # Evaluate the metropolis-hastings ratio
         if log_q_back == -_np.inf:
             accept = False
+            p_accept = 0.
         elif log_q == -_np.inf:
             accept = True
+            p_accept = 1.
         else:
             mh_ratio = self.metropolis_hastings_ratio(ll_new=ll_candidate, ll_prev=self._ll[c],
                                                       prior_new=prior_candidate, prior_prev=self._prior[c],
                                                       log_q=log_q, log_q_back=log_q_back)
+            p_accept = _math.exp(min(mh_ratio, 0.))
 
             # Accept/reject according to MH-ratio and update
             accept = _math.log(_random.random()) < mh_ratio
@@ -322,12 +352,89 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
             self._ll[c] = ll_candidate
             self._prior[c] = prior_candidate
             self.statistics['accepted_steps'] += 1
-            self.statistics['accept_operator'][propose_step.__name__] += 1
+            self.statistics['accept_operator'][operator_name] += 1
         else:
-            self.statistics['reject_operator'][propose_step.__name__] += 1
+            self.statistics['reject_operator'][operator_name] += 1
+
+        self.adapt_proposal(operator_name, p_accept)
 
         return sample
 
+    def step_batch(self, samples):
+        """Perform one MCMC step in all chains, using the same operator. If the operator has a
+        batched version (a method called <operator>_batch), the candidates of all chains are
+        proposed and evaluated in one go and accepted/rejected as a vector. Otherwise the step is
+        performed for each chain separately.
+
+        Args:
+            samples (list): The current sample of each chain.
+        Returns:
+            list: The samples of each chain after the step.
+        """
+        propose_step = _np.random.choice(self.fn_operators, 1, p=self.p_operators)[0]
+        operator_name = propose_step.__name__
+
+        propose_batch = getattr(self, operator_name + '_batch', None)
+        if propose_batch is None:
+            return [self.step(samples[c], c, propose_step=propose_step) for c in self.chain_idx]
+
+        t_start = _time.perf_counter()
+        candidates, log_q, log_q_back, changed_features = propose_batch(samples)
+        t_proposal = _time.perf_counter()
+
+        # Compute the log-likelihood of the candidates of all chains
+        if self.sample_from_prior:
+            ll_candidates = _np.zeros(self.n_chains)
+        else:
+            ll_candidates = self.likelihood_batch(samples, candidates, changed_features)
+        t_likelihood = _time.perf_counter()
+
+        # Compute the prior of the candidates
+        prior_candidates = _np.array([self.prior(candidates[c], c) for c in self.chain_idx])
+        t_prior = _time.perf_counter()
+
+        self.statistics['time_proposal'][operator_name] += t_proposal - t_start
+        self.statistics['time_likelihood'][operator_name] += t_likelihood - t_proposal
+        self.statistics['time_prior'][operator_name] += t_prior - t_likelihood
+
+        # Evaluate the metropolis-hastings ratio for all chains
+        with _np.errstate(invalid='ignore'):
+            mh_ratio = self.metropolis_hastings_ratio(ll_new=ll_candidates, ll_prev=self._ll,
+                                                      prior_new=prior_candidates, prior_prev=self._prior,
+                                                      log_q=log_q, log_q_back=log_q_back)
+        mh_ratio = _np.where(log_q_back == -_np.inf, -_np.inf,
+                             _np.where(log_q == -_np.inf, 0., mh_ratio))
+
+        # Accept/reject all chains according to the MH-ratio and update
+        p_accept = _np.exp(_np.minimum(mh_ratio, 0.))
+        accept = _np.log(_np.random.random(self.n_chains)) < mh_ratio
+
+        for c in self.chain_idx:
+            if accept[c]:
+                samples[c] = candidates[c]
+                self._ll[c] = ll_candidates[c]
+                self._prior[c] = prior_candidates[c]
+
+            self.last_proposal = self.last_proposal_batch[c]
+            self.adapt_proposal(operator_name, p_accept[c])
+
+        n_accepted = int(_np.sum(accept))
+        self.statistics['accepted_steps'] += n_accepted
+        self.statistics['accept_operator'][operator_name] += n_accepted
+        self.statistics['reject_operator'][operator_name] += self.n_chains - n_accepted
+
+        return samples
+
+    def adapt_proposal(self, operator_name, p_accept):
+        """Hook for adapting the proposal distribution after each step (e.g. in the warm-up).
+        The base-class does not adapt anything.
+
+        Args:
+            operator_name (str): the name of the operator used in the last step.
+            p_accept (float): the acceptance probability of the last step.
+        """
+        pass
+
     @staticmethod
     def metropolis_hastings_ratio(ll_new, ll_prev, prior_new, prior_prev, log_q, log_q_back, temperature=1.):
         """ Computes the metropolis-hastings ratio.
@@ -389,6 +496,117 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
         print(i_step_str + likelihood_str + time_str)
         # print('size0 =', 'sum(sample[self.chain_idx[0]].zones[0]))
 
+    def get_cache_usage(self):
+        """Collect how often the cached likelihood and prior components could be reused,
+        summed over all chains.
+
+        Returns:
+            dict: Number of calls and cache hits per component of the likelihood and the prior.
+        """
+        cache_usage = {'likelihood': {}, 'prior': {}}
+        for posterior in self.posterior_per_chain:
+            for part, evaluator in [('likelihood', posterior.likelihood),
+                                    ('prior', posterior.prior)]:
+                for component, n_calls in evaluator.cache_calls.items():
+                    usage = cache_usage[part].setdefault(component, {'calls': 0, 'hits': 0})
+                    usage['calls'] += n_calls
+                    usage['hits'] += evaluator.cache_hits[component]
+
+        for part in cache_usage.values():
+            for usage in part.values():
+                usage['hit_rate'] = usage['hits'] / usage['calls'] if usage['calls'] > 0 else None
+
+        return cache_usage
+
+    def get_operator_statistics(self, samples):
+        """Summarize acceptance, run time and cache usage of all operators in a dictionary.
+
+        Args:
+            samples (dict): The statistics of the sampling run (see self.statistics).
+        Returns:
+            dict: The operator statistics (can be written to a JSON file).
+        """
+        operator_stats = {}
+        for operator in self.fn_operators:
+            name = operator.__name__
+            acc = samples['accept_operator'][name]
+            rej = samples['reject_operator'][name]
+            total = acc + rej
+            time_proposal = samples['time_proposal'][name]
+            time_likelihood = samples['time_likelihood'][name]
+            time_prior = samples['time_prior'][name]
+            time_total = time_proposal + time_likelihood + time_prior
+
+            operator_stats[name] = {
+                'accepts': acc,
+                'rejects': rej,
+                'total': total,
+                'acceptance_rate': acc / total if total > 0 else None,
+                'time_proposal': time_proposal,
+                'time_likelihood': time_likelihood,
+                'time_prior': time_prior,
+                'time_total': time_total,
+                'time_per_step': time_total / total if total > 0 else None
+            }
+
+        return {'operators': operator_stats,
+                'cache_usage': samples['cache_usage'],
+                'acceptance_ratio': samples.get('acceptance_ratio'),
+                'sampling_time': samples.get('sampling_time')}
+
+    @staticmethod
+    def operator_block(name):
+        """The block of parameters changed by an operator, e.g. 'area' for grow_zone or
+        'weights' for alter_weights and gibbs_sample_weights."""
+        if name.endswith('_zone') or name.startswith('gibbsish_sample_zones'):
+            return 'area'
+        return name.replace('gibbs_sample_', '').replace('alter_', '')
+
+    def tune_operator_weights(self, max_factor=4., max_acceptance_rate=0.99):
+        """Adapt the operator weights to the acceptance rate and the run time measured so far
+        (e.g. in the warm-up). The efficiency (accepted steps per second) of an operator is only
+        compared to other operators changing the same block of parameters, e.g. the area
+        operators (grow, shrink, swap) among each other. The total weight of each block stays
+        the same, since the efficiency of operators on different parameters says nothing about
+        how well the chain mixes. Gibbs operators and operators which are (almost) always
+        accepted are not rescaled. The change per operator is limited to ´max_factor´ in
+        either direction.
+
+        Args:
+            max_factor (float): maximum factor by which a weight is increased or decreased.
+            max_acceptance_rate (float): operators with a higher acceptance rate are not rescaled.
+        Returns:
+            dict: the tuned weights (values) for each operator (keys), summing to one.
+        """
+        operator_stats = self.get_operator_statistics(self.statistics)['operators']
+        weights = {op.__name__: p for op, p in zip(self.fn_operators, self.p_operators)}
+
+        # Efficiency of each MH operator that was used, grouped by block
+        efficiency = defaultdict(dict)
+        for name, p in weights.items():
+            stats = operator_stats[name]
+            if p == 0 or stats['total'] == 0 or not stats['time_per_step']:
+                continue
+            if name.startswith('gibbs_sample_') or stats['acceptance_rate'] > max_acceptance_rate:
+                continue
+            efficiency[self.operator_block(name)][name] = stats['acceptance_rate'] / stats['time_per_step']
+
+        # Rescale the operators within each block, keeping the total weight of the block
+        for block_efficiency in efficiency.values():
+            mean_efficiency = _np.mean(list(block_efficiency.values()))
+            if len(block_efficiency) < 2 or mean_efficiency == 0:
+                continue
+
+            block_weight = sum(weights[name] for name in block_efficiency)
+            for name, eff in block_efficiency.items():
+                weights[name] *= _np.clip(eff / mean_efficiency, 1 / max_factor, max_factor)
+            scale = block_weight / sum(weights[name] for name in block_efficiency)
+            for name in block_efficiency:
+                weights[name] *= scale
+
+        total = sum(weights.values())
+        return {name: w / total for name, w in weights.items()}
+
     def print_statistics(self, samples):
         self.logger.info("\n")
         self.logger.info("MCMC STATISTICS")
@@ -397,9 +615,31 @@ class MCMCGenerative(metaclass=_abc.ABCMeta):
         for operator in self.fn_operators:
             self.logger.info(log_operator_statistics(operator.__name__, samples))
 
+        self.logger.info("\n")
+        self.logger.info(log_operator_timing_header())
+        for operator in self.fn_operators:
+            self.logger.info(log_operator_timing(operator.__name__, samples))
+
+        self.logger.info("\n")
+        self.logger.info(log_cache_usage_header())
+        for part, cache_usage in samples['cache_usage'].items():
+            for component, usage in cache_usage.items():
+                self.logger.info(log_cache_usage(f'{part}: {component}', usage))
+
+    def write_statistics(self, samples, path):
+        """Write the operator statistics of the sampling run to a JSON file.
+
+        Args:
+            samples (dict): The statistics of the sampling run (see self.statistics).
+            path (Path): The path of the JSON file.
+        """
+        with open(path, 'w') as stats_file:
+            _json.dump(self.get_operator_statistics(samples), stats_file, indent=4)
+
 
 COL_WIDTHS = [20, 8, 8, 8, 10]
 
+
 def log_operator_statistics_header():
     name_header = str.ljust('OPERATOR', COL_WIDTHS[0])
     acc_header = str.ljust('ACCEPTS', COL_WIDTHS[1])
@@ -426,3 +666,53 @@ def log_operator_statistics(operator_name, mcmc_stats):
     acc_rate_str = '%.2f%%' % (100*acc/total)
 
     return '\t'.join([name_str, acc_str, rej_str, total_str, acc_rate_str])
+
+
+TIMING_COL_WIDTHS = [20, 10, 10, 10, 10]
+
+
+def log_operator_timing_header():
+    headers = ['OPERATOR', 'TIME [s]', 'PROPOSAL', 'LH', 'PRIOR', 'MS / STEP']
+    widths = TIMING_COL_WIDTHS + [0]
+    return '\t'.join([str.ljust(h, widths[i]) for i, h in enumerate(headers)])
+
+
+def log_operator_timing(operator_name, mcmc_stats):
+    total = (mcmc_stats['accept_operator'][operator_name]
+             + mcmc_stats['reject_operator'][operator_name])
+
+    if total == 0:
+        row_strings = [operator_name, '-', '-', '-', '-', '-']
+        return '\t'.join([str.ljust(x, (TIMING_COL_WIDTHS + [0])[i]) for i, x in enumerate(row_strings)])
+
+    time_proposal = mcmc_stats['time_proposal'][operator_name]
+    time_likelihood = mcmc_stats['time_likelihood'][operator_name]
+    time_prior = mcmc_stats['time_prior'][operator_name]
+    time_total = time_proposal + time_likelihood + time_prior
+
+    # The time of each phase is shown as a percentage of the total time of the operator
+    def fraction_str(t):
+        return '%.1f%%' % (100 * t / time_total) if time_total > 0 else '-'
+
+    row_strings = [operator_name,
+                   '%.2f' % time_total,
+                   fraction_str(time_proposal),
+                   fraction_str(time_likelihood),
+                   fraction_str(time_prior)]
+    row = [str.ljust(x, TIMING_COL_WIDTHS[i]) for i, x in enumerate(row_strings)]
+    row.append('%.3f' % (1000 * time_total / total))
+
+    return '\t'.join(row)
+
+
+def log_cache_usage_header():
+    return '\t'.join([str.ljust('COMPONENT', 24), str.ljust('CALLS', 10), 'HIT RATE'])
+
+
+def log_cache_usage(component_name, usage):
+    if usage['calls'] == 0:
+        hit_rate_str = '-'
+    else:
+        hit_rate_str = '%.2f%%' % (100 * usage['hit_rate'])
+
+    return '\t'.join([str.ljust(component_name, 24), str.ljust(str(usage['calls']), 10), hit_rate_str])
@@ -6,9 +6,10 @@ from copy import deepcopy
 
 import numpy as np
 import scipy.stats as stats
+from scipy.special import gammaln, xlogy
 
 from sbayes.sampling.mcmc_generative import MCMCGenerative
-from sbayes.model import normalize_weights
+from sbayes.model import normalize_weights, compute_feature_log_likelihood_batch
 from sbayes.util import get_neighbours, normalize, dirichlet_pdf, get_max_size_list
 from sbayes.preprocessing import sample_categorical
 
@@ -128,6 +129,7 @@ class ZoneMCMC(MCMCGenerative):
         self.features = self.data.features
         self.applicable_states = self.data.states
         self.n_states_by_feature = np.sum(self.data.states, axis=-1)
+        self.na_features = self.model.likelihood.na_features
 
         # Network
         self.network = self.data.network
@@ -161,14 +163,17 @@ class ZoneMCMC(MCMCGenerative):
             self.n_families = None
             self.n_sources = 2
 
-        # Variance of the proposal distribution
-        self.var_proposal_weight = var_proposal['weights']
-        self.var_proposal_p_global = var_proposal['universal']
-        self.var_proposal_p_zones = var_proposal['contact']
-        try:
-            self.var_proposal_p_families = var_proposal['inheritance']
-        except KeyError:
-            pass
+        # Variance of the proposal distribution (one precision value per feature)
+        self.var_proposal_weight = self.precision_per_feature(var_proposal['weights'])
+        self.var_proposal_p_global = self.precision_per_feature(var_proposal['universal'])
+        self.var_proposal_p_zones = self.precision_per_feature(var_proposal['contact'])
+        if self.inheritance:
+            self.var_proposal_p_families = self.precision_per_feature(var_proposal['inheritance'])
+        else:
+            self.var_proposal_p_families = None
+
+        # The parameter block and feature changed in the last Dirichlet proposal
+        self.last_proposal = None
 
         # todo remove after testing
         self.q_areas_stats = {'q_grow': [],
@@ -177,6 +182,26 @@ class ZoneMCMC(MCMCGenerative):
                               'q_back_shrink': []
                               }
 
+    def precision_per_feature(self, precision):
+        """Expand the precision of a proposal distribution to one value per feature.
+
+        Args:
+            precision (float or np.array): a single precision value or one value per feature.
+        Returns:
+            np.array: the precision for each feature.
+                shape: (n_features,)
+        """
+        return np.array(np.broadcast_to(precision, (self.n_features,)), dtype=float)
+
+    def get_proposal_precision(self):
+        """Return the (possibly tuned) precision of the Dirichlet proposals, in the same format
+        as the PROPOSAL_PRECISION config."""
+        return {'weights': self.var_proposal_weight.copy(),
+                'universal': self.var_proposal_p_global.copy(),
+                'contact': self.var_proposal_p_zones.copy(),
+                'inheritance': (None if self.var_proposal_p_families is None
+                                else self.var_proposal_p_families.copy())}
+
     def gibbs_sample_sources(self, sample: Sample, as_gibbs=True,
                              site_subset=slice(None)):
         """Resample the of observations to mixture components (their source).
@@ -429,7 +454,7 @@ class ZoneMCMC(MCMCGenerative):
             weights_current_t = weights_current / weights_current.sum()
 
             # Propose new sample
-            weights_new_t, log_q, log_q_back = self.dirichlet_proposal(weights_current_t, self.var_proposal_weight)
+            weights_new_t, log_q, log_q_back = self.dirichlet_proposal(weights_current_t, self.var_proposal_weight[f_id])
 
             # Transform back
             weights_new = weights_new_t * weights_current.sum()
@@ -440,9 +465,11 @@ class ZoneMCMC(MCMCGenerative):
         else:
             # if inheritance is not considered, there are only two weights.
             weights_current = sample.weights[f_id, :]
-            weights_new, log_q, log_q_back = self.dirichlet_proposal(weights_current, self.var_proposal_weight)
+            weights_new, log_q, log_q_back = self.dirichlet_proposal(weights_current, self.var_proposal_weight[f_id])
             sample_new.weights[f_id, :] = weights_new
 
+        self.last_proposal = ('weights', f_id)
+
         # The step changed the weights (which has an influence on how the lh and the prior look like)
         sample_new.what_changed['lh']['weights'] = True
         sample_new.what_changed['prior']['weights'] = True
@@ -476,7 +503,8 @@ class ZoneMCMC(MCMCGenerative):
         p_current_t = p_current / p_current.sum()
 
         # Propose new sample
-        p_new_t, log_q, log_q_back = self.dirichlet_proposal(p_current_t, step_precision=self.var_proposal_p_global)
+        p_new_t, log_q, log_q_back = self.dirichlet_proposal(p_current_t, step_precision=self.var_proposal_p_global[f_id])
+        self.last_proposal = ('universal', f_id)
 
         # Transform back
         p_new = p_new_t * p_current.sum()
@@ -518,7 +546,8 @@ class ZoneMCMC(MCMCGenerative):
         p_current_t = p_current / p_current.sum()
 
         # Sample new p from dirichlet distribution with given precision
-        p_new_t, log_q, log_q_back = self.dirichlet_proposal(p_current_t, step_precision=self.var_proposal_p_zones)
+        p_new_t, log_q, log_q_back = self.dirichlet_proposal(p_current_t, step_precision=self.var_proposal_p_zones[f_id])
+        self.last_proposal = ('contact', f_id)
 
         # Transform back
         p_new = p_new_t * p_current.sum()
@@ -568,6 +597,237 @@ class ZoneMCMC(MCMCGenerative):
 
         return w_new, np.log(q), np.log(q_back)
 
+    @staticmethod
+    def dirichlet_proposal_batch(w, step_precision):
+        """A batched version of the dirichlet_proposal, proposing new weight vectors for a
+        batch of samples (e.g. one per chain) at once.
+
+        Args:
+            w (np.array): The weight vectors, which are being resampled.
+                shape: (n_batch, n_categories)
+            step_precision (np.array): The precision of the proposal distribution for each sample.
+                shape: (n_batch,)
+
+        Returns:
+            np.array: The newly proposed weights w_new (same shape as w).
+            np.array: The log transition probabilities q.
+            np.array: The log back probabilities q_back.
+        """
+        alpha = 1 + step_precision[:, np.newaxis] * w
+        w_new = np.random.gamma(alpha)
+        w_new /= np.sum(w_new, axis=-1, keepdims=True)
+
+        alpha_back = 1 + step_precision[:, np.newaxis] * w_new
+
+        def dirichlet_logpdf_batch(x, a):
+            return gammaln(np.sum(a, axis=-1)) - np.sum(gammaln(a), axis=-1) + np.sum(xlogy(a - 1, x), axis=-1)
+
+        log_q = dirichlet_logpdf_batch(w_new, alpha)
+        log_q_back = dirichlet_logpdf_batch(w, alpha_back)
+
+        # Numerically degenerate proposals are rejected
+        invalid = ~np.all(np.isfinite(w_new), axis=-1) | ~np.isfinite(log_q)
+        log_q_back[invalid] = -np.inf
+
+        return w_new, log_q, log_q_back
+
+    def random_state_pairs(self, f_ids):
+        """Randomly choose two distinct applicable states for each of the given features.
+
+        Args:
+            f_ids (np.array): The feature index for each sample in the batch.
+                shape: (n_batch,)
+        Returns:
+            np.array: The two states for each sample.
+                shape: (n_batch, 2)
+        """
+        # Random keys for all states, non-applicable states are never among the two smallest
+        keys = np.random.random((len(f_ids), self.applicable_states.shape[-1]))
+        keys[~self.applicable_states[f_ids]] = 2.
+        return np.argsort(keys, axis=-1)[:, :2]
+
+    def alter_weights_batch(self, samples):
+        """Batched version of alter_weights: modifies one weight of one feature in the current
+        sample of every chain.
+
+        Args:
+            samples (list): The current sample of each chain.
+        Returns:
+            list: The candidate of each chain.
+            np.array: The log transition probabilities.
+            np.array: The log back probabilities.
+            np.array: The feature changed in each candidate.
+        """
+        n_batch = len(samples)
+        f_ids = np.random.randint(self.n_features, size=n_batch)
+
+        if self.inheritance:
+            # Randomly choose two weights that will be changed, leave the others untouched
+            weights_to_alter = np.argsort(np.random.random((n_batch, 3)), axis=-1)[:, :2]
+        else:
+            weights_to_alter = np.tile([0, 1], (n_batch, 1))
+
+        weights_current = np.array([s.weights[f, w] for s, f, w in zip(samples, f_ids, weights_to_alter)])
+        weights_sum = np.sum(weights_current, axis=-1, keepdims=True)
+
+        # Propose new weights for all chains
+        weights_new_t, log_q, log_q_back = self.dirichlet_proposal_batch(weights_current / weights_sum,
+                                                                         self.var_proposal_weight[f_ids])
+        weights_new = weights_new_t * weights_sum
+
+        candidates = []
+        for i, sample in enumerate(samples):
+            candidate = sample.copy()
+            candidate.weights[f_ids[i], weights_to_alter[i]] = weights_new[i]
+
+            for s in (sample, candidate):
+                s.what_changed['lh']['weights'] = True
+                s.what_changed['prior']['weights'] = True
+            candidates.append(candidate)
+
+        self.last_proposal_batch = [('weights', f) for f in f_ids]
+        return candidates, log_q, log_q_back, f_ids[:, np.newaxis]
+
+    def alter_p_global_batch(self, samples):
+        """Batched version of alter_p_global: modifies p_global of two states in one feature
+        in the current sample of every chain.
+
+        Args:
+            samples (list): The current sample of each chain.
+        Returns:
+            list: The candidate of each chain.
+            np.array: The log transition probabilities.
+            np.array: The log back probabilities.
+            np.array: The feature changed in each candidate.
+        """
+        n_batch = len(samples)
+        f_ids = np.random.randint(self.n_features, size=n_batch)
+        states_to_alter = self.random_state_pairs(f_ids)
+
+        p_current = np.array([s.p_global[0, f, states] for s, f, states in zip(samples, f_ids, states_to_alter)])
+        p_sum = np.sum(p_current, axis=-1, keepdims=True)
+
+        # Propose new probabilities for all chains
+        p_new_t, log_q, log_q_back = self.dirichlet_proposal_batch(p_current / p_sum,
+                                                                   self.var_proposal_p_global[f_ids])
+        p_new = p_new_t * p_sum
+
+        candidates = []
+        for i, sample in enumerate(samples):
+            candidate = sample.copy()
+            candidate.p_global[0, f_ids[i], states_to_alter[i]] = p_new[i]
+
+            for s in (sample, candidate):
+                s.what_changed['lh']['p_global'].add(f_ids[i])
+                s.what_changed['prior']['p_global'].add(f_ids[i])
+            candidates.append(candidate)
+
+        self.last_proposal_batch = [('universal', f) for f in f_ids]
+        return candidates, log_q, log_q_back, f_ids[:, np.newaxis]
+
+    def gibbs_sample_p_global_batch(self, samples, fraction_of_features=0.4):
+        """Batched version of gibbs_sample_p_global: resamples p_global of a random subset of
+        features in the current sample of every chain.
+
+        Args:
+            samples (list): The current sample of each chain.
+            fraction_of_features (float): The expected fraction of features to resample.
+        Returns:
+            list: The candidate of each chain.
+            np.array: The log transition probabilities.
+            np.array: The log back probabilities.
+            np.array: The features changed in each candidate, padded with unchanged features to
+                the same number in all candidates.
+        """
+        n_batch = len(samples)
+        feature_subset = np.random.random((n_batch, self.n_features)) < fraction_of_features
+
+        # Count the observations that are attributed to the global distribution in each chain
+        from_global = np.array([s.source[:, :, 0] for s in samples])
+        feature_counts = np.einsum('bsf,sfk->bfk', from_global, np.nan_to_num(self.features))
+
+        # Get the prior (pseudo-)counts from the data
+        prior_counts = self.posterior_per_chain[0].prior.prior_p_global.counts
+
+        # Resample p_global of all chains and features according to these observations
+        p_new = np.random.gamma(prior_counts[np.newaxis] + feature_counts) * self.applicable_states
+        p_new /= np.sum(p_new, axis=-1, keepdims=True)
+
+        candidates = []
+        for i, sample in enumerate(samples):
+            candidate = sample.copy()
+            f_resample = np.flatnonzero(feature_subset[i])
+            for f in f_resample:
+                s_idxs = self.applicable_states[f]
+                candidate.p_global[0, f, s_idxs] = p_new[i, f, s_idxs]
+
+                candidate.what_changed['lh']['p_global'].add(f)
+                candidate.what_changed['prior']['p_global'].add(f)
+            candidates.append(candidate)
+
+        self.last_proposal_batch = [None] * n_batch
+
+        # The resampled features of each chain first, followed by unchanged features (their
+        # likelihood does not change), up to the largest number of resampled features
+        n_changed = max(np.max(np.sum(feature_subset, axis=-1)), 1)
+        changed_features = np.argsort(~feature_subset, axis=-1, kind='stable')[:, :n_changed]
+        return candidates, np.full(n_batch, self.Q_GIBBS), np.full(n_batch, self.Q_BACK_GIBBS), changed_features
+
+    def feature_log_likelihood_batch(self, samples, changed_features):
+        """Compute the log-likelihood of the given features in a batch of samples.
+
+        Args:
+            samples (list): The samples (one per chain).
+            changed_features (np.array): The features to evaluate in each sample.
+                shape: (n_batch, n_changed_features)
+        Returns:
+            np.array: The log-likelihood of the features in each sample.
+                shape: (n_batch, n_changed_features)
+        """
+        batch_idx = np.arange(len(samples))[:, np.newaxis]
+
+        features = self.features[:, changed_features, :].transpose((1, 2, 0, 3))
+        na_features = self.na_features[:, changed_features].transpose((1, 2, 0))
+        zones = np.array([s.zones for s in samples])
+        weights = np.array([s.weights for s in samples])[batch_idx, changed_features]
+        p_global = np.array([s.p_global[0] for s in samples])[batch_idx, changed_features]
+        p_zones = np.array([s.p_zones for s in samples])[batch_idx, :, changed_features]
+
+        if self.inheritance:
+            p_families = np.array([s.p_families for s in samples])[batch_idx, :, changed_features]
+        else:
+            p_families = None
+
+        if self.model.sample_source:
+            source = np.array([s.source for s in samples])[batch_idx, :, changed_features]
+        else:
+            source = None
+
+        return compute_feature_log_likelihood_batch(features=features, na_features=na_features,
+                                                    families=self.families, zones=zones, weights=weights,
+                                                    p_global=p_global, p_zones=p_zones,
+                                                    p_families=p_families, source=source)
+
+    def likelihood_batch(self, samples, candidates, changed_features):
+        """Compute the (log) likelihood of the candidates of all chains in one batch. Only the
+        changed features are evaluated, the rest of the likelihood is taken from the current samples.
+
+        Args:
+            samples (list): The current sample of each chain.
+            candidates (list): The proposed candidate of each chain.
+            changed_features (np.array): The features changed in the candidate of each chain.
+                shape: (n_chains, n_changed_features)
+        Returns:
+            np.array: (log)likelihood of each candidate.
+                shape: (n_chains,)
+        """
+        ll_current = self.feature_log_likelihood_batch(samples, changed_features)
+        ll_candidates = self.feature_log_likelihood_batch(candidates, changed_features)
+
+        with np.errstate(invalid='ignore'):
+            ll_diff = np.where(ll_candidates == ll_current, 0., ll_candidates - ll_current)
+        return self._ll + np.sum(ll_diff, axis=-1)
+
     def alter_p_families(self, sample):
         """This function modifies one p_families of one category, one feature and one family in the current sample
             Args:
@@ -595,7 +855,8 @@ class ZoneMCMC(MCMCGenerative):
         p_current_t = p_current / p_current.sum()
 
         # Sample new p from dirichlet distribution with given precision
-        p_new_t, log_q, log_q_back = self.dirichlet_proposal(p_current_t, step_precision=self.var_proposal_p_families)
+        p_new_t, log_q, log_q_back = self.dirichlet_proposal(p_current_t, step_precision=self.var_proposal_p_families[f_id])
+        self.last_proposal = ('inheritance', f_id)
 
         # Transform back
         p_new = p_new_t * p_current.sum()
@@ -1273,9 +1534,23 @@ class ZoneMCMCWarmup(ZoneMCMC):
 
     IS_WARMUP = True
 
-    def __init__(self, **kwargs):
+    TARGET_ACCEPTANCE = 0.44
+    """float: Target acceptance rate when tuning the precision of the Dirichlet proposals."""
+
+    ADAPTATION_DECAY = 0.6
+    """float: Exponent of the decaying step size in the Robbins-Monro schedule."""
+
+    MIN_PRECISION = 1.
+    MAX_PRECISION = 1E6
+
+    def __init__(self, tune_proposal_precision=False, **kwargs):
         super(ZoneMCMCWarmup, self).__init__(**kwargs)
 
+        # Tune the precision of the Dirichlet proposals (per parameter block and feature)?
+        self.tune_proposal_precision = tune_proposal_precision
+        self.n_adaptations = {block: np.zeros(self.n_features, dtype=int)
+                              for block in ['weights', 'universal', 'contact', 'inheritance']}
+
         # In warmup chains can have a different max_size for areas
         self.max_size = get_max_size_list(
             start=(self.initial_size + self.max_size)/4,
@@ -1290,6 +1565,36 @@ class ZoneMCMCWarmup(ZoneMCMC):
             k=self.n_chains
         )
 
+    def adapt_proposal(self, operator_name, p_accept):
+        """Tune the precision of the last Dirichlet proposal towards the target acceptance rate,
+        using a Robbins-Monro schedule on the log-precision.
+
+        Args:
+            operator_name (str): the name of the operator used in the last step.
+            p_accept (float): the acceptance probability of the last step.
+        """
+        if not self.tune_proposal_precision or self.last_proposal is None:
+            return
+
+        block, f_id = self.last_proposal
+        self.last_proposal = None
+        if not np.isfinite(p_accept):
+            return
+
+        precision = {'weights': self.var_proposal_weight,
+                     'universal': self.var_proposal_p_global,
+                     'contact': self.var_proposal_p_zones,
+                     'inheritance': self.var_proposal_p_families}[block]
+
+        # Decaying step size: gamma_t = (t+1)^(-decay)
+        t = self.n_adaptations[block][f_id]
+        gamma = (t + 1) ** -self.ADAPTATION_DECAY
+        self.n_adaptations[block][f_id] += 1
+
+        # Higher acceptance than the target -> wider proposal (lower precision) and vice versa
+        log_precision = np.log(precision[f_id]) - gamma * (p_accept - self.TARGET_ACCEPTANCE)
+        precision[f_id] = np.clip(np.exp(log_precision), self.MIN_PRECISION, self.MAX_PRECISION)
+
     def gibbs_sample_sources(self, sample, c=0, as_gibbs=True, site_subset=slice(None)):
         return super(ZoneMCMCWarmup, self).gibbs_sample_sources(
             sample, as_gibbs=True, site_subset=site_subset
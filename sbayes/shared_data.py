@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Shared-memory data plane for runs or chains in parallel worker processes """
+
+import atexit
+import ctypes
+from copy import copy
+
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+try:
+    from multiprocessing import shared_memory       # PYTHON >= 3.8
+except ImportError:
+    shared_memory = None                            # PYTHON < 3.8
+
+
+DATA_ARRAYS = [('features',),
+               ('na_features',),
+               ('states',),
+               ('families',),
+               ('network', 'dist_mat'),
+               ('network', 'adj_mat'),
+               ('prior_universal', 'counts'),
+               ('prior_inheritance', 'counts'),
+               ('geo_prior', 'cost_matrix')]
+'''list: Paths (attribute or dictionary keys) of the large arrays in a data object.'''
+
+
+def _get(obj, key):
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+def _set(obj, key, value):
+    if isinstance(obj, dict):
+        obj[key] = value
+    else:
+        setattr(obj, key, value)
+
+
+class _SharedBuffer:
+
+    """The base object of an array view on a shared memory block. The view keeps the block
+    (and thus the memory mapping) alive for as long as it is used."""
+
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        address = ctypes.addressof(ctypes.c_char.from_buffer(shm.buf))
+        self.__array_interface__ = {'data': (address, False),
+                                    'shape': tuple(shape),
+                                    'typestr': np.dtype(dtype).str,
+                                    'version': 3}
+
+
+def _view(shm, shape, dtype):
+    return np.asarray(_SharedBuffer(shm, shape, dtype))
+
+
+class SharedArrays:
+    """A set of numpy arrays stored in shared memory blocks. The creating process owns the
+    memory and releases it on `unlink` (at the latest on exit). The memory mapping of each
+    process stays valid as long as views on the arrays are in use. Pickling a `SharedArrays` object
+    only transfers the names of the blocks; unpickling (e.g. in a worker process) attaches
+    zero-copy views.
+
+    Attributes:
+        arrays (dict): the shared arrays (name -> np.array view on the shared memory).
+        spec (dict): name, shape and dtype of the shared memory block for each array.
+        is_owner (bool): whether this process created (and has to release) the memory.
+    """
+
+    def __init__(self, arrays):
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or higher.')
+
+        self.arrays = {}
+        self.spec = {}
+        self._blocks = []
+        self.is_owner = True
+
+        try:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                self._blocks.append(shm)
+
+                view = _view(shm, array.shape, array.dtype)
+                view[...] = array
+                self.arrays[name] = view
+                self.spec[name] = (shm.name, array.shape, array.dtype.str)
+        except BaseException:
+            self.unlink()
+            raise
+
+        # Make sure the shared memory is released when the owner exits
+        atexit.register(self.unlink)
+
+    @classmethod
+    def attach(cls, spec):
+        """Attach to shared arrays created in another process.
+
+        Args:
+            spec (dict): the `spec` of the owning SharedArrays object.
+        Returns:
+            SharedArrays: the shared arrays (not owned by this process).
+        """
+        shared = cls.__new__(cls)
+        shared.arrays = {}
+        shared.spec = spec
+        shared._blocks = []
+        shared.is_owner = False
+
+        for name, (shm_name, shape, dtype) in spec.items():
+            # Worker processes share the resource tracker of the owner, so attaching does
+            # not change when the memory is released
+            shm = shared_memory.SharedMemory(name=shm_name)
+            shared._blocks.append(shm)
+            shared.arrays[name] = _view(shm, shape, dtype)
+
+        return shared
+
+    def __reduce__(self):
+        return SharedArrays.attach, (self.spec,)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        """Detach this process from the shared memory. Blocks are unmapped once the last view
+        on them is garbage collected."""
+        self.arrays = {}
+        self._blocks = []
+
+    def unlink(self):
+        """Detach and (if this process is the owner) release the shared memory. Views which
+        are still in use remain valid, the memory is freed once all processes detached."""
+        if self.is_owner:
+            for shm in self._blocks:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.unlink()
+
+
+class SharedData:
+    """A data object (Data or Simulation) whose large arrays (features, distance matrix,
+    adjacency matrix, prior counts, geo cost matrix) are placed in shared memory once.
+    Passing a `SharedData` object to worker processes (e.g. as an argument in a
+    ProcessPoolExecutor) only pickles the small attributes; the workers attach zero-copy
+    views on the arrays.
+
+    Usage:
+        with SharedData(data) as shared:
+            pool.submit(run, shared, ...)    # the worker uses `shared.data`
+
+    Attributes:
+        data: the data object, with the large arrays replaced by views on the shared memory.
+        shared_arrays (SharedArrays): the shared memory blocks.
+    """
+
+    def __init__(self, data):
+        arrays = {}
+        self.paths = []
+        self.sparse_shapes = {}
+        for path in DATA_ARRAYS:
+            value = self._get_path(data, path)
+            if value is None:
+                continue
+            self.paths.append(path)
+
+            key = '.'.join(path)
+            if issparse(value):
+                value = value.tocsr()
+                arrays[key + '.data'] = value.data
+                arrays[key + '.indices'] = value.indices
+                arrays[key + '.indptr'] = value.indptr
+                self.sparse_shapes[key] = value.shape
+            else:
+                arrays[key] = value
+
+        self.shared_arrays = SharedArrays(arrays)
+        self.data = self.insert_arrays(data)
+
+    @staticmethod
+    def _get_path(obj, path):
+        for key in path:
+            if obj is None:
+                return None
+            obj = _get(obj, key)
+        return obj
+
+    def replace_arrays(self, data, get_value):
+        """Copy the data object, replacing all large arrays by the result of `get_value`. The
+        containers (data object, network, prior dictionaries) are copied, the rest is shared.
+
+        Args:
+            data: the data object.
+            get_value (callable): maps the path of an array to its new value.
+        Returns:
+            the copy of the data object.
+        """
+        data = copy(data)
+        copied = set()
+        for path in self.paths:
+            obj = data
+            for i, key in enumerate(path[:-1]):
+                child = _get(obj, key)
+                if path[:i+1] not in copied:
+                    child = copy(child)
+                    _set(obj, key, child)
+                    copied.add(path[:i+1])
+                obj = child
+
+            _set(obj, path[-1], get_value(path))
+        return data
+
+    def insert_arrays(self, data):
+        """Replace the large arrays in (a copy of) the data object by the shared arrays."""
+        def get_shared(path):
+            key = '.'.join(path)
+            if key in self.sparse_shapes:
+                return csr_matrix((self.shared_arrays[key + '.data'],
+                                   self.shared_arrays[key + '.indices'],
+                                   self.shared_arrays[key + '.indptr']), shape=self.sparse_shapes[key])
+            return self.shared_arrays[key]
+        return self.replace_arrays(data, get_shared)
+
+    def __getstate__(self):
+        # Only pickle the small attributes and the handles of the shared memory blocks
+        state = copy(self.__dict__)
+        state['data'] = self.replace_arrays(self.data, lambda path: None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = self.insert_arrays(self.data)
+
+    def close(self):
+        """Detach this process from the shared memory (and release it in the owning process)."""
+        self.shared_arrays.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
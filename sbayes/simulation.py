@@ -8,23 +8,25 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import logging
+import time
 import numpy as np
 
 from sbayes.preprocessing import (compute_network, read_sites,
-                                  simulate_assignment_probabilities,
+                                  simulate_assignment_probabilities_batch,
                                   assign_family,
                                   assign_area,
                                   simulate_features,
                                   simulate_weights,
                                   subset_features,
                                   counts_from_complement)
-from sbayes.util import assess_correlation_probabilities
+from sbayes.util import assess_correlation_probabilities, memmap_features
 
 
 class Simulation:
-    def __init__(self, experiment, n_correlated=10):
+    def __init__(self, experiment, n_correlated=10, n_candidates=100):
 
         self.path_log = experiment.path_results / 'experiment.log'
+        self.path_results = experiment.path_results
         self.config = experiment.config['simulation']
 
         self.sites_file = experiment.config['simulation']['SITES']
@@ -35,6 +37,7 @@ class Simulation:
         self.network = None
         self.areas = None
         self.features = None
+        self.na_features = None
         self.states = None
         self.families = None
         self.weights = None
@@ -51,6 +54,9 @@ class Simulation:
         self.family_names = None
         self.site_names = None
 
+        # Time (in seconds) spent building the network
+        self.time_network = 0.
+
         # Is a simulation
         self.is_simulated = True
 
@@ -58,6 +64,9 @@ class Simulation:
         self.corr_th = experiment.config['simulation']['CORRELATION_THRESHOLD']
         self.n_correlated = n_correlated
 
+        # Number of candidate probabilities which are simulated (and screened for correlation) at once
+        self.n_candidates = n_candidates
+
     def log_simulation(self):
         logging.basicConfig(format='%(message)s', filename=self.path_log, level=logging.DEBUG)
         logging.info("\n")
@@ -75,7 +84,12 @@ class Simulation:
         logging.info("Simulated area: %s", self.config['AREA'])
 
     def run_simulation(self):
+        self.load_sites()
+        self.simulate_parameters()
+        self.simulate_data()
 
+    def load_sites(self):
+        """Read the sites and define the network, the simulated areas and families."""
         self.inheritance = self.config['INHERITANCE']
         self.subset = self.config['SUBSET']
 
@@ -84,7 +98,9 @@ class Simulation:
                                                                       retrieve_family=self.inheritance,
                                                                       retrieve_subset=self.subset)
 
+        t_start = time.perf_counter()
         self.network = compute_network(self.sites)
+        self.time_network += time.perf_counter() - t_start
         self.areas = assign_area(area_id=self.config['AREA'], sites_sim=self.sites)
 
         # Simulate families
@@ -93,6 +109,8 @@ class Simulation:
         else:
             self.families = None
 
+    def simulate_parameters(self):
+        """Simulate the weights and the probabilities of universal pressure, contact and inheritance."""
         # Simulate weights, i.e. the influence of universal pressure, contact and inheritance on each feature
         self.weights = simulate_weights(i_universal=self.config['I_UNIVERSAL'],
                                         i_contact=self.config['I_CONTACT'],
@@ -101,25 +119,33 @@ class Simulation:
                                         n_features=self.config['N_FEATURES'])
         attempts = 0
         while True:
-            attempts += 1
-
-            # Simulate probabilities for features to be universally preferred,
+            # Simulate a batch of candidate probabilities for features to be universally preferred,
             # passed through contact (and inherited if available)
-            self.p_universal, self.p_contact, self.p_inheritance \
-                = simulate_assignment_probabilities(e_universal=self.config['E_UNIVERSAL'],
-                                                    e_contact=self.config['E_CONTACT'],
-                                                    e_inheritance=self.config['E_INHERITANCE'],
-                                                    inheritance=self.inheritance,
-                                                    n_features=self.config['N_FEATURES'],
-                                                    p_number_categories=self.config['P_N_CATEGORIES'],
-                                                    areas=self.areas, families=self.families)
-
-            correlated = assess_correlation_probabilities(self.p_universal, self.p_contact, self.p_inheritance,
+            p_universal, p_contact, p_inheritance, n_categories = \
+                simulate_assignment_probabilities_batch(n_candidates=self.n_candidates,
+                                                        e_universal=self.config['E_UNIVERSAL'],
+                                                        e_contact=self.config['E_CONTACT'],
+                                                        e_inheritance=self.config['E_INHERITANCE'],
+                                                        inheritance=self.inheritance,
+                                                        n_features=self.config['N_FEATURES'],
+                                                        p_number_categories=self.config['P_N_CATEGORIES'],
+                                                        areas=self.areas, families=self.families)
+
+            # Screen all candidates for correlation at once and use the first valid one
+            correlated = assess_correlation_probabilities(p_universal, p_contact, p_inheritance,
                                                           corr_th=self.corr_th)
-
-            if correlated <= self.n_correlated:
+            valid = np.flatnonzero(correlated <= self.n_correlated)
+
+            if len(valid) > 0:
+                i = valid[0]
+                max_categories = np.max(n_categories[i])
+                self.p_universal = p_universal[i, :, :max_categories]
+                self.p_contact = p_contact[i, :, :, :max_categories]
+                if p_inheritance is not None:
+                    self.p_inheritance = p_inheritance[i, :, :, :max_categories]
                 break
 
+            attempts += self.n_candidates
             if attempts > 10000:
                 attempts = 0
 
@@ -128,6 +154,8 @@ class Simulation:
                 print("Correlation threshold for simulation increased to", self.corr_th)
                 print("Number of allowed correlated features increased to", self.n_correlated)
 
+    def simulate_data(self):
+        """Simulate the features from the areas, families, weights and probabilities."""
         # Simulate features
         self.features, self.states, self.feature_names, self.state_names = \
             simulate_features(areas=self.areas,
@@ -147,11 +175,21 @@ class Simulation:
             self.prior_universal = {'counts': counts,
                                     'states': self.states}
 
+            t_start = time.perf_counter()
             self.network = compute_network(sites=self.sites, subset=self.sites['subset'])
+            self.time_network += time.perf_counter() - t_start
             sub_idx = np.nonzero(self.sites['subset'])[0]
             self.areas = self.areas[np.newaxis, 0, sub_idx]
             self.features = subset_features(features=self.features, subset=self.sites['subset'])
 
+        self.na_features = (np.sum(self.features, axis=-1) == 0)
+
+        # Store the features (and NA mask) in memory-mapped files, shared by all processes on the node.
+        # Simulated data is not reused by other runs, so the files are kept with the results of this run.
+        if self.config.get('FEATURES_MEMMAP', False):
+            self.features, self.na_features = memmap_features(self.features, self.na_features,
+                                                              self.path_results)
+
         geo_cost_matrix = self.network['dist_mat']
         self.geo_prior = {'cost_matrix': geo_cost_matrix}
         
\ No newline at end of file
@@ -0,0 +1,464 @@
+""" Benchmarks of the likelihood, the prior components, the MCMC operators and the
+post-processing on synthetic data.
+
+The synthetic data sets are parameterized by the number of sites, features, states, areas
+and families, so that the benchmarks do not depend on any data files and can be scaled. The
+timings are written to a JSON file, together with the git commit and the parameters, so that
+the results of two commits can be compared:
+
+    python -m sbayes.tools.benchmark --output before.json
+    (... change the code ...)
+    python -m sbayes.tools.benchmark --output after.json --compare before.json
+
+All timings are in seconds per call. `median` is robust to outliers, `min` is the best
+estimate of the cost without interference from other processes.
+
+Usage:
+    python -m sbayes.tools.benchmark --sizes small medium --repeat 50 --output benchmark.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from sbayes.preprocessing import compute_network, simulate_dirichlet, simulate_features
+from sbayes.tools.run_sweep import set_seed
+
+
+SIZES = {
+    'small': {'n_sites': 100, 'n_features': 20, 'n_states': 3, 'n_areas': 2, 'n_families': 2},
+    'medium': {'n_sites': 500, 'n_features': 50, 'n_states': 4, 'n_areas': 3, 'n_families': 5},
+    'large': {'n_sites': 2000, 'n_features': 100, 'n_states': 5, 'n_areas': 5, 'n_families': 10}
+}
+'''dict: The parameters of the predefined synthetic data sets.'''
+
+LIKELIHOOD_CHANGES = ['everything', 'zones', 'weights', 'p_global', 'p_zones', 'p_families', 'nothing']
+'''list: The kinds of changes of a sample for which the (cached) likelihood is timed.'''
+
+OPERATORS = {
+    True: ['shrink_zone', 'grow_zone', 'swap_zone', 'gibbs_sample_sources', 'gibbs_sample_weights',
+           'gibbs_sample_p_global', 'gibbs_sample_p_zones', 'gibbs_sample_p_families'],
+    False: ['shrink_zone', 'grow_zone', 'swap_zone', 'alter_weights', 'alter_p_global',
+            'alter_p_zones', 'alter_p_families']
+}
+'''dict: The operators of the sampler, with and without sampling the source.'''
+
+
+class SyntheticData:
+    """A synthetic data set with the attributes of `Data` used by the model and the sampler.
+
+    The sites are uniformly distributed in a square, the areas are the nearest neighbours of
+    random centres and the families are the Voronoi cells of random centres (about 10% of the
+    sites are isolates). The features are simulated from random weights and probabilities.
+
+    Attributes:
+        params (dict): the parameters of the data set.
+        network (compute_network): the network of the sites.
+        time_network (float): the time (in seconds) spent building the network.
+        features (np.array): the one-hot encoded features.
+            shape: (n_sites, n_features, n_states)
+        states (np.array): the applicable states of each feature.
+            shape: (n_features, n_states)
+        families (np.array): the assignment of sites to families.
+            shape: (n_families, n_sites)
+        areas (np.array): the areas from which the features were simulated.
+            shape: (n_areas, n_sites)
+    """
+
+    is_simulated = False
+
+    def __init__(self, n_sites, n_features, n_states, n_areas, n_families, seed=0):
+        self.params = {'n_sites': n_sites, 'n_features': n_features, 'n_states': n_states,
+                       'n_areas': n_areas, 'n_families': n_families, 'seed': seed}
+        set_seed(seed)
+
+        # Sites in a square of 1000 x 1000 km
+        locations = np.random.uniform(0, 1E6, size=(n_sites, 2))
+        self.sites = {'id': list(range(n_sites)),
+                      'locations': locations,
+                      'names': [f'site_{i}' for i in range(n_sites)]}
+        t_start = time.perf_counter()
+        self.network = compute_network(self.sites)
+        self.time_network = time.perf_counter() - t_start
+        self.geo_prior = {'cost_matrix': self.network['dist_mat']}
+
+        self.areas = self.simulate_areas(locations, n_areas)
+        self.families = self.simulate_families(locations, n_families)
+
+        # Weights and probabilities of universal pressure, contact and inheritance
+        n_states_per_feature = np.random.randint(2, n_states + 1, size=n_features)
+        n_states_per_feature[0] = n_states
+        applicable = np.arange(n_states) < n_states_per_feature[:, np.newaxis]
+        weights = np.random.dirichlet(np.ones(3), n_features)
+        p_universal = simulate_dirichlet(1., applicable)
+        p_contact = simulate_dirichlet(1., np.repeat(applicable[np.newaxis], n_areas, axis=0))
+        p_inheritance = simulate_dirichlet(1., np.repeat(applicable[np.newaxis], n_families, axis=0))
+
+        self.features, self.states, feature_names, state_names = simulate_features(
+            areas=self.areas, families=self.families, p_universal=p_universal,
+            p_contact=p_contact, p_inheritance=p_inheritance, weights=weights, inheritance=True)
+        self.feature_names = feature_names
+        self.state_names = state_names
+        family_names = [f'family_{i}' for i in range(n_families)]
+        self.family_names = {'external': family_names, 'internal': family_names}
+
+    @staticmethod
+    def simulate_areas(locations, n_areas):
+        """Define disjoint areas as the nearest neighbours of random centres."""
+        n_sites = len(locations)
+        area_size = max(3, n_sites // (4 * n_areas))
+        areas = np.zeros((n_areas, n_sites), dtype=bool)
+        free = np.ones(n_sites, dtype=bool)
+        for z in range(n_areas):
+            centre = locations[np.random.choice(np.flatnonzero(free))]
+            distance = np.linalg.norm(locations - centre, axis=1)
+            distance[~free] = np.inf
+            members = np.argsort(distance)[:area_size]
+            areas[z, members] = True
+            free[members] = False
+        return areas
+
+    @staticmethod
+    def simulate_families(locations, n_families, p_isolate=0.1):
+        """Assign the sites to the nearest of random family centres (or to no family)."""
+        n_sites = len(locations)
+        centres = locations[np.random.choice(n_sites, size=n_families, replace=False)]
+        distance = np.linalg.norm(locations[np.newaxis] - centres[:, np.newaxis], axis=-1)
+        families = np.zeros((n_families, n_sites), dtype=bool)
+        families[np.argmin(distance, axis=0), np.arange(n_sites)] = True
+        families[:, np.random.random(n_sites) < p_isolate] = False
+        return families
+
+
+def benchmark_config(data, inheritance=True, sample_source=True, geo_prior='cost_based'):
+    """Define a model and MCMC config (as after Experiment.load_config) for a synthetic data set."""
+    n_sites = data.params['n_sites']
+    geo = {'type': 'uniform'} if geo_prior == 'uniform' else {'type': 'cost_based', 'scale': 100000}
+    return {
+        'model': {
+            'N_AREAS': data.params['n_areas'],
+            'MIN_M': 3,
+            'MAX_M': max(10, n_sites // 2),
+            'INHERITANCE': inheritance,
+            'SAMPLE_SOURCE': sample_source,
+            'PRIOR': {'geo': geo,
+                      'area_size': {'type': 'none'},
+                      'weights': {'type': 'uniform'},
+                      'universal': {'type': 'uniform'},
+                      'contact': {'type': 'uniform'},
+                      'inheritance': {'type': 'uniform'}}
+        },
+        'mcmc': {
+            'N_STEPS': 1000,
+            'N_SAMPLES': 100,
+            'N_CHAINS': 1,
+            'P_GROW_CONNECTED': 0.85,
+            'PROPOSAL_PRECISION': {'weights': 15, 'universal': 40, 'contact': 20, 'inheritance': 20},
+            'M_INITIAL': 5
+        }
+    }
+
+
+def init_sampler(data, config):
+    """Build the model and a single-chain sampler, with operators according to the model."""
+    from sbayes.model import Model
+    from sbayes.sampling.zone_sampling import ZoneMCMC
+
+    model = Model(data=data, config=config['model'])
+    operators = OPERATORS[model.sample_source]
+    if not model.inheritance:
+        operators = [op for op in operators if 'families' not in op]
+
+    sampler = ZoneMCMC(data=data, model=model, n_chains=1,
+                       operators={op: 1. / len(operators) for op in operators},
+                       var_proposal=config['mcmc']['PROPOSAL_PRECISION'],
+                       p_grow_connected=config['mcmc']['P_GROW_CONNECTED'],
+                       initial_size=config['mcmc']['M_INITIAL'])
+    return model, sampler
+
+
+def time_call(fn, setup=None, n_repeat=20):
+    """Time a function (without its setup) and summarize the time per call.
+
+    Args:
+        fn (callable): the function to time.
+        setup (callable): a function called (untimed) before each call of `fn`.
+        n_repeat (int): the number of calls.
+    Returns:
+        dict: the median, min and mean time per call and the number of calls.
+    """
+    times = np.empty(n_repeat)
+    for i in range(n_repeat):
+        if setup is not None:
+            setup()
+        t_start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - t_start
+    return {'median': float(np.median(times)), 'min': float(np.min(times)),
+            'mean': float(np.mean(times)), 'n': n_repeat}
+
+
+def quiet(fn):
+    """Wrap a function to suppress its output to stdout."""
+    def fn_quiet(*args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn(*args, **kwargs)
+    return fn_quiet
+
+
+def mark_changed(sample, change):
+    """Mark a single parameter of a sample as changed, as the operators do."""
+    sample.everything_changed()
+    lh_changed = sample.what_changed['lh']
+    for key in ['zones', 'p_global', 'p_zones', 'p_families']:
+        lh_changed[key].clear()
+    lh_changed['weights'] = False
+
+    if change == 'everything':
+        sample.everything_changed()
+    elif change == 'weights':
+        lh_changed['weights'] = True
+    elif change in ['zones', 'p_global']:
+        lh_changed[change].add(0)
+    elif change in ['p_zones', 'p_families']:
+        lh_changed[change].add((0, 0))
+
+
+def benchmark_likelihood(model, sample, n_repeat=20):
+    """Time the likelihood without caching and with caching, after each kind of change."""
+    likelihood = model.likelihood
+    results = {'uncached': time_call(lambda: likelihood(sample, caching=False),
+                                     setup=sample.everything_changed, n_repeat=n_repeat)}
+
+    for change in LIKELIHOOD_CHANGES:
+        if change == 'p_families' and not model.inheritance:
+            continue
+        results[change] = time_call(lambda: likelihood(sample),
+                                    setup=lambda: mark_changed(sample, change),
+                                    n_repeat=n_repeat)
+    return results
+
+
+def benchmark_prior(model, sample, n_repeat=20):
+    """Time each component of the prior (recomputed from scratch) and the complete prior."""
+    prior = model.prior
+    components = {'size': prior.size_prior, 'geo': prior.geo_prior, 'weights': prior.prior_weights,
+                  'p_global': prior.prior_p_global, 'p_zones': prior.prior_p_zones}
+    if model.inheritance:
+        components['p_families'] = prior.prior_p_families
+
+    results = {name: time_call(lambda: component(sample),
+                               setup=sample.everything_changed, n_repeat=n_repeat)
+               for name, component in components.items()}
+    results['total'] = time_call(lambda: prior(sample), setup=sample.everything_changed,
+                                 n_repeat=n_repeat)
+    return results
+
+
+def benchmark_operators(sampler, sample, n_steps=100):
+    """Time the MH steps of each operator: proposal, likelihood, prior and the total step."""
+    results = {}
+    for name in [f.__name__ for f in sampler.fn_operators]:
+        operator = getattr(sampler, name)
+
+        # Start each operator from the same sample (and cached likelihood and prior)
+        s = sample.copy()
+        s.everything_changed()
+        sampler._ll[0] = sampler.likelihood(s, 0)
+        sampler._prior[0] = sampler.prior(s, 0)
+        for key in ['time_proposal', 'time_likelihood', 'time_prior']:
+            sampler.statistics[key][name] = 0.
+
+        t_start = time.perf_counter()
+        for _ in range(n_steps):
+            s = sampler.step(s, 0, propose_step=operator)
+        t_total = time.perf_counter() - t_start
+
+        results[name] = {'proposal': sampler.statistics['time_proposal'][name] / n_steps,
+                         'likelihood': sampler.statistics['time_likelihood'][name] / n_steps,
+                         'prior': sampler.statistics['time_prior'][name] / n_steps,
+                         'step': t_total / n_steps,
+                         'n': n_steps}
+    return results
+
+
+def benchmark_postprocessing(sampler, data, config, n_samples=100, n_repeat=5):
+    """Time Sample.copy, the contribution of each area, match_areas and samples2file."""
+    from sbayes.postprocessing import contribution_per_area, match_areas
+    from sbayes.util import samples2file
+
+    sample = sampler.generate_initial_sample()
+    results = {'sample_copy': time_call(sample.copy, n_repeat=max(n_repeat, 100))}
+
+    # A short run to collect samples
+    quiet(sampler.generate_samples)(n_steps=n_samples, n_samples=n_samples)
+    results['contribution_per_area'] = time_call(lambda: contribution_per_area(sampler), n_repeat=n_repeat)
+    samples = sampler.statistics
+
+    results['match_areas'] = time_call(lambda: quiet(match_areas)(dict(samples)), n_repeat=n_repeat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {'parameters': Path(tmp_dir) / 'stats.txt', 'areas': Path(tmp_dir) / 'areas.txt'}
+        results['samples2file'] = time_call(lambda: quiet(samples2file)(samples, data, config, paths),
+                                            n_repeat=n_repeat)
+    return results
+
+
+def run_benchmarks(params, n_repeat=20, n_steps=100, n_samples=100, seed=0,
+                   inheritance=True, sample_source=True, geo_prior='cost_based'):
+    """Run all benchmarks on one synthetic data set.
+
+    Args:
+        params (dict): the parameters of the data set (n_sites, n_features, n_states,
+            n_areas, n_families).
+        n_repeat (int): the number of calls per likelihood and prior benchmark.
+        n_steps (int): the number of MH steps per operator.
+        n_samples (int): the number of samples for the post-processing benchmarks.
+        seed (int): the seed of the data set and the sampler.
+        inheritance (bool): whether the model includes inheritance.
+        sample_source (bool): whether the sampler samples the source (Gibbs operators).
+        geo_prior (str): the type of the geo prior ('uniform' or 'cost_based').
+    Returns:
+        dict: the parameters and the timings of each group of benchmarks.
+    """
+    t_start = time.perf_counter()
+    data = SyntheticData(**params, seed=seed)
+    t_data = time.perf_counter() - t_start
+
+    config = benchmark_config(data, inheritance=inheritance, sample_source=sample_source,
+                              geo_prior=geo_prior)
+    model, sampler = init_sampler(data, config)
+
+    sample = sampler.generate_initial_sample()
+    model.likelihood(sample)
+    model.prior(sample)
+
+    return {
+        'params': {**data.params, 'inheritance': inheritance, 'sample_source': sample_source,
+                   'geo_prior': geo_prior},
+        'data': {'synthetic_data': t_data},
+        'likelihood': benchmark_likelihood(model, sample, n_repeat=n_repeat),
+        'prior': benchmark_prior(model, sample, n_repeat=n_repeat),
+        'operators': benchmark_operators(sampler, sample, n_steps=n_steps),
+        'postprocessing': benchmark_postprocessing(sampler, data, config, n_samples=n_samples)
+    }
+
+
+def get_git_commit():
+    """The current git commit of the package (None if not in a git repository)."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment_info():
+    return {'commit': get_git_commit(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor()}
+
+
+def iter_timings(results, prefix=()):
+    """Iterate over all timings in nested benchmark results: (key, timing) pairs."""
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        if 'median' in value:
+            yield prefix + (key,), value['median']
+        elif 'step' in value:
+            yield prefix + (key,), value['step']
+        else:
+            yield from iter_timings(value, prefix + (key,))
+
+
+def compare_results(new, old):
+    """Compare the (median) timings of two benchmark runs.
+
+    Returns:
+        list: (benchmark, old time, new time, ratio new/old) for all benchmarks in both runs.
+    """
+    old_timings = dict(iter_timings(old['results']))
+    rows = []
+    for key, t_new in iter_timings(new['results']):
+        if key in old_timings:
+            t_old = old_timings[key]
+            rows.append(('/'.join(key), t_old, t_new, t_new / t_old if t_old > 0 else np.nan))
+    return rows
+
+
+def print_results(results):
+    for key, t in iter_timings(results):
+        print(f'{"/".join(key):60s} {t * 1000:10.3f} ms')
+
+
+def print_comparison(rows, threshold=1.1):
+    print(f'{"benchmark":60s} {"old [ms]":>10s} {"new [ms]":>10s} {"ratio":>7s}')
+    for name, t_old, t_new, ratio in rows:
+        flag = '  slower' if ratio > threshold else ('  faster' if ratio < 1 / threshold else '')
+        print(f'{name:60s} {t_old * 1000:10.3f} {t_new * 1000:10.3f} {ratio:7.2f}{flag}')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the likelihood, prior, operators and post-processing of sBayes.')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(SIZES),
+                        help='The predefined synthetic data sets to benchmark.')
+    parser.add_argument('--n-sites', type=int, default=None,
+                        help='Benchmark a custom data set with this number of sites.')
+    parser.add_argument('--n-features', type=int, default=30)
+    parser.add_argument('--n-states', type=int, default=3)
+    parser.add_argument('--n-areas', type=int, default=2)
+    parser.add_argument('--n-families', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='The number of calls per likelihood and prior benchmark.')
+    parser.add_argument('--n-steps', type=int, default=100,
+                        help='The number of MH steps per operator.')
+    parser.add_argument('--no-inheritance', action='store_true',
+                        help='Benchmark a model without inheritance.')
+    parser.add_argument('--no-sample-source', action='store_true',
+                        help='Benchmark the operators without sampling the source.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, default=None,
+                        help='The JSON file to write the results to.')
+    parser.add_argument('--compare', type=Path, default=None,
+                        help='A JSON file with the results of a previous run to compare to.')
+    args = parser.parse_args(args)
+
+    if args.n_sites is not None:
+        data_sets = {'custom': {'n_sites': args.n_sites, 'n_features': args.n_features,
+                                'n_states': args.n_states, 'n_areas': args.n_areas,
+                                'n_families': args.n_families}}
+    else:
+        data_sets = {size: SIZES[size] for size in args.sizes}
+
+    results = {'environment': environment_info(), 'results': {}}
+    for name, params in data_sets.items():
+        print(f'Benchmarking {name} data set: {params}')
+        results['results'][name] = run_benchmarks(params, n_repeat=args.repeat, n_steps=args.n_steps,
+                                                  seed=args.seed, inheritance=not args.no_inheritance,
+                                                  sample_source=not args.no_sample_source)
+        print_results(results['results'][name])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+        print_comparison(compare_results(results, old))
+
+
+if __name__ == '__main__':
+    main()
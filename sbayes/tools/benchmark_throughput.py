@@ -0,0 +1,372 @@
+""" End-to-end throughput benchmark of sBayes.
+
+Runs short MCMC jobs with a fixed seed on the bundled experiments (Balkan, simulation) and on
+synthetic data sets scaled up in the number of sites, and reports for each job:
+
+    - the time per phase (load, network, warm-up, sample, post-process, write),
+    - the steps per second in the warm-up and in the sampling,
+    - the effective sample size (ESS) per second of the log-posterior and the weights,
+    - the peak resident set size (RSS) of the process.
+
+Optionally, scaling curves over the number of sites and the number of features are computed
+on synthetic data. Each job runs in a fresh process (so that the peak RSS is that of the job).
+The results are written to the output directory as JSON (throughput.json), as a table
+(throughput.csv) and, with --scaling, as a plot of the scaling curves (scaling.pdf).
+
+Usage:
+    python -m sbayes.tools.benchmark_throughput --scales 1 10 100 --scaling --output benchmark_results
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+
+from sbayes.tools.benchmark import SyntheticData, benchmark_config, environment_info, quiet
+from sbayes.tools.run_sweep import set_seed
+
+
+EXPERIMENTS_DIR = Path(__file__).resolve().parents[2] / 'experiments'
+'''Path: The directory of the bundled experiments (in the source tree).'''
+
+EXPERIMENTS = {
+    'balkan': {
+        'config': EXPERIMENTS_DIR / 'balkan' / 'config.json',
+        'settings': {'data': {'FEATURES': 'data/features/features.csv',
+                              'FEATURE_STATES': 'data/features/feature_states.csv'},
+                     'model': {'N_AREAS': 2}}
+    },
+    'simulation': {
+        'config': EXPERIMENTS_DIR / 'simulation' / 'sim_exp1' / 'config.json',
+        'settings': {'simulation': {'STRENGTH': 1, 'I_CONTACT': 3, 'E_CONTACT': 0.5, 'AREA': 4}}
+    }
+}
+'''dict: The bundled experiments, with the settings which are left open (TBD) in their config.'''
+
+SYNTHETIC_BASE = {'n_sites': 100, 'n_features': 30, 'n_states': 3, 'n_areas': 2, 'n_families': 3}
+'''dict: The parameters of the synthetic data set at scale 1.'''
+
+PHASES = ['load', 'network', 'warm_up', 'sample', 'post_process', 'write']
+'''list: The phases of a job, in the order in which they are executed.'''
+
+
+def effective_sample_size(x):
+    """Estimate the effective sample size of a chain, using Geyer's initial monotone sequence
+    estimator of the integrated autocorrelation time.
+
+    Args:
+        x (np.array): the chain (samples of a scalar parameter).
+            shape: (n_samples,)
+    Returns:
+        float: the effective sample size (nan for a constant chain).
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    variance = np.var(x)
+    if n < 4 or variance == 0:
+        return np.nan
+
+    # Autocorrelation via FFT (zero-padded to avoid circular correlation)
+    x = x - np.mean(x)
+    f = np.fft.rfft(x, n=2 * n)
+    acf = np.fft.irfft(f * np.conj(f))[:n] / (n * variance)
+
+    # Sums of pairs of consecutive autocorrelations, truncated at the first non-positive sum
+    pairs = acf[:n - n % 2].reshape(-1, 2).sum(axis=1)
+    non_positive = np.flatnonzero(pairs <= 0)
+    if len(non_positive) > 0:
+        pairs = pairs[:non_positive[0]]
+    pairs = np.minimum.accumulate(pairs)
+
+    tau = max(-1. + 2. * np.sum(pairs), 1. / np.log10(n))
+    return float(n / tau)
+
+
+def peak_rss():
+    """The peak resident set size of the current process (in MB)."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+@contextlib.contextmanager
+def time_phase(times, phase):
+    t_start = time.perf_counter()
+    yield
+    times[phase] += time.perf_counter() - t_start
+
+
+def mcmc_settings(n_steps, n_samples, n_warm_up_steps, n_warm_up_chains):
+    """The settings of a short MCMC run (overriding the config of the experiment)."""
+    return {'mcmc': {'N_STEPS': n_steps, 'N_SAMPLES': n_samples, 'N_RUNS': 1,
+                     'WARM_UP': {'N_WARM_UP_STEPS': n_warm_up_steps,
+                                 'N_WARM_UP_CHAINS': n_warm_up_chains}}}
+
+
+def synthetic_experiment(data, name, settings, results_path):
+    """Set up an experiment (config with defaults and results path) for a synthetic data set."""
+    from sbayes.experiment_setup import DEFAULT_CONFIG, Experiment, set_defaults, update_recursive
+
+    config = benchmark_config(data)
+    config['results'] = {'RESULTS_PATH': str(results_path), 'FILE_INFO': 'n'}
+    set_defaults(config, DEFAULT_CONFIG)
+    update_recursive(config, settings)
+
+    experiment = Experiment(experiment_name=name, log=False)
+    experiment.config = config
+    experiment.path_results = Path(results_path) / name
+    experiment.path_results.mkdir(parents=True, exist_ok=True)
+    return experiment
+
+
+def run_job(job):
+    """Run one MCMC job and measure its throughput.
+
+    Args:
+        job (dict): the job definition, with
+            name (str): the name of the job,
+            config (Path): the config file of a bundled experiment (or None),
+            synthetic (dict): the parameters of a synthetic data set (or None),
+            settings (dict): settings overriding the config (MCMC length, open settings),
+            results_path (Path): the directory for the results of the job,
+            seed (int): the random seed.
+    Returns:
+        dict: the size of the data, the time per phase, the steps and ESS per second and the
+            peak RSS of the job.
+    """
+    from sbayes.cli import init_data
+    from sbayes.experiment_setup import Experiment
+    from sbayes.mcmc_setup import MCMC
+    from sbayes.postprocessing import contribution_per_area
+
+    times = defaultdict(float)
+    set_seed(job['seed'])
+
+    with time_phase(times, 'load'):
+        if job.get('synthetic') is not None:
+            data = SyntheticData(**job['synthetic'], seed=job['seed'])
+            experiment = synthetic_experiment(data, job['name'], job['settings'], job['results_path'])
+        else:
+            experiment = Experiment(experiment_name=job['name'], log=False)
+            experiment.load_config(job['config'], custom_settings={
+                **job['settings'], 'results': {'RESULTS_PATH': str(job['results_path'])}})
+            data = quiet(init_data)(experiment)
+
+    # The network is built while loading the data
+    times['network'] = data.time_network
+    times['load'] -= times['network']
+
+    mcmc = MCMC(data=data, experiment=experiment)
+    with time_phase(times, 'warm_up'):
+        quiet(mcmc.warm_up)()
+
+    with time_phase(times, 'sample'):
+        quiet(mcmc.sample)(lh_per_area=False)
+
+    with time_phase(times, 'post_process'):
+        contribution_per_area(mcmc.sampler)
+        quiet(mcmc.postprocess_samples)()
+
+    with time_phase(times, 'write'):
+        quiet(mcmc.write_samples)(run=0)
+
+    # Throughput of the warm-up (all chains) and the sampling
+    mcmc_config = experiment.config['mcmc']
+    n_warm_up_steps = mcmc_config['WARM_UP']['N_WARM_UP_STEPS'] * mcmc_config['WARM_UP']['N_WARM_UP_CHAINS']
+    n_steps = mcmc_config['N_STEPS'] * mcmc_config.get('N_CHAINS', 1)
+
+    # Effective sample size of the log-posterior and of the weights (worst feature)
+    samples = mcmc.samples
+    log_posterior = np.add(samples['sample_likelihood'], samples['sample_prior'])
+    weights = np.array(samples['sample_weights'])
+    ess_posterior = effective_sample_size(log_posterior)
+    ess_weights = np.nanmin([effective_sample_size(w) for w in weights.reshape(len(weights), -1).T])
+
+    n_sites, n_features, n_states = data.features.shape
+    return {
+        'name': job['name'],
+        'n_sites': n_sites,
+        'n_features': n_features,
+        'n_states': n_states,
+        'n_areas': experiment.config['model']['N_AREAS'],
+        'inheritance': experiment.config['model']['INHERITANCE'],
+        'n_steps': n_steps,
+        'n_samples': len(log_posterior),
+        'times': {phase: times[phase] for phase in PHASES},
+        'total_time': sum(times.values()),
+        'warm_up_steps_per_second': n_warm_up_steps / times['warm_up'],
+        'steps_per_second': n_steps / times['sample'],
+        'ess_posterior': ess_posterior,
+        'ess_weights': float(ess_weights),
+        'ess_posterior_per_second': ess_posterior / times['sample'],
+        'ess_weights_per_second': float(ess_weights) / times['sample'],
+        'peak_rss_mb': peak_rss()
+    }
+
+
+def run_isolated(job):
+    """Run a job in a fresh process, so that the peak RSS is measured for this job only."""
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_job, job).result()
+
+
+def build_jobs(experiments, scales, scaling, sites_factors, features_factors, settings,
+               results_path, seed=0):
+    """List the jobs of a benchmark: bundled experiments, scaled synthetic data sets and
+    (optionally) the points of the scaling curves over sites and features."""
+    jobs = []
+    for name in experiments:
+        jobs.append({'name': name, 'group': 'experiment', 'config': EXPERIMENTS[name]['config'],
+                     'settings': {**EXPERIMENTS[name]['settings'], **settings}})
+
+    for s in scales:
+        params = {**SYNTHETIC_BASE, 'n_sites': int(SYNTHETIC_BASE['n_sites'] * s)}
+        jobs.append({'name': f'synthetic_{s:g}x', 'group': 'synthetic', 'synthetic': params,
+                     'settings': settings})
+
+    if scaling:
+        for f in sites_factors:
+            params = {**SYNTHETIC_BASE, 'n_sites': int(SYNTHETIC_BASE['n_sites'] * f)}
+            jobs.append({'name': f'sites_{params["n_sites"]}', 'group': 'scaling_sites',
+                         'synthetic': params, 'settings': settings})
+        for f in features_factors:
+            params = {**SYNTHETIC_BASE, 'n_features': int(SYNTHETIC_BASE['n_features'] * f)}
+            jobs.append({'name': f'features_{params["n_features"]}', 'group': 'scaling_features',
+                         'synthetic': params, 'settings': settings})
+
+    for job in jobs:
+        job['results_path'] = Path(results_path)
+        job['seed'] = seed
+    return jobs
+
+
+def results_table(results):
+    """Flatten the results of all jobs to a table (one row per job)."""
+    import pandas as pd
+
+    rows = []
+    for r in results:
+        row = {k: v for k, v in r.items() if k != 'times'}
+        row.update({f'time_{phase}': t for phase, t in r['times'].items()})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def plot_scaling(table, file):
+    """Plot the steps per second and the time per phase over the number of sites and features."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    curves = [('scaling_sites', 'n_sites', 'Number of sites'),
+              ('scaling_features', 'n_features', 'Number of features')]
+    fig, axes = plt.subplots(2, 2, figsize=(10, 8))
+    for col, (group, x, label) in enumerate(curves):
+        t = table[table['group'] == group].sort_values(x)
+        if len(t) == 0:
+            continue
+
+        ax = axes[0, col]
+        ax.plot(t[x], t['steps_per_second'], marker='o', label='sampling')
+        ax.plot(t[x], t['warm_up_steps_per_second'], marker='o', label='warm-up')
+        ax.plot(t[x], t['ess_posterior_per_second'], marker='o', label='ESS (log-posterior)')
+        ax.set(xscale='log', yscale='log', xlabel=label, ylabel='per second')
+        ax.legend()
+
+        ax = axes[1, col]
+        for phase in PHASES:
+            ax.plot(t[x], t[f'time_{phase}'], marker='o', label=phase)
+        ax.set(xscale='log', yscale='log', xlabel=label, ylabel='time [s]')
+        ax.legend()
+
+    fig.tight_layout()
+    fig.savefig(file)
+    plt.close(fig)
+
+
+def run_throughput_benchmark(jobs, isolate=True):
+    """Run all jobs (one after the other) and collect their results.
+
+    Returns:
+        list: the results of the jobs, see `run_job`.
+        list: the jobs which failed, with the error message.
+    """
+    results, failed = [], []
+    for i, job in enumerate(jobs):
+        print(f'Job {i+1}/{len(jobs)}: {job["name"]}')
+        try:
+            r = run_isolated(job) if isolate else run_job(job)
+        except Exception as e:
+            failed.append({'name': job['name'], 'error': repr(e)})
+            print(f'Job {job["name"]} failed: {e!r}')
+            continue
+
+        r['group'] = job['group']
+        results.append(r)
+        print(f'\t{r["n_sites"]} sites, {r["n_features"]} features: '
+              f'{r["steps_per_second"]:.0f} steps/s, '
+              f'{r["ess_posterior_per_second"]:.2f} ESS/s, '
+              f'{r["peak_rss_mb"]:.0f} MB, '
+              + ', '.join(f'{phase} {t:.2f}s' for phase, t in r['times'].items()))
+    return results, failed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='End-to-end throughput benchmark of sBayes (short MCMC runs).')
+    parser.add_argument('--experiments', nargs='*', default=list(EXPERIMENTS), choices=list(EXPERIMENTS),
+                        help='The bundled experiments to run.')
+    parser.add_argument('--scales', nargs='*', type=float, default=[1, 10, 100],
+                        help='Scale factors (number of sites) of the synthetic data sets.')
+    parser.add_argument('--scaling', action='store_true',
+                        help='Compute the scaling curves over the number of sites and features.')
+    parser.add_argument('--sites-factors', nargs='+', type=float, default=[1, 2, 5, 10, 20],
+                        help='The scale factors of the number of sites in the scaling curve.')
+    parser.add_argument('--features-factors', nargs='+', type=float, default=[0.5, 1, 2, 5, 10],
+                        help='The scale factors of the number of features in the scaling curve.')
+    parser.add_argument('--n-steps', type=int, default=2000)
+    parser.add_argument('--n-samples', type=int, default=200)
+    parser.add_argument('--n-warm-up-steps', type=int, default=500)
+    parser.add_argument('--n-warm-up-chains', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-isolate', action='store_true',
+                        help='Run all jobs in the main process (the peak RSS is then cumulative).')
+    parser.add_argument('--output', type=Path, default=Path('benchmark_results'),
+                        help='The directory to write the results to.')
+    args = parser.parse_args(args)
+
+    settings = mcmc_settings(args.n_steps, args.n_samples, args.n_warm_up_steps, args.n_warm_up_chains)
+    args.output.mkdir(parents=True, exist_ok=True)
+
+    # The samples written by the jobs are only needed to time the writing
+    with tempfile.TemporaryDirectory() as results_path:
+        jobs = build_jobs(args.experiments, args.scales, args.scaling, args.sites_factors,
+                          args.features_factors, deepcopy(settings), results_path, seed=args.seed)
+        results, failed = run_throughput_benchmark(jobs, isolate=not args.no_isolate)
+
+    with open(args.output / 'throughput.json', 'w') as f:
+        json.dump({'environment': environment_info(), 'settings': settings,
+                   'results': results, 'failed': failed}, f, indent=4)
+
+    if results:
+        table = results_table(results)
+        table.to_csv(args.output / 'throughput.csv', index=False)
+        if args.scaling:
+            plot_scaling(table, args.output / 'scaling.pdf')
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
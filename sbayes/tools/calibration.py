@@ -0,0 +1,276 @@
+""" Simulation-based calibration (SBC) of the sampler.
+
+Each replicate draws the parameters (area, weights, universal, contact and inheritance
+probabilities) from the prior, simulates features from them and runs a short MCMC on the
+simulated data. For every scalar parameter, the rank of the true value among the posterior
+samples is recorded. If the sampler is correct, the ranks are uniformly distributed, so the
+aggregated rank histograms of a calibrated sampler are flat.
+
+The replicates run in parallel worker processes, each with its own random seed. The ranks
+(ranks.npz) and the aggregated histograms (histograms.csv) are written to the results
+directory of the experiment.
+
+The prior draws are exact for the uniform priors on weights and probabilities, a uniform geo
+prior and any of the area size priors, with a single area. The posterior samples should be
+(roughly) independent, i.e. N_STEPS / N_SAMPLES should be larger than the autocorrelation
+time of the chain.
+
+Usage:
+    python -m sbayes.tools.calibration config.json --n-replicates 200 --n-jobs 8
+"""
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy.stats import chisquare
+
+from sbayes.preprocessing import simulate_dirichlet
+from sbayes.tools.run_sweep import get_seed, set_seed
+from sbayes.util import log_binom
+
+
+PARAMETERS = ['area', 'weights', 'p_universal', 'p_contact', 'p_inheritance']
+'''list: The groups of parameters for which the rank statistics are computed.'''
+
+
+def verify_calibration_config(config):
+    """Check whether the parameters of a model can be drawn exactly from its prior."""
+    priors = config['model']['PRIOR']
+    for key in ['geo', 'weights', 'universal', 'contact', 'inheritance']:
+        prior = priors.get(key)
+        if prior is not None and prior['type'] != 'uniform':
+            raise ValueError(f'Calibration requires a uniform prior for \'{key}\' '
+                             f'(got \'{prior["type"]}\').')
+    if config['simulation']['SUBSET']:
+        raise ValueError('Calibration is not possible on a subset of the simulated sites.')
+
+
+def draw_area_from_prior(n_sites, min_size, max_size, size_prior):
+    """Draw an area from the prior: the size from the size prior, the sites uniformly.
+
+    Args:
+        n_sites (int): the number of sites.
+        min_size (int): minimum size of the area.
+        max_size (int): maximum size of the area.
+        size_prior (str): the type of the area size prior ('none', 'uniform' or 'quadratic').
+    Returns:
+        np.array: the area.
+            shape: (1, n_sites)
+    """
+    sizes = np.arange(min_size, min(max_size, n_sites) + 1)
+
+    # Log-probability of all areas of size k, given the size prior
+    if size_prior == 'none':
+        logp = log_binom(n_sites, sizes)
+    elif size_prior == 'uniform':
+        logp = np.zeros(len(sizes))
+    elif size_prior == 'quadratic':
+        logp = log_binom(n_sites, sizes) - 2 * np.log(sizes)
+    else:
+        raise ValueError(f'Invalid prior type {size_prior} for size prior.')
+
+    p = np.exp(logp - np.max(logp))
+    size = np.random.choice(sizes, p=p / np.sum(p))
+
+    area = np.zeros((1, n_sites), dtype=bool)
+    area[0, np.random.choice(n_sites, size=size, replace=False)] = True
+    return area
+
+
+def draw_from_prior(sim, model_config):
+    """Draw the parameters of a simulation from the (uniform) prior of the model.
+
+    Args:
+        sim (Simulation): the simulation, with the sites (and families) loaded.
+        model_config (dict): the model section of the config.
+    """
+    n_sites = sim.network['n']
+    n_features = sim.config['N_FEATURES']
+
+    sim.areas = draw_area_from_prior(n_sites=n_sites,
+                                     min_size=model_config['MIN_M'],
+                                     max_size=model_config['MAX_M'],
+                                     size_prior=model_config['PRIOR']['area_size']['type'])
+
+    # Weights of universal pressure, contact (and inheritance)
+    n_components = 3 if sim.inheritance else 2
+    sim.weights = np.random.dirichlet(np.ones(n_components), n_features)
+
+    # Number of states per feature
+    categories = [int(k) for k in sim.config['P_N_CATEGORIES']]
+    p_categories = list(sim.config['P_N_CATEGORIES'].values())
+    n_categories = np.random.choice(a=categories, size=n_features, p=p_categories)
+    applicable = np.arange(np.max(n_categories)) < n_categories[:, np.newaxis]
+
+    sim.p_universal = simulate_dirichlet(1., applicable)
+    sim.p_contact = simulate_dirichlet(1., np.repeat(applicable[np.newaxis], 1, axis=0))
+    if sim.inheritance:
+        n_families = len(sim.families)
+        sim.p_inheritance = simulate_dirichlet(1., np.repeat(applicable[np.newaxis], n_families, axis=0))
+    else:
+        sim.p_inheritance = None
+
+
+def compute_ranks(true_values, samples, mask=None):
+    """Compute the rank of the true values among the posterior samples. Ties (e.g. for the
+    binary area membership) are broken at random, so that the ranks are uniform on
+    {0, ..., n_samples} for a calibrated sampler.
+
+    Args:
+        true_values (np.array): the true parameters.
+            shape: (*param_shape)
+        samples (np.array): the posterior samples.
+            shape: (n_samples, *param_shape)
+        mask (np.array): the parameters to include (default: all).
+            shape: (*param_shape)
+    Returns:
+        np.array: the ranks of the included parameters.
+            shape: (n_params,)
+    """
+    less = np.sum(samples < true_values, axis=0)
+    equal = np.sum(samples == true_values, axis=0)
+    ranks = less + np.floor(np.random.random(equal.shape) * (equal + 1)).astype(int)
+    if mask is None:
+        return ranks.ravel()
+    return ranks[mask]
+
+
+def run_replicate(config_file, custom_settings, name, replicate, seed):
+    """Draw parameters from the prior, simulate data and compute the rank statistics of one
+    replicate.
+
+    Returns:
+        dict: the ranks for each group of parameters.
+        int: the number of posterior samples.
+        Path: the results directory of the calibration.
+    """
+    from sbayes.experiment_setup import Experiment
+    from sbayes.mcmc_setup import MCMC
+    from sbayes.simulation import Simulation
+
+    experiment = Experiment(experiment_name=f'{name}/replicate_{replicate}', log=False)
+    experiment.load_config(config_file, custom_settings=custom_settings)
+    experiment.config['model']['N_AREAS'] = 1
+    verify_calibration_config(experiment.config)
+
+    set_seed(seed)
+
+    # Simulate data from parameters drawn from the prior
+    sim = Simulation(experiment=experiment)
+    sim.load_sites()
+    draw_from_prior(sim, experiment.config['model'])
+    sim.simulate_data()
+
+    # Sample from the posterior
+    mcmc = MCMC(data=sim, experiment=experiment)
+    mcmc.warm_up()
+    mcmc.sample(lh_per_area=False)
+    samples = mcmc.samples
+
+    applicable = sim.states.astype(bool)
+    ranks = {
+        'area': compute_ranks(sim.areas, np.array(samples['sample_zones'])),
+        'weights': compute_ranks(sim.weights, np.array(samples['sample_weights'])),
+        'p_universal': compute_ranks(sim.p_universal, np.array(samples['sample_p_global'])[:, 0], applicable),
+        'p_contact': compute_ranks(sim.p_contact[0], np.array(samples['sample_p_zones'])[:, 0], applicable)
+    }
+    if sim.inheritance:
+        ranks['p_inheritance'] = compute_ranks(sim.p_inheritance, np.array(samples['sample_p_families']),
+                                               np.repeat(applicable[np.newaxis], len(sim.families), axis=0))
+
+    return ranks, len(samples['sample_zones']), experiment.path_results.parent
+
+
+def rank_histograms(ranks, n_samples, n_bins=20):
+    """Aggregate the ranks of each group of parameters in histograms and test them for
+    uniformity.
+
+    Args:
+        ranks (dict): the ranks of all replicates for each group of parameters.
+        n_samples (int): the number of posterior samples per replicate.
+        n_bins (int): the number of bins (at most n_samples + 1).
+    Returns:
+        pd.DataFrame: the counts per group and bin, with the expected counts and the
+            p-value of a chi-square test for uniformity.
+    """
+    import pandas as pd
+
+    n_bins = min(n_bins, n_samples + 1)
+    rows = []
+    for group, r in ranks.items():
+        # Equal-width bins on the possible ranks {0, ..., n_samples}
+        counts = np.bincount(r * n_bins // (n_samples + 1), minlength=n_bins)
+        expected = len(r) * np.diff(np.ceil(np.arange(n_bins + 1) * (n_samples + 1) / n_bins)) / (n_samples + 1)
+        p_value = chisquare(counts, expected).pvalue
+        for i_bin in range(n_bins):
+            rows.append({'parameter': group, 'bin': i_bin, 'count': counts[i_bin],
+                         'expected': expected[i_bin], 'p_value': p_value})
+    return pd.DataFrame(rows)
+
+
+def run_calibration(config_file, n_replicates, custom_settings=None, n_jobs=1, seed=0,
+                    name='calibration', n_bins=20):
+    """Run the replicates of a simulation-based calibration and aggregate the ranks.
+
+    Args:
+        config_file (Path): the config file (with a simulation section).
+        n_replicates (int): the number of replicates.
+        custom_settings (dict): settings overriding the config file.
+        n_jobs (int): the number of worker processes.
+        seed (int): base seed of the calibration.
+        name (str): the experiment name (the results directory) of the calibration.
+        n_bins (int): the number of bins of the histograms.
+    Returns:
+        pd.DataFrame: the histograms, see `rank_histograms`.
+    """
+    seeds = [get_seed(seed, r) for r in range(n_replicates)]
+    args = [(config_file, custom_settings, name, r, seeds[r]) for r in range(n_replicates)]
+
+    if n_jobs == 1:
+        results = [run_replicate(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(run_replicate, *zip(*args)))
+
+    n_samples = results[0][1]
+    path_results = results[0][2]
+    ranks = {group: np.concatenate([r[0][group] for r in results])
+             for group in PARAMETERS if group in results[0][0]}
+
+    np.savez(path_results / 'ranks.npz', n_samples=n_samples, **ranks)
+    histograms = rank_histograms(ranks, n_samples, n_bins=n_bins)
+    histograms.to_csv(path_results / 'histograms.csv', index=False)
+
+    for group, h in histograms.groupby('parameter', sort=False):
+        print(f'{group}: {len(ranks[group])} ranks, p-value (uniformity) = {h["p_value"].iloc[0]:.3f}')
+
+    return histograms
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Simulation-based calibration of the sBayes sampler.')
+    parser.add_argument('config', type=Path,
+                        help='The JSON configuration file (with a simulation section).')
+    parser.add_argument('--n-replicates', type=int, default=100,
+                        help='The number of replicates.')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='The number of worker processes.')
+    parser.add_argument('--n-bins', type=int, default=20,
+                        help='The number of bins of the rank histograms.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The base seed of the calibration.')
+    parser.add_argument('--name', type=str, default='calibration',
+                        help='The name of the results directory.')
+    parser.add_argument('--settings', type=json.loads, default=None,
+                        help='Settings overriding the config file, as a JSON string.')
+    args = parser.parse_args(args)
+
+    run_calibration(args.config, args.n_replicates, custom_settings=args.settings,
+                    n_jobs=args.n_jobs, seed=args.seed, name=args.name, n_bins=args.n_bins)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,10 +5,7 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
-import tkinter as tk
-from tkinter import filedialog, messagebox
-
-from sbayes.util import normalize_str
+from sbayes.util import normalize_str_columns
 
 
 ORDER_STATES = True
@@ -16,6 +13,8 @@ ORDER_STATES = True
 
 
 def select_open_file(default_dir='.'):
+    from tkinter import filedialog
+
     path = filedialog.askopenfilename(
         title='Select a data file in CSV format.',
         initialdir=default_dir,
@@ -25,6 +24,8 @@ def select_open_file(default_dir='.'):
 
 
 def select_save_file(default_dir='.', default_name='feature_states.csv'):
+    from tkinter import filedialog
+
     path = filedialog.asksaveasfile(
         title='Select an output file in CSV format.',
         initialdir=default_dir,
@@ -35,7 +36,9 @@ def select_save_file(default_dir='.', default_name='feature_states.csv'):
 
 
 def ask_more_files():
-    MsgBox = tk.messagebox.askquestion ('Additional data files','Would you like to add more data files?')
+    from tkinter import messagebox
+
+    MsgBox = messagebox.askquestion ('Additional data files','Would you like to add more data files?')
     return MsgBox == 'yes'
 
 
@@ -46,7 +49,7 @@ def collect_feature_states(features_path):
         if column not in features.columns:
             raise ValueError(f'Required column \'{column}\' missing in file {features_path}.')
     features = features.drop(METADATA_COLUMNS, axis=1)
-    features = features.applymap(normalize_str)
+    features = normalize_str_columns(features)
     return {f: set(features[f].dropna().unique()) for f in features.columns}
 
 
@@ -73,6 +76,8 @@ def main(args):
 
     # GUI
     if (csv_paths is None) or (len(csv_paths) == 0):
+        import tkinter as tk
+
         tk.Tk().withdraw()
 
         # Ask the user for input files
@@ -0,0 +1,160 @@
+""" Render the plots of several models (results files) in parallel.
+
+The data and the results of each model are read once in the main process. The plots are
+rendered in a pool of worker processes with the non-interactive Agg backend: the data is
+passed to each worker once, the results of a model with each plot.
+
+The plots are defined in a JSON file (or a list of dictionaries), e.g.
+
+    [
+        {"type": "posterior_map", "file_name": "posterior_map_{model}_0.7",
+         "config": {"map": {"content": {"min_posterior_frequency": 0.7}}}},
+        {"type": "plot_weights_grid", "file_name": "weights_grid_{model}"},
+        {"type": "plot_probability_grid", "file_name": "prob_grid_{model}_gamma_a1",
+         "config": {"probabilities_plot": {"parameter": "gamma_a1"}}},
+        {"type": "plot_dic", "file_name": "dic"}
+    ]
+
+`type` is the name of the Plot method, `file_name` may contain the placeholder {model},
+`config` updates the plot config for this plot only and `kwargs` are passed on to the
+method. Plots over all models (plot_dic, plot_recall_precision_over_all_models) are
+rendered once, with the results of all models.
+
+Usage:
+    python -m sbayes.tools.plot_batch config_plot.json plots.json --n-jobs 8
+"""
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
+from pathlib import Path
+
+
+MODEL_PLOTS = ['posterior_map', 'plot_weights_grid', 'plot_probability_grid', 'plot_pies', 'plot_trace']
+'''list: Plots which are rendered for each model.'''
+
+SUMMARY_PLOTS = ['plot_dic', 'plot_recall_precision_over_all_models']
+'''list: Plots which are rendered once, over the results of all models.'''
+
+_plot = None
+'''Plot: the plot object (config and data) of a worker process.'''
+
+
+def init_worker(plot):
+    """Set the non-interactive backend and the plot object of a worker process."""
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+    global _plot
+    _plot = plot
+
+
+def render(spec, model, results):
+    """Render one plot in a worker process.
+
+    Args:
+        spec (dict): the plot definition (type, file_name, config, kwargs).
+        model (str): the name of the model (None for plots over all models).
+        results (dict): the results of the model (or the results of all models).
+    Returns:
+        str: the file name of the plot.
+    """
+    import matplotlib.pyplot as plt
+    from sbayes.experiment_setup import update_recursive
+
+    # Each plot works on its own copy of the config
+    plot = copy(_plot)
+    plot.config = deepcopy(_plot.config)
+    update_recursive(plot.config, spec.get('config', {}))
+
+    file_name = spec['file_name'].format(model=model)
+    try:
+        if spec['type'] in SUMMARY_PLOTS:
+            getattr(plot, spec['type'])(results, file_name=file_name, **spec.get('kwargs', {}))
+        else:
+            plot.results = results
+            getattr(plot, spec['type'])(file_name=file_name, **spec.get('kwargs', {}))
+    finally:
+        plt.close('all')
+
+    return file_name
+
+
+def plot_batch(config_file, plots, models=None, simulated_data=False, n_jobs=1):
+    """Read the results of all models once and render the plots in parallel.
+
+    Args:
+        config_file (Path): the plot config file.
+        plots (list): the plot definitions (see module docstring).
+        models (list): the names of the models to plot (default: all models in the config).
+        simulated_data (bool): whether the results are from a simulation.
+        n_jobs (int): the number of worker processes.
+    Returns:
+        list: the plots which failed, with the model and the error message.
+    """
+    from sbayes.plot import Plot
+
+    for spec in plots:
+        if spec['type'] not in MODEL_PLOTS + SUMMARY_PLOTS:
+            raise ValueError(f'Invalid plot type {spec["type"]} (choose from {MODEL_PLOTS + SUMMARY_PLOTS}).')
+
+    plot = Plot(simulated_data=simulated_data)
+    plot.load_config(config_file=config_file)
+    plot.read_data()
+
+    if models is None:
+        models = plot.get_model_names()
+
+    # Read the results of each model once
+    results_per_model = {}
+    for m in models:
+        plot.read_results(model=m)
+        results_per_model[m] = plot.results
+    plot.results = {}
+
+    jobs = []
+    for spec in plots:
+        if spec['type'] in SUMMARY_PLOTS:
+            jobs.append((spec, None, results_per_model))
+        else:
+            jobs.extend((spec, m, results_per_model[m]) for m in models)
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=(plot,)) as pool:
+        futures = [pool.submit(render, *job) for job in jobs]
+        for (spec, m, _), future in zip(jobs, futures):
+            try:
+                print('Plotted', future.result())
+            except Exception as e:
+                failed.append({'type': spec['type'], 'model': m, 'error': repr(e)})
+                print(f'Plot {spec["type"]} failed for model {m}: {e!r}')
+
+    return failed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Render the plots of several sBayes models in parallel.')
+    parser.add_argument('config', type=Path,
+                        help='The JSON plot configuration file.')
+    parser.add_argument('plots', type=Path,
+                        help='A JSON file with the list of plots to render.')
+    parser.add_argument('--models', nargs='+', default=None,
+                        help='The models to plot (default: all models in the config).')
+    parser.add_argument('--simulated', action='store_true',
+                        help='Whether the results are from a simulation.')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='The number of worker processes.')
+    args = parser.parse_args(args)
+
+    with open(args.plots, 'r') as f:
+        plots = json.load(f)
+
+    failed = plot_batch(args.config, plots, models=args.models,
+                        simulated_data=args.simulated, n_jobs=args.n_jobs)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+""" Run a simulation study (or any other experiment) over a grid of config settings.
+
+Each cell of the grid (one combination of settings and one run) is an independent job: the
+cells are executed in parallel worker processes, each with its own random seed. The results
+of a setting are written to a directory named after a hash of the config file and the
+settings, with a subdirectory per run, so that cells which are already done are skipped when
+the sweep is restarted.
+
+The grid is a JSON file mapping config sections to the values of each key, e.g.
+
+    {
+        "simulation": {
+            "STRENGTH": [{"STRENGTH": 0, "I_CONTACT": 2, "E_CONTACT": 0.75},
+                         {"STRENGTH": 1, "I_CONTACT": 3, "E_CONTACT": 0.5}],
+            "AREA": [4, 6, 3, 8]
+        },
+        "model": {
+            "N_AREAS": [1, 2]
+        }
+    }
+
+A value which is a dictionary sets all of its items at once (e.g. to couple I_CONTACT and
+E_CONTACT to STRENGTH).
+
+Usage:
+    python -m sbayes.tools.run_sweep config.json grid.json --n-jobs 8
+"""
+import argparse
+import itertools
+import json
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from sbayes.util import hash_inputs
+
+
+DONE_FILE = 'done.json'
+'''str: Marker file, written to the results directory of a run once it is finished.'''
+
+
+def grid_settings(grid):
+    """List the custom settings of all combinations in a parameter grid.
+
+    Args:
+        grid (dict): config section -> key -> list of values.
+    Returns:
+        list: the custom settings (section -> key -> value) of each combination.
+    """
+    axes = [(section, key, values)
+            for section, keys in grid.items()
+            for key, values in keys.items()]
+
+    settings = []
+    for combination in itertools.product(*[values for _, _, values in axes]):
+        s = {}
+        for (section, key, _), value in zip(axes, combination):
+            if isinstance(value, dict):
+                s.setdefault(section, {}).update(value)
+            else:
+                s.setdefault(section, {})[key] = value
+        settings.append(s)
+    return settings
+
+
+def get_seed(*keys):
+    """Derive a reproducible 32-bit seed from a sequence of keys (e.g. a hash and a run)."""
+    entropy = [int(k, 16) if isinstance(k, str) else k for k in keys]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def build_cells(config_file, grid, n_runs=None, seed=0):
+    """Build the cells of a sweep.
+
+    Args:
+        config_file (Path): the base config file of the experiment.
+        grid (dict): config section -> key -> list of values.
+        n_runs (int): the number of runs per setting (default: N_RUNS in the config).
+        seed (int): base seed of the sweep.
+    Returns:
+        list: one dictionary per cell with the settings, their hash, the run and the seeds
+            for the simulation and the sampler.
+    """
+    if n_runs is None:
+        with open(config_file, 'r') as f:
+            n_runs = json.load(f).get('mcmc', {}).get('N_RUNS', 1)
+
+    cells = []
+    for settings in grid_settings(grid):
+        # The results section only defines where the results are written, not the results
+        model_settings = {section: v for section, v in settings.items() if section != 'results'}
+        setting_hash = hash_inputs([config_file], {'settings': model_settings, 'seed': seed})
+
+        # The data is simulated with the same seed in all runs of a setting
+        data_seed = get_seed(setting_hash)
+        for run in range(n_runs):
+            cells.append({'settings': settings,
+                          'hash': setting_hash,
+                          'run': run,
+                          'data_seed': data_seed,
+                          'mcmc_seed': get_seed(setting_hash, run + 1)})
+    return cells
+
+
+def cell_name(cell):
+    """The name of the results directory of a cell (relative to the results path): one
+    subdirectory per run in the directory of the setting. Runs never share their results,
+    logs or memory-mapped files."""
+    return f'{cell["hash"]}/run_{cell["run"]}'
+
+
+def set_seed(seed):
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def run_cell(config_file, cell):
+    """Simulate (or load) the data and run the experiment for one cell of the sweep.
+
+    Args:
+        config_file (Path): the base config file of the experiment.
+        cell (dict): the cell, as defined in `build_cells`.
+    Returns:
+        Path: the results directory of the cell.
+    """
+    from sbayes.cli import init_data, run_experiments
+    from sbayes.experiment_setup import Experiment
+
+    experiment = Experiment(experiment_name=cell_name(cell), log=False)
+    experiment.load_config(config_file, custom_settings=cell['settings'])
+    experiment.log_experiment()
+
+    # Record the settings of the cell next to the results
+    with open(experiment.path_results / 'settings.json', 'w') as f:
+        json.dump(cell['settings'], f, indent=4)
+
+    set_seed(cell['data_seed'])
+    data = init_data(experiment)
+
+    set_seed(cell['mcmc_seed'])
+    run_experiments(experiment, data, cell['run'])
+
+    # Mark the cell as done
+    with open(experiment.path_results / DONE_FILE, 'w') as f:
+        json.dump(cell, f, indent=4)
+
+    return experiment.path_results
+
+
+def is_done(config_file, cell):
+    """Check whether the results of a cell already exist."""
+    with open(config_file, 'r') as f:
+        results_path = json.load(f).get('results', {}).get('RESULTS_PATH', 'results')
+    results_path = cell['settings'].get('results', {}).get('RESULTS_PATH', results_path)
+
+    # Relative results paths are relative to the config file (as in the experiment)
+    path_results = Path(config_file).absolute().parent / results_path / cell_name(cell)
+    return (path_results / DONE_FILE).exists()
+
+
+def run_sweep(config_file, grid, n_runs=None, n_jobs=1, seed=0):
+    """Run all cells of a sweep which are not done yet.
+
+    Args:
+        config_file (Path): the base config file of the experiment.
+        grid (dict): config section -> key -> list of values.
+        n_runs (int): the number of runs per setting (default: N_RUNS in the config).
+        n_jobs (int): the number of worker processes.
+        seed (int): base seed of the sweep.
+    Returns:
+        list: the cells which failed, with the error message as an additional entry.
+    """
+    cells = build_cells(config_file, grid, n_runs=n_runs, seed=seed)
+    todo = [cell for cell in cells if not is_done(config_file, cell)]
+    print(f'{len(cells) - len(todo)} of {len(cells)} cells done, running {len(todo)} cells.')
+
+    failed = []
+    if n_jobs == 1:
+        for cell in todo:
+            try:
+                run_cell(config_file, cell)
+            except Exception as e:
+                failed.append({**cell, 'error': repr(e)})
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {pool.submit(run_cell, config_file, cell): cell for cell in todo}
+            for i, future in enumerate(as_completed(futures)):
+                cell = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append({**cell, 'error': repr(e)})
+                print(f'Cell {i+1}/{len(todo)} finished: {cell["hash"]} run {cell["run"]}')
+
+    for cell in failed:
+        print(f'Cell {cell["hash"]} run {cell["run"]} failed: {cell["error"]}')
+
+    return failed
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run an sBayes experiment over a grid of config settings in parallel.')
+    parser.add_argument('config', type=Path,
+                        help='The JSON configuration file of the experiment.')
+    parser.add_argument('grid', type=Path,
+                        help='A JSON file defining the grid (config section -> key -> list of values).')
+    parser.add_argument('--n-runs', type=int, default=None,
+                        help='The number of runs per setting (default: N_RUNS in the config).')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='The number of worker processes.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The base seed of the sweep.')
+    args = parser.parse_args(args)
+
+    with open(args.grid, 'r') as f:
+        grid = json.load(f)
+
+    failed = run_sweep(args.config, grid, n_runs=args.n_runs, n_jobs=args.n_jobs, seed=args.seed)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
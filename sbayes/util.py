@@ -5,22 +5,22 @@ import datetime
 import time
 import csv
 import os
+import json
+import hashlib
+import tempfile
 from math import sqrt, floor, ceil
+from pathlib import Path
 
 import typing as t
 
 import numpy as np
-import pandas as pd
 import scipy.spatial as spatial
 from scipy.special import betaln
 import scipy.stats as stats
-from scipy.sparse import csr_matrix
-import matplotlib.pyplot as plt
-from matplotlib.collections import LineCollection
-from scipy.stats import chi2_contingency
+from scipy.sparse import csr_matrix, triu
 
-from itertools import combinations
-from fastcluster import linkage
+# pandas, matplotlib and fastcluster are imported inside the functions that use them, so that
+# importing sbayes.util (e.g. in the model and the samplers) stays fast and light-weight.
 
 EPS = np.finfo(float).eps
 
@@ -155,6 +155,89 @@ def get_neighbours(zone, already_in_zone, adj_mat):
     return neighbours
 
 
+def hash_inputs(files, config=None):
+    """Compute a hash of the content of the given input files and (optionally) a dictionary
+    of config values, e.g. to identify cached preprocessing results.
+
+    Args:
+        files (list): paths to the input files.
+        config (dict): config values which influence the preprocessing.
+    Returns:
+        str: the hexadecimal hash.
+    """
+    h = hashlib.sha256()
+    for file in files:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:20]
+
+
+def set_default_permissions(path):
+    """Give a file or directory the permissions of a newly created one (according to the
+    umask). Files and directories made by `tempfile` are only accessible to their owner, so
+    this is needed before renaming them to a location shared with other users.
+
+    Args:
+        path (Path): the file or directory.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = 0o777 if os.path.isdir(path) else 0o666
+    os.chmod(path, mode & ~umask)
+
+
+def memmap_array(array, directory):
+    """Store an array in a .npy file named by its content and open it as a read-only
+    memory-map. Processes which load the same array share one (page-cached) copy of the data
+    instead of each holding their own. An existing file is never overwritten (which would
+    break the memory-maps of other processes): it is only written if missing, through a
+    temporary file which is renamed atomically.
+
+    Args:
+        array (np.array): the array to store.
+        directory (Path): the directory of the .npy file.
+    Returns:
+        np.memmap: the memory-mapped array.
+    """
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha256()
+    h.update(json.dumps([array.dtype.str, array.shape]).encode())
+    h.update(array.data)
+    file = Path(directory) / f'array_{h.hexdigest()[:20]}.npy'
+
+    if not file.exists():
+        file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=file.parent, suffix='.npy')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            set_default_permissions(tmp_file)
+            os.replace(tmp_file, file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+    return np.load(file, mmap_mode='r')
+
+
+def memmap_features(features, na_features, directory):
+    """Store the features and the NA mask in memory-mapped files, shared by all processes
+    on the node (see `memmap_array`).
+
+    Args:
+        features (np.array): the encoded features.
+            shape: (n_sites, n_features, n_states)
+        na_features (np.array): the NA mask of the features.
+            shape: (n_sites, n_features)
+        directory (Path): the directory of the .npy files.
+    Returns:
+        (np.memmap, np.memmap): the memory-mapped features and NA mask.
+    """
+    return memmap_array(features, directory), memmap_array(na_features, directory)
+
+
 def compute_delaunay(locations):
     """Computes the Delaunay triangulation between a set of point locations
 
@@ -175,30 +258,60 @@ def compute_delaunay(locations):
     return csr_matrix((data, indices, indptr), shape=(n, n))
 
 
+def compute_distance_matrix(locations, dtype=np.float64, out_file=None, chunk_size=1000):
+    """Computes the matrix of Euclidean distances between all pairs of locations. The matrix
+    is filled in blocks of rows, so no temporary array larger than (chunk_size, n_sites) is
+    created. Optionally, the matrix is stored in a memory-mapped .npy file instead of RAM.
+
+    Args:
+        locations (np.array): a set of locations
+            shape (n_sites, n_spatial_dims = 2)
+        dtype (np.dtype): data type of the distance matrix (e.g. float32 to halve the memory)
+        out_file (Path): path of a .npy file to memory-map the distance matrix to (optional)
+        chunk_size (int): number of rows computed in one block
+    Returns:
+        (np.array) the distance matrix
+            shape (n_sites, n_sites)
+    """
+    locations = np.asarray(locations, dtype=float)
+    n = len(locations)
+
+    if out_file is None:
+        dist_mat = np.empty((n, n), dtype=dtype)
+    else:
+        dist_mat = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=(n, n))
+
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        dist_mat[start:end] = spatial.distance.cdist(locations[start:end], locations)
+
+    return dist_mat
+
+
 def gabriel_graph_from_delaunay(delaunay, locations):
-    delaunay = delaunay.toarray()
-    # converting delaunay graph to boolean array denoting whether points are connected
-    delaunay = delaunay > 0
-
-    # Delaunay indices and locations
-    delaunay_connections = []
-    delaunay_locations = []
-
-    for index, connected in np.ndenumerate(delaunay):
-        if connected:
-            # getting indices of points in area
-            i1, i2 = index[0], index[1]
-            if [i2, i1] not in delaunay_connections:
-                delaunay_connections.append([i1, i2])
-                delaunay_locations.append(locations[[*[i1, i2]]])
-    delaunay_connections = np.sort(np.asarray(delaunay_connections), axis=1)
-    delaunay_locations = np.asarray(delaunay_locations)
+    """Computes the Gabriel graph (the subset of Delaunay edges whose diametral circle
+    contains no other point) from a sparse Delaunay triangulation.
+
+    Args:
+        delaunay (csr_matrix): sparse adjacency matrix of the Delaunay triangulation
+            shape (n_sites, n_sites)
+        locations (np.array): a set of locations
+            shape (n_sites, n_spatial_dims = 2)
+    Returns:
+        (np.array) the Gabriel edges as pairs of site indices (i < j)
+            shape (n_gabriel_edges, 2)
+    """
+    # Each undirected Delaunay edge once (i < j, in row-major order)
+    upper = triu(delaunay, k=1).tocsr()
+    upper.sort_indices()
+    i1, i2 = upper.nonzero()
+    delaunay_connections = np.column_stack((i1, i2))
 
     # Find the midpoint on all Delaunay edges
-    m = (delaunay_locations[:, 0, :] + delaunay_locations[:, 1, :]) / 2
+    m = (locations[i1] + locations[i2]) / 2
 
     # Find the radius sphere between each pair of nodes
-    r = np.sqrt(np.sum((delaunay_locations[:, 0, :] - delaunay_locations[:, 1, :]) ** 2, axis=1)) / 2
+    r = np.sqrt(np.sum((locations[i1] - locations[i2]) ** 2, axis=1)) / 2
 
     # Use the kd-tree function in Scipy's spatial module
     tree = spatial.cKDTree(locations)
@@ -210,6 +323,43 @@ def gabriel_graph_from_delaunay(delaunay, locations):
     return delaunay_connections[g]
 
 
+def sparse_cost_matrix(costs, locations, graph='delaunay', k=8):
+    """Restrict a cost matrix to the edges of a sparse neighbourhood graph (the Delaunay
+    triangulation or the k nearest neighbours of each site). Only the costs of these edges are
+    looked up, so `costs` can be a memory-mapped array.
+
+    Args:
+        costs (np.array): the (dense) cost matrix between all sites.
+            shape (n_sites, n_sites)
+        locations (np.array): the locations of the sites.
+            shape (n_sites, n_spatial_dims = 2)
+        graph (str): the neighbourhood graph, either 'delaunay' or 'knn'.
+        k (int): number of neighbours per site (only used for graph='knn').
+    Returns:
+        csr_matrix: the symmetric sparse cost matrix.
+            shape (n_sites, n_sites)
+    """
+    n = len(locations)
+
+    if graph == 'delaunay':
+        i1, i2 = triu(compute_delaunay(locations), k=1).nonzero()
+    elif graph == 'knn':
+        k = min(k, n - 1)
+        _, neighbours = spatial.cKDTree(locations).query(locations, k=k+1)
+        i1 = np.repeat(np.arange(n), k)
+        i2 = neighbours[:, 1:].ravel()
+    else:
+        raise ValueError(f'Unknown neighbourhood graph \'{graph}\' (choose from [delaunay, knn]).')
+
+    # Each undirected edge once (k-NN edges can be found from both sites)
+    i1, i2 = np.unique(np.sort(np.column_stack((i1, i2)), axis=1), axis=0).T
+
+    # Look up the costs of all edges and store them in both directions
+    edge_costs = np.asarray(costs[i1, i2], dtype=float)
+    return csr_matrix((np.concatenate([edge_costs, edge_costs]),
+                       (np.concatenate([i1, i2]), np.concatenate([i2, i1]))), shape=(n, n))
+
+
 def n_smallest_distances(a, n, return_idx: bool):
     """ This function finds the n smallest distances in a distance matrix
 
@@ -287,61 +437,82 @@ def range_like(a):
 
 # Encoding
 def encode_states(features_raw, feature_states):
+    """Encode the raw (string valued) features as one-hot vectors over the states defined in
+    `feature_states`. All features are mapped to internal state indices in one pass, using a
+    lookup table of (feature, state) pairs.
+
+    Args:
+        features_raw (pd.DataFrame): the raw feature values (one column per feature).
+            shape: (n_sites, n_features)
+        feature_states (pd.DataFrame): the valid states of each feature (one column per feature).
+            shape: (n_states, n_features)
+    Returns:
+        (np.array, dict, np.array, int): the one-hot encoded features, the external and internal
+            state names, the applicable states per feature and the number of NA values.
+    """
+    import pandas as pd
+
     # Define shapes
     n_states, n_features = feature_states.shape
-    features_bin_shape = features_raw.shape + (n_states,)
     n_sites, _ = features_raw.shape
     assert n_features == _
 
-    # Initialize arrays and counts
-    features_bin = np.zeros(features_bin_shape, dtype=int)
-    applicable_states = np.zeros((n_features, n_states), dtype=bool)
+    # Applicable states and state names per feature
+    applicable_states = feature_states.notna().to_numpy().T
     state_names = {'external': [], 'internal': []}
-    na_number = 0
-
-    # Binary vectors used for encoding
-    one_hot = np.eye(n_states)
-
-    for f_idx in range(n_features):
-        f_name = feature_states.columns[f_idx]
-        f_states = feature_states[f_name]
-
-        # Define applicable states for feature f
-        applicable_states[f_idx] = ~f_states.isna()
-
-        # Define external and internal state names
-        s_ext = f_states.dropna().to_list()
-        s_int = range_like(s_ext)
+    for f_name in feature_states.columns:
+        s_ext = feature_states[f_name].dropna().to_list()
         state_names['external'].append(s_ext)
-        state_names['internal'].append(s_int)
+        state_names['internal'].append(range_like(s_ext))
 
-        # Map external to internal states for feature f
-        ext_to_int = dict(zip(s_ext, s_int))
-        f_raw = features_raw[f_name]
-        f_enc = f_raw.map(ext_to_int)
-        if not (set(f_raw.dropna()).issubset(set(s_ext))):
-            print(set(f_raw.dropna()) - set(s_ext))
-            print(s_ext)
-        assert set(f_raw.dropna()).issubset(set(s_ext))  # All states should map to an encoding
+    # Lookup table from (feature, state) pairs to the internal state index
+    states_long = feature_states.T.stack()
+    state_codes = states_long.groupby(level=0, sort=False).cumcount().to_numpy()
+    lookup = pd.MultiIndex.from_arrays([states_long.index.get_level_values(0), states_long.to_numpy()])
 
-        # Binarize features
-        f_applicable = ~f_enc.isna().to_numpy()
-        f_enc_applicable = f_enc[f_applicable].astype(int)
+    # Look up all non-NA feature values (in the order of the feature_states columns)
+    values = features_raw[feature_states.columns].to_numpy(dtype=object)
+    is_na = pd.isna(values)
+    site_idx, f_idx = np.nonzero(~is_na)
+    idx = lookup.get_indexer(pd.MultiIndex.from_arrays([feature_states.columns[f_idx], values[site_idx, f_idx]]))
 
-        features_bin[f_applicable, f_idx] = one_hot[f_enc_applicable]
+    # All states should map to an encoding
+    unknown = idx < 0
+    if np.any(unknown):
+        unknown_pairs = sorted(set(zip(feature_states.columns[f_idx[unknown]], values[site_idx[unknown], f_idx[unknown]])))
+        msg = ', '.join(f'{f}: {s}' for f, s in unknown_pairs)
+        raise ValueError(f'Invalid states (not defined in the feature states file): {msg}')
 
-        # Count NA
-        na_number += np.count_nonzero(f_enc.isna())
+    # Binarize features
+    features_bin = np.zeros((n_sites, n_features, n_states), dtype=bool)
+    features_bin[site_idx, f_idx, state_codes[idx]] = True
 
-    return features_bin.astype(bool), state_names, applicable_states, na_number
+    # Count NA
+    na_number = int(np.count_nonzero(is_na))
+
+    return features_bin, state_names, applicable_states, na_number
 
 
 def normalize_str(s):
+    import pandas as pd
+
     if pd.isna(s):
         return s
     return str.strip(s)
 
 
+def normalize_str_columns(df):
+    """Strip leading and trailing whitespace from all (string) values in a data frame,
+    using vectorized string operations per column.
+
+    Args:
+        df (pd.DataFrame): a data frame with string (or NA) values.
+    Returns:
+        pd.DataFrame: the normalized data frame.
+    """
+    return df.apply(lambda column: column.str.strip())
+
+
 def read_features_from_csv(file, feature_states_file):
     """This is a helper function to import data (sites, features, family membership,...) from a csv file
     Args:
@@ -352,8 +523,10 @@ def read_features_from_csv(file, feature_states_file):
         The language date including sites, site names, all features, feature names and state names per feature,
         as well as family membership and family names and log information
     """
+    import pandas as pd
+
     data = pd.read_csv(file, dtype=str)
-    data = data.applymap(normalize_str)
+    data = normalize_str_columns(data)
 
     try:
         x = data.pop('x')
@@ -366,7 +539,7 @@ def read_features_from_csv(file, feature_states_file):
 
     # Load the valid features-states
     feature_states = pd.read_csv(feature_states_file, dtype=str)
-    feature_states = feature_states.applymap(normalize_str)
+    feature_states = normalize_str_columns(feature_states)
     feature_names_ext = feature_states.columns.to_numpy()
 
     # Make sure the same features are specified in the data file and in the feature_states file
@@ -374,17 +547,11 @@ def read_features_from_csv(file, feature_states_file):
 
     # sites
     n_sites, n_features = data.shape
-    locations = np.zeros((n_sites, 2))
-    site_id = []
-
-    for i in range(n_sites):
-        # Define location tuples
-        locations[i, 0] = float(x[i])
-        locations[i, 1] = float(y[i])
+    locations = np.column_stack([x.astype(float), y.astype(float)])
 
-        # The order in the list maps name to id and id to name
-        # name could be any unique identifier, id is an integer from 0 to len(name)
-        site_id.append(i)
+    # The order in the list maps name to id and id to name
+    # name could be any unique identifier, id is an integer from 0 to len(name)
+    site_id = list(range(n_sites))
 
     sites = {'locations': locations,
              'id': site_id,
@@ -402,9 +569,9 @@ def read_features_from_csv(file, feature_states_file):
     family_names_ordered = np.unique(family.dropna()).tolist()
     n_families = len(family_names_ordered)
 
+    family_idx = pd.Categorical(family, categories=family_names_ordered).codes
     families = np.zeros((n_families, n_sites), dtype=int)
-    for fam in range(n_families):
-        families[fam, np.where(family == family_names_ordered[fam])] = 1
+    families[family_idx[family_idx >= 0], np.flatnonzero(family_idx >= 0)] = 1
 
     family_names = {'external': family_names_ordered,
                     'internal': list(range(n_families))}
@@ -414,18 +581,187 @@ def read_features_from_csv(file, feature_states_file):
     return sites, site_names, features, feature_names, state_names, applicable_states, families, family_names, log
 
 
-def read_costs_from_csv(file):
-    """This is a helper function to read the cost matrix from a csv file
+def get_site_order(site_ids, file_site_ids, file):
+    """Find the position of each site in a cost matrix file in the order of the sites in the data.
+
+    Args:
+        site_ids (list): the (external) site ids in the data
+        file_site_ids (list): the site ids in the order of the cost matrix file
+        file (str): the cost matrix file (for error messages)
+
+    Returns:
+        np.array: the index of each site of the file in the data
+    """
+    position = {s: i for i, s in enumerate(site_ids)}
+    missing = set(site_ids) - set(file_site_ids)
+    unknown = [s for s in file_site_ids if s not in position]
+    if missing or unknown or len(file_site_ids) != len(site_ids):
+        raise ValueError(f'The sites in the cost matrix {file} do not match the sites in the data '
+                         f'(missing: {sorted(missing)}, unknown: {unknown}).')
+    return np.array([position[s] for s in file_site_ids])
+
+
+def read_costs_from_csv(file, site_ids, chunk_size=1000):
+    """This is a helper function to read the cost matrix from a csv file (with site ids as index
+    and columns). The file is parsed in chunks of rows, with the costs read directly as numbers and
+    written to the matrix in the order of the sites in the data.
         Args:
             file (str): file location of the csv file
+            site_ids (list): the (external) site ids in the data
+            chunk_size (int): number of rows parsed at once
 
         Returns:
-            CHANGE
+            (np.array, str): the cost matrix and log information
+                shape (n_sites, n_sites)
         """
+    import pandas as pd
+
+    header = pd.read_csv(file, nrows=0).columns
+    index_name, file_site_ids = header[0], list(header[1:])
+    col_order = get_site_order(site_ids, file_site_ids, file)
+
+    n = len(site_ids)
+    position = {s: i for i, s in enumerate(site_ids)}
+    cost_matrix = np.empty((n, n))
+    rows_read = np.zeros(n, dtype=bool)
+
+    dtype = dict.fromkeys(file_site_ids, float)
+    dtype[index_name] = str
+    for chunk in pd.read_csv(file, index_col=0, dtype=dtype, chunksize=chunk_size):
+        row_order = np.array([position.get(s, -1) for s in chunk.index])
+        if np.any(row_order < 0):
+            raise ValueError(f'Unknown sites {list(chunk.index[row_order < 0])} in the cost matrix {file}.')
+        cost_matrix[row_order[:, np.newaxis], col_order[np.newaxis, :]] = chunk.to_numpy(dtype=float)
+        rows_read[row_order] = True
+
+    if not np.all(rows_read):
+        raise ValueError(f'The cost matrix {file} has no rows for the sites '
+                         f'{[site_ids[i] for i in np.flatnonzero(~rows_read)]}.')
 
-    data = pd.read_csv(file, dtype=str, index_col=0)
     log = f"Geographical cost matrix read from {file}."
-    return data, log
+    return cost_matrix, log
+
+
+def load_npz_member_mmap(file, name):
+    """Memory-map an array stored (uncompressed) in a .npz file. Arrays in compressed files
+    (np.savez_compressed) are loaded into memory.
+
+    Args:
+        file (str): the .npz file
+        name (str): the name of the array in the .npz file
+
+    Returns:
+        np.array: the (memory-mapped) array
+    """
+    import zipfile
+
+    read_header = {(1, 0): np.lib.format.read_array_header_1_0,
+                   (2, 0): np.lib.format.read_array_header_2_0}
+
+    with zipfile.ZipFile(file) as zf:
+        info = zf.getinfo(name + '.npy')
+        if info.compress_type == zipfile.ZIP_STORED:
+            with zf.open(info) as member:
+                version = np.lib.format.read_magic(member)
+
+        # Only uncompressed arrays with a header of version 1.0 or 2.0 can be memory-mapped
+        if info.compress_type != zipfile.ZIP_STORED or version not in read_header:
+            with zf.open(info) as member:
+                return np.lib.format.read_array(member)
+
+    with open(file, 'rb') as f:
+        # Skip the local file header of the zip member (30 bytes + file name + extra field)
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = np.frombuffer(f.read(4), dtype='<u2')
+        f.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+
+        # Read the header of the .npy file
+        np.lib.format.read_magic(f)
+        shape, fortran_order, dtype = read_header[version](f)
+        offset = f.tell()
+
+    return np.memmap(file, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def read_costs_from_binary(file, site_ids):
+    """This is a helper function to read the cost matrix from a binary numpy file. Costs in a
+    .npy file are ordered like the sites in the data. A .npz file contains the costs (`costs`)
+    and the ids of the sites in the order of the matrix (`site_ids`). The costs are memory-mapped
+    (for .npz files only if saved uncompressed with np.savez) and only copied if they have to be
+    reordered.
+        Args:
+            file (str): file location of the .npy or .npz file
+            site_ids (list): the (external) site ids in the data
+
+        Returns:
+            (np.array, str): the cost matrix and log information
+                shape (n_sites, n_sites)
+        """
+    n = len(site_ids)
+    log = f"Geographical cost matrix read from {file}"
+
+    if str(file).endswith('.npy'):
+        cost_matrix = np.load(file, mmap_mode='r')
+    else:
+        with np.load(file, allow_pickle=False) as npz:
+            file_site_ids = [str(s) for s in npz['site_ids']]
+        cost_matrix = load_npz_member_mmap(file, 'costs')
+
+        order = np.argsort(get_site_order(site_ids, file_site_ids, file))
+        if np.any(order != np.arange(n)):
+            cost_matrix = cost_matrix[np.ix_(order, order)]
+            log += " (reordered to match the sites in the data)"
+
+    if cost_matrix.shape != (n, n):
+        raise ValueError(f'The cost matrix in {file} has shape {cost_matrix.shape}, '
+                         f'but there are {n} sites.')
+
+    return cost_matrix, log + "."
+
+
+def is_symmetric(matrix, block_size=1000):
+    """Check whether a (possibly memory-mapped) square matrix is symmetric, comparing blocks of
+    the upper and lower triangle one at a time.
+
+    Args:
+        matrix (np.array): the matrix
+        block_size (int): number of rows and columns per block
+
+    Returns:
+        bool: whether the matrix is symmetric (up to floating point precision)
+    """
+    n = matrix.shape[0]
+    for i in range(0, n, block_size):
+        for j in range(i, n, block_size):
+            upper = matrix[i:i+block_size, j:j+block_size]
+            lower = matrix[j:j+block_size, i:i+block_size]
+            if not np.allclose(upper, lower.T):
+                return False
+    return True
+
+
+def symmetrize(matrix, block_size=1000):
+    """Make a square matrix symmetric by averaging the upper and lower triangle, one block at
+    a time. Read-only (e.g. memory-mapped) matrices are copied first.
+
+    Args:
+        matrix (np.array): the matrix
+        block_size (int): number of rows and columns per block
+
+    Returns:
+        np.array: the symmetric matrix
+    """
+    if not matrix.flags.writeable:
+        matrix = np.array(matrix)
+
+    n = matrix.shape[0]
+    for i in range(0, n, block_size):
+        for j in range(i, n, block_size):
+            mean = (matrix[i:i+block_size, j:j+block_size] + matrix[j:j+block_size, i:i+block_size].T) / 2
+            matrix[i:i+block_size, j:j+block_size] = mean
+            matrix[j:j+block_size, i:i+block_size] = mean.T
+    return matrix
 
 
 def write_languages_to_csv(features, sites, families, file):
@@ -503,6 +839,7 @@ def read_feature_occurrence_from_csv(file, feature_states_file):
             The occurrence of each feature, either as relative frequencies or counts, together with feature
             and category names
     """
+    import pandas as pd
 
     # Load data and feature states
     counts_raw = pd.read_csv(file, index_col='feature')
@@ -636,24 +973,6 @@ def mkpath(path):
         touch(path)
 
 
-def add_edge(edges, edge_nodes, coords, i, j):
-    """
-    Add an edge between the i-th and j-th points, if not in edges already
-    Args:
-        edges (set): set of edges
-        edge_nodes(list): coordinates of all nodes in all edges
-        coords(float, float): point coordinates of sites
-        i (int): i-th point
-        j (int): j-th point
-        """
-    if (i, j) in edges or (j, i) in edges:
-        # already added
-        return
-
-    edges.add((i, j))
-    edge_nodes.append(coords[[i, j]])
-
-
 def collect_gt_for_writing(samples, data, config):
 
     gt = dict()
@@ -1046,13 +1365,20 @@ def round_int(n, mode='up', offset=0):
     return n_rounded
 
 
-def colorline(ax, x, y, z=None, cmap=plt.get_cmap('copper'), norm=plt.Normalize(0.0, 1.0), linewidth=3, alpha=1.0):
+def colorline(ax, x, y, z=None, cmap=None, norm=None, linewidth=3, alpha=1.0):
     """
     Plot a colored line with coordinates x and y
     Optionally specify colors in the array z
-    Optionally specify a colormap, a norm function and a line width
+    Optionally specify a colormap (default: 'copper'), a norm function (default: [0,1]) and a line width
     from: https://nbviewer.jupyter.org/github/dpsanders/matplotlib-examples/blob/master/colorline.ipynb
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
+    if cmap is None:
+        cmap = plt.get_cmap('copper')
+    if norm is None:
+        norm = plt.Normalize(0.0, 1.0)
 
     # Default colors equally spaced on [0,1]:
     if z is None:
@@ -1151,32 +1477,30 @@ def assess_correlation_probabilities(p_universal, p_contact, p_inheritance, corr
             corr_th (float): correlation threshold
             include_universal (bool): Should p_universal also be checked for independence?
 
+        All probabilities can have an additional leading axis for a batch of candidate sets, which are
+        assessed at once.
+
+        Returns:
+            int or np.array: the number of correlated pairs of probability vectors (per candidate set)
         """
     if include_universal:
         if p_inheritance is not None:
-            samples = np.vstack((p_universal[np.newaxis, :, :], p_contact, p_inheritance))
+            samples = np.concatenate((p_universal[..., np.newaxis, :, :], p_contact, p_inheritance), axis=-3)
         else:
-            samples = np.vstack((p_universal[np.newaxis, :, :], p_contact))
+            samples = np.concatenate((p_universal[..., np.newaxis, :, :], p_contact), axis=-3)
     else:
         if p_inheritance is not None:
-            samples = np.vstack((p_contact, p_inheritance))
+            samples = np.concatenate((p_contact, p_inheritance), axis=-3)
         else:
             samples = p_contact
 
-    n_samples = samples.shape[0]
-    n_features = samples.shape[1]
+    n_samples = samples.shape[-3]
 
-    comb = list(combinations(list(range(n_samples)), 2))
-    correlated_probability_vectors = 0
+    # Probability of the same state for all pairs of probability vectors (Gram matrix per feature)
+    p_same_state = np.einsum('...ifk,...jfk->...fij', samples, samples)
+    i, j = np.triu_indices(n_samples, k=1)
 
-    for f in range(n_features):
-        for c in comb:
-            p0 = samples[c[0], f]
-            p1 = samples[c[1], f]
-            p_same_state = np.dot(p0, p1)
-            if p_same_state > corr_th:
-                correlated_probability_vectors += 1
-    return correlated_probability_vectors
+    return np.count_nonzero(p_same_state[..., i, j] > corr_th, axis=(-2, -1))
 
 
 def get_max_size_list(start, end, n_total, k_groups):
@@ -1291,6 +1615,8 @@ def sort_by_similarity(similarity_matrix):
     n, _ = similarity_matrix.shape
     assert n == _, 'Similarity matrix needs to be a square matrix.'
 
+    from fastcluster import linkage
+
     max_sim = np.max(similarity_matrix)
     dendrogram = linkage(max_sim-similarity_matrix, method='ward', preserve_input=True)
     order = seriation(dendrogram, n, 2 * n - 2)
@@ -1299,6 +1625,8 @@ def sort_by_similarity(similarity_matrix):
 
 
 def plot_similarity_matrix(similarities, names, show_similarity_overlay=False):
+    import matplotlib.pyplot as plt
+
     n = len(similarities)
 
     order = sort_by_similarity(similarities)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+
+from sbayes.tools.benchmark import SyntheticData, compare_results, iter_timings, run_benchmarks
+
+
+class TestBenchmark(unittest.TestCase):
+
+    """Test the synthetic data and a (very short) run of the benchmarks."""
+
+    PARAMS = {'n_sites': 40, 'n_features': 6, 'n_states': 3, 'n_areas': 2, 'n_families': 2}
+
+    def test_synthetic_data(self):
+        data = SyntheticData(**self.PARAMS, seed=1)
+        self.assertEqual(data.features.shape, (40, 6, 3))
+        self.assertEqual(data.states.shape, (6, 3))
+        self.assertEqual(data.families.shape, (2, 40))
+        self.assertEqual(data.network['n'], 40)
+        self.assertGreater(data.time_network, 0)
+
+        # Areas are disjoint and sites belong to at most one family
+        self.assertTrue(np.all(np.sum(data.areas, axis=0) <= 1))
+        self.assertTrue(np.all(np.sum(data.families, axis=0) <= 1))
+
+        # The data set is reproducible
+        np.testing.assert_array_equal(data.features, SyntheticData(**self.PARAMS, seed=1).features)
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(self.PARAMS, n_repeat=2, n_steps=3, n_samples=5)
+        self.assertEqual(set(results['operators']),
+                         {'shrink_zone', 'grow_zone', 'swap_zone', 'gibbs_sample_sources',
+                          'gibbs_sample_weights', 'gibbs_sample_p_global', 'gibbs_sample_p_zones',
+                          'gibbs_sample_p_families'})
+        self.assertIn('p_families', results['prior'])
+        self.assertIn('match_areas', results['postprocessing'])
+
+        timings = dict(iter_timings(results))
+        self.assertIn(('likelihood', 'zones'), timings)
+        self.assertTrue(all(t >= 0 for t in timings.values()))
+
+        # Comparing a run to itself gives a ratio of 1 for all benchmarks
+        rows = compare_results({'results': {'small': results}}, {'results': {'small': results}})
+        self.assertEqual(len(rows), len(timings))
+        self.assertTrue(all(ratio == 1 for *_, ratio in rows if not np.isnan(ratio)))
+
+
+if __name__ == '__main__':
+    unittest.main()
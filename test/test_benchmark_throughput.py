@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import tempfile
+import unittest
+
+import numpy as np
+
+from sbayes.tools.benchmark_throughput import (PHASES, build_jobs, effective_sample_size,
+                                               mcmc_settings, run_job)
+
+
+class TestBenchmarkThroughput(unittest.TestCase):
+
+    """Test the ESS estimator and a (very short) end-to-end job on synthetic data."""
+
+    def test_effective_sample_size(self):
+        rng = np.random.default_rng(0)
+        n = 10000
+
+        # Independent samples: ESS close to n
+        self.assertAlmostEqual(effective_sample_size(rng.normal(size=n)) / n, 1., delta=0.1)
+
+        # AR(1) chain: ESS close to n * (1 - phi) / (1 + phi)
+        phi = 0.8
+        x = np.zeros(n)
+        noise = rng.normal(size=n)
+        for i in range(1, n):
+            x[i] = phi * x[i - 1] + noise[i]
+        expected = n * (1 - phi) / (1 + phi)
+        self.assertAlmostEqual(effective_sample_size(x) / expected, 1., delta=0.25)
+
+        self.assertTrue(np.isnan(effective_sample_size(np.ones(100))))
+
+    def test_run_job(self):
+        settings = mcmc_settings(n_steps=40, n_samples=10, n_warm_up_steps=10, n_warm_up_chains=2)
+        with tempfile.TemporaryDirectory() as results_path:
+            jobs = build_jobs([], scales=[0.5], scaling=False, sites_factors=[], features_factors=[],
+                              settings=settings, results_path=results_path)
+            self.assertEqual([job['name'] for job in jobs], ['synthetic_0.5x'])
+
+            result = run_job(jobs[0])
+
+        self.assertEqual(result['n_sites'], 50)
+        self.assertEqual(result['n_samples'], 10)
+        self.assertEqual(list(result['times']), PHASES)
+        self.assertGreater(result['times']['network'], 0)
+        self.assertGreaterEqual(result['times']['load'], 0)
+        self.assertGreater(result['steps_per_second'], 0)
+        self.assertGreater(result['peak_rss_mb'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
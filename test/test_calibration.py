@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from sbayes.tools.calibration import compute_ranks, draw_area_from_prior, run_calibration
+
+
+class TestCalibration(unittest.TestCase):
+
+    """Test the simulation-based calibration of the sampler."""
+
+    def test_ranks_are_uniform(self):
+        # True values drawn from the same distribution as the samples have uniform ranks
+        n_samples = 9
+        samples = np.random.random((n_samples, 20000))
+        ranks = compute_ranks(np.random.random(20000), samples)
+        counts = np.bincount(ranks, minlength=n_samples + 1)
+        self.assertTrue(np.allclose(counts / 20000, 1 / (n_samples + 1), atol=0.01))
+
+        # ... also for binary parameters, where ties are broken at random
+        samples = np.random.random((n_samples, 20000)) < 0.3
+        ranks = compute_ranks(np.random.random(20000) < 0.3, samples)
+        counts = np.bincount(ranks, minlength=n_samples + 1)
+        self.assertTrue(np.allclose(counts / 20000, 1 / (n_samples + 1), atol=0.01))
+
+    def test_draw_area(self):
+        sizes = [np.sum(draw_area_from_prior(50, 3, 10, 'uniform')) for _ in range(2000)]
+        self.assertEqual(min(sizes), 3)
+        self.assertEqual(max(sizes), 10)
+
+        # Without a size prior, large areas are much more likely (there are more of them)
+        sizes = [np.sum(draw_area_from_prior(50, 3, 10, 'none')) for _ in range(200)]
+        self.assertGreater(np.mean(sizes), 8)
+
+    def test_run_calibration(self):
+        with tempfile.TemporaryDirectory() as results_dir:
+            settings = {
+                'simulation': {'N_FEATURES': 5, 'I_CONTACT': 3, 'E_CONTACT': 0.5, 'STRENGTH': 0, 'AREA': 3},
+                'mcmc': {'N_STEPS': 40, 'N_SAMPLES': 20,
+                         'WARM_UP': {'N_WARM_UP_STEPS': 5, 'N_WARM_UP_CHAINS': 2}},
+                'results': {'RESULTS_PATH': results_dir}
+            }
+            histograms = run_calibration(Path('experiments/simulation/sim_exp1/config.json'),
+                                         n_replicates=2, custom_settings=settings, n_bins=7)
+
+            self.assertEqual(set(histograms['parameter']), {'area', 'weights', 'p_universal', 'p_contact'})
+            self.assertTrue(np.allclose(histograms.groupby('parameter')['count'].sum(),
+                                        histograms.groupby('parameter')['expected'].sum()))
+            self.assertTrue((Path(results_dir) / 'calibration' / 'histograms.csv').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
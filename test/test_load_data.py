@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+from sbayes import load_data
+from sbayes.load_data import Data
+
+BALKAN_FEATURES = Path(__file__).parent.parent / 'experiments/balkan/data/features'
+
+
+class TestFeaturesCache(unittest.TestCase):
+
+    """Test caching the preprocessed features (data.CACHE)."""
+
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        shutil.copytree(BALKAN_FEATURES, self.tmp_dir / 'features')
+        self.config = {'data': {'FEATURES': str(self.tmp_dir / 'features/features.csv'),
+                                'FEATURE_STATES': str(self.tmp_dir / 'features/feature_states.csv'),
+                                'CACHE': True}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def load_data(self):
+        experiment = SimpleNamespace(path_results=self.tmp_dir, experiment_name='test', config=self.config)
+        data = Data(experiment)
+        data.load_features()
+        return data
+
+    def cache_dirs(self):
+        return sorted((self.tmp_dir / 'features/.sbayes_cache').iterdir())
+
+    def test_read_cache(self):
+        data = self.load_data()
+        cached = self.load_data()
+        self.assertIn('loaded from cache', cached.log_load_features)
+        np.testing.assert_array_equal(cached.features, data.features)
+        np.testing.assert_array_equal(cached.na_features, data.na_features)
+        np.testing.assert_array_equal(cached.network['dist_mat'], data.network['dist_mat'])
+
+    def test_time_network(self):
+        data = self.load_data()
+        cached = self.load_data()
+
+        # Restoring the network from the cache is timed as well
+        self.assertGreater(data.time_network, 0)
+        self.assertGreater(cached.time_network, 0)
+
+    def test_cache_permissions(self):
+        self.load_data()
+        umask = os.umask(0)
+        os.umask(umask)
+        cache_dir, = self.cache_dirs()
+        self.assertEqual(cache_dir.stat().st_mode & 0o777, 0o777 & ~umask)
+
+    def test_cache_version(self):
+        self.load_data()
+        with mock.patch.object(load_data, 'CACHE_VERSION', load_data.CACHE_VERSION + 1):
+            data = self.load_data()
+        self.assertNotIn('loaded from cache', data.log_load_features)
+        self.assertEqual(len(self.cache_dirs()), 2)
+
+    def test_cache_without_na_features(self):
+        # Caches written before the NA mask was cached
+        data = self.load_data()
+        cache_dir, = self.cache_dirs()
+        (cache_dir / 'na_features.npy').unlink()
+
+        cached = self.load_data()
+        self.assertIn('loaded from cache', cached.log_load_features)
+        np.testing.assert_array_equal(cached.na_features, data.na_features)
+
+    def test_features_memmap(self):
+        self.config['data']['CACHE'] = False
+        self.config['data']['FEATURES_MEMMAP'] = True
+        data = self.load_data()
+        self.assertIsInstance(data.features, np.memmap)
+        self.assertIsInstance(data.na_features, np.memmap)
+
+        # The files are named by their content and never rewritten
+        files = self.cache_dirs()
+        self.assertEqual(len(files), 2)
+        mtimes = [f.stat().st_mtime_ns for f in files]
+        other = self.load_data()
+        self.assertEqual([f.stat().st_mtime_ns for f in self.cache_dirs()], mtimes)
+        np.testing.assert_array_equal(other.features, data.features)
+
+
+if __name__ == '__main__':
+    unittest.main()
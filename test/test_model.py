@@ -2,10 +2,21 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 from collections import namedtuple
+from copy import copy
+import tempfile
 import unittest
+from pathlib import Path
+from types import SimpleNamespace
 
-from sbayes.model import Likelihood
+from scipy.sparse import issparse, save_npz
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial.distance import cdist
+
+from sbayes.model import (GeoPrior, Likelihood, Model, PFamiliesPrior,
+                          compute_feature_log_likelihood_batch, geo_prior_distance, sparse_mst_distances)
+from sbayes.preprocessing import read_geo_cost_matrix
 from sbayes.sampling.zone_sampling import Sample
+from sbayes.util import dirichlet_logpdf, scale_counts, sparse_cost_matrix
 
 
 def binary_encoding(data, n_categories=None):
@@ -91,6 +102,245 @@ class TestLikelihood(unittest.TestCase):
 
         self.assertAlmostEqual(lh_with_family, lh_direct)
 
+    def test_batch_likelihood(self):
+        N_SITES = 12
+        N_FEATURES = 4
+        N_CATEGORIES = 3
+        N_BATCH = 3
+
+        features = generate_features((N_SITES, N_FEATURES), N_CATEGORIES)
+        families = np.zeros((2, N_SITES), dtype=bool)
+        families[0, :4] = families[1, 6:9] = True
+
+        # Dummy ´Data´ class to pass features and families to the likelihood
+        Data = namedtuple('Data', ['features', 'families'])
+        data = Data(features=features, families=families)
+
+        samples = []
+        for _ in range(N_BATCH):
+            # Two disjoint areas
+            area_labels = np.random.randint(-1, 2, size=N_SITES)
+            areas = area_labels[np.newaxis, :] == np.arange(2)[:, np.newaxis]
+            samples.append(Sample(zones=areas,
+                                  weights=np.random.dirichlet(np.ones(3), size=N_FEATURES),
+                                  p_global=np.random.dirichlet(np.ones(N_CATEGORIES), size=(1, N_FEATURES)),
+                                  p_zones=np.random.dirichlet(np.ones(N_CATEGORIES), size=(2, N_FEATURES)),
+                                  p_families=np.random.dirichlet(np.ones(N_CATEGORIES), size=(2, N_FEATURES))))
+
+        # Evaluate all features of all samples in one batch
+        all_features = np.tile(np.arange(N_FEATURES), (N_BATCH, 1))
+        na_features = (np.sum(features, axis=-1) == 0)
+        lh_batch = compute_feature_log_likelihood_batch(
+            features=features[:, all_features, :].transpose((1, 2, 0, 3)),
+            na_features=na_features[:, all_features].transpose((1, 2, 0)),
+            families=families,
+            zones=np.array([s.zones for s in samples]),
+            weights=np.array([s.weights for s in samples]),
+            p_global=np.array([s.p_global[0] for s in samples]),
+            p_zones=np.array([s.p_zones for s in samples]).transpose((0, 2, 1, 3)),
+            p_families=np.array([s.p_families for s in samples]).transpose((0, 2, 1, 3))
+        )
+
+        for i, sample in enumerate(samples):
+            likelihood = Likelihood(data=data, inheritance=True)
+            self.assertAlmostEqual(np.sum(lh_batch[i]), likelihood(sample, caching=False))
+
+
+class TestGeoPrior(unittest.TestCase):
+
+    """Test the cost-based geo-prior with dense and sparse cost matrices."""
+
+    def test_sparse_cost_matrix(self):
+        N_SITES = 30
+
+        locations = np.random.random((N_SITES, 2))
+        costs = cdist(locations, locations)
+        zones = np.zeros((1, N_SITES), dtype=bool)
+        zones[0, np.random.choice(N_SITES, size=8, replace=False)] = True
+        dense_prior = geo_prior_distance(zones, costs, scale=0.5)
+
+        # With all neighbours, the sparse cost matrix is equivalent to the dense one
+        sparse_costs = sparse_cost_matrix(costs, locations, graph='knn', k=N_SITES)
+        assert sparse_costs.nnz == N_SITES * (N_SITES - 1)
+        np.testing.assert_allclose(geo_prior_distance(zones, sparse_costs, scale=0.5), dense_prior)
+
+        # Zones which are not connected in a sparse graph fall back to the dense costs
+        sparse_costs = sparse_cost_matrix(costs, locations, graph='knn', k=1)
+        np.testing.assert_allclose(geo_prior_distance(zones, sparse_costs, scale=0.5, fallback_costs=costs),
+                                   dense_prior)
+
+        # Delaunay neighbours (the MST can only get longer on a subgraph)
+        sparse_costs = sparse_cost_matrix(costs, locations, graph='delaunay')
+        assert geo_prior_distance(zones, sparse_costs, scale=0.5, fallback_costs=costs) <= dense_prior
+
+    def test_fallback_costs(self):
+        N_SITES = 30
+
+        # Costs in other units than the distances between the locations (with the same order)
+        locations = np.random.random((N_SITES, 2))
+        costs = 100. * cdist(locations, locations) ** 2
+        zones = np.zeros((1, N_SITES), dtype=bool)
+        zones[0, np.random.choice(N_SITES, size=8, replace=False)] = True
+        dense_prior = geo_prior_distance(zones, costs, scale=0.5)
+
+        # The components are connected by the (memory-mapped) dense costs
+        with tempfile.TemporaryDirectory() as directory:
+            np.save(Path(directory) / 'costs.npy', costs)
+            costs_mmap = np.load(Path(directory) / 'costs.npy', mmap_mode='r')
+            sparse_costs = sparse_cost_matrix(costs_mmap, locations, graph='knn', k=1)
+            sparse_prior = geo_prior_distance(zones, sparse_costs, scale=0.5, fallback_costs=costs_mmap)
+            del costs_mmap
+        np.testing.assert_allclose(sparse_prior, dense_prior)
+
+    def test_sparse_only_costs(self):
+        N_SITES = 30
+        rng = np.random.default_rng(4)
+
+        # Non-Euclidean costs, only given between Delaunay neighbours (in a sparse .npz file)
+        locations = rng.random((N_SITES, 2))
+        noise = rng.random((N_SITES, N_SITES))
+        costs = 100. * cdist(locations, locations) ** 2 + noise + noise.T
+        site_names = {'external': [f'site_{i}' for i in range(N_SITES)], 'internal': list(range(N_SITES))}
+        with tempfile.TemporaryDirectory() as directory:
+            save_npz(Path(directory) / 'costs.npz', sparse_cost_matrix(costs, locations, graph='delaunay'))
+            sparse_costs, _ = read_geo_cost_matrix(site_names, Path(directory) / 'costs.npz')
+        assert issparse(sparse_costs)
+
+        # A zone which is not connected in the sparse graph
+        zones = np.zeros((1, N_SITES), dtype=bool)
+        zones[0, rng.choice(N_SITES, size=8, replace=False)] = True
+        assert connected_components(sparse_costs[zones[0]][:, zones[0]], directed=False)[0] > 1
+
+        # The components are connected by the shortest paths in the sparse cost matrix
+        data = SimpleNamespace(states=None, geo_prior={'cost_matrix': sparse_costs},
+                               network={'dist_mat': cdist(locations, locations), 'locations': locations})
+        geo_prior = GeoPrior({'type': 'cost_based', 'scale': 0.5}, data)
+        sample = SimpleNamespace(zones=zones, what_changed={'prior': {'zones': True}})
+        shortest_paths = dijkstra(sparse_costs, directed=False)
+        np.testing.assert_allclose(geo_prior(sample),
+                                   geo_prior_distance(zones, sparse_costs, scale=0.5, fallback_costs=shortest_paths))
+
+        # ... in the units of the costs
+        idx = np.flatnonzero(zones[0])
+        np.testing.assert_allclose(np.sort(sparse_mst_distances(1000. * sparse_costs, idx)),
+                                   1000. * np.sort(sparse_mst_distances(sparse_costs, idx)))
+
+        # Zones which can not be connected in the sparse cost matrix are rejected (isolated site)
+        isolated = sparse_costs.tolil()
+        isolated[idx[0], :] = 0.
+        isolated[:, idx[0]] = 0.
+        isolated = isolated.tocsr()
+        isolated.eliminate_zeros()
+        with self.assertRaises(ValueError):
+            sparse_mst_distances(isolated, idx)
+
+
+class TestModel(unittest.TestCase):
+
+    """Test the model shared by several chains."""
+
+    def test_model_copy(self):
+        N_SITES = 10
+        N_FEATURES = 5
+        N_CATEGORIES = 3
+
+        features = generate_features((N_SITES, N_FEATURES), N_CATEGORIES)
+        families = np.zeros((1, N_SITES), dtype=bool)
+        families[0, :4] = True
+        counts = np.random.randint(0, 20, size=(N_FEATURES, N_CATEGORIES)).astype(float)
+
+        # Dummy ´Data´ class providing the attributes used by the likelihood and the prior
+        Data = namedtuple('Data', ['features', 'families', 'states', 'network', 'prior_universal'])
+        data = Data(features=features, families=families,
+                    states=np.ones((N_FEATURES, N_CATEGORIES), dtype=bool), network={},
+                    prior_universal={'counts': counts.copy()})
+
+        config = {'N_AREAS': 1, 'MIN_M': 3, 'MAX_M': 5, 'INHERITANCE': True, 'SAMPLE_SOURCE': False,
+                  'PRIOR': {'geo': {'type': 'uniform'},
+                            'area_size': {'type': 'none'},
+                            'weights': {'type': 'uniform'},
+                            'universal': {'type': 'counts', 'scale_counts': 10},
+                            'inheritance': {'type': 'universal', 'scale_counts': 5},
+                            'contact': {'type': 'uniform'}}}
+        model = Model(data=data, config=config)
+        chain_models = [copy(model) for _ in range(3)]
+
+        # The counts in the data are not changed by scaling or copying
+        np.testing.assert_array_equal(data.prior_universal['counts'], counts)
+
+        # Constants are shared, caches are separate
+        sample = Sample(zones=np.zeros((1, N_SITES), dtype=bool),
+                        weights=broadcast_weights([0.4, 0.3, 0.3], N_FEATURES),
+                        p_global=np.random.dirichlet(np.ones(N_CATEGORIES), size=(1, N_FEATURES)),
+                        p_zones=np.random.dirichlet(np.ones(N_CATEGORIES), size=(1, N_FEATURES)),
+                        p_families=np.random.dirichlet(np.ones(N_CATEGORIES), size=(1, N_FEATURES)))
+        chain_models[0](sample.copy())
+        for m in chain_models:
+            self.assertIs(m.prior.prior_p_global.dirichlet, model.prior.prior_p_global.dirichlet)
+            self.assertIs(m.likelihood.features, model.likelihood.features)
+        self.assertIsNotNone(chain_models[0].likelihood.all_lh)
+        self.assertIsNone(chain_models[1].likelihood.all_lh)
+        self.assertIsNone(chain_models[1].prior.prior_p_families.prior_p_families_distr)
+
+        # All copies evaluate to the same posterior
+        posteriors = [m(sample.copy()) for m in chain_models]
+        self.assertAlmostEqual(posteriors[0], posteriors[1])
+        self.assertAlmostEqual(posteriors[0], model(sample.copy()))
+
+
+class TestPFamiliesPrior(unittest.TestCase):
+
+    """Test the prior on the probabilities in families."""
+
+    def test_counts_and_universal(self):
+        N_FAMILIES = 2
+        N_FEATURES = 4
+        N_CATEGORIES = 3
+        STRENGTH = 5
+
+        features = generate_features((10, N_FEATURES), N_CATEGORIES)
+        families = np.zeros((N_FAMILIES, 10), dtype=bool)
+        families[0, :4] = True
+        families[1, 4:8] = True
+        states = np.ones((N_FEATURES, N_CATEGORIES), dtype=bool)
+        states[0, 2] = False
+        counts = np.random.randint(0, 20, size=(N_FAMILIES, N_FEATURES, N_CATEGORIES)).astype(float)
+        counts[:, 0, 2] = 0
+
+        Data = namedtuple('Data', ['features', 'families', 'states', 'prior_inheritance'])
+        data = Data(features=features, families=families, states=states,
+                    prior_inheritance={'counts': counts.copy()})
+        prior = PFamiliesPrior(config={'type': 'counts_and_universal', 'scale_counts': STRENGTH}, data=data)
+
+        def expected_prior(sample):
+            # Dirichlet with the (scaled) family counts and the universal probabilities as pseudocounts
+            alpha = 1. + scale_counts(counts, STRENGTH, prior_inheritance=True) + STRENGTH * sample.p_global[0]
+            return sum(dirichlet_logpdf(x=sample.p_families[fam, f, states[f]],
+                                        alpha=alpha[fam, f, states[f]] + 1.)
+                       for fam in range(N_FAMILIES) for f in range(N_FEATURES))
+
+        def random_p(size):
+            p = np.random.dirichlet(np.ones(N_CATEGORIES), size=size)
+            p[..., 0, 2] = 0
+            return p / np.sum(p, axis=-1, keepdims=True)
+
+        sample = Sample(zones=np.zeros((1, 10), dtype=bool),
+                        weights=broadcast_weights([0.4, 0.3, 0.3], N_FEATURES),
+                        p_global=random_p((1, N_FEATURES)), p_zones=random_p((1, N_FEATURES)),
+                        p_families=random_p((N_FAMILIES, N_FEATURES)))
+        self.assertAlmostEqual(prior(sample), expected_prior(sample))
+
+        # The prior is updated when p_global changes
+        sample.everything_changed()
+        sample.what_changed['prior']['p_global'].clear()
+        sample.what_changed['prior']['p_families'].clear()
+        sample.p_global[0, 1] = random_p((1, N_FEATURES))[0, 1]
+        sample.what_changed['prior']['p_global'].add(1)
+        self.assertAlmostEqual(prior(sample), expected_prior(sample))
+
+        # The counts in the data are not changed
+        np.testing.assert_array_equal(data.prior_inheritance['counts'], counts)
+
 
 if __name__ == '__main__':
     unittest.main()
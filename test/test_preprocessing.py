@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+
+import numpy as np
+
+from sbayes.preprocessing import simulate_features
+
+
+class TestSimulateFeatures(unittest.TestCase):
+
+    """Test the simulated features against the likelihood of the model."""
+
+    def setUp(self):
+        np.random.seed(1)
+        n_per_group = 4000
+        n_features, n_states = 4, 3
+
+        # Four groups of sites: no area or family, area 0, family 0, area 1 and family 0
+        group_areas = np.array([[0, 0], [1, 0], [0, 0], [0, 1]], dtype=bool)
+        group_families = np.array([[0], [0], [1], [1]], dtype=bool)
+        self.group = np.repeat(np.arange(4), n_per_group)
+        self.areas = group_areas[self.group].T
+        self.families = group_families[self.group].T
+
+        self.p_universal = np.random.dirichlet(np.ones(n_states), size=n_features)
+        self.p_contact = np.random.dirichlet(np.ones(n_states), size=(2, n_features))
+        self.p_inheritance = np.random.dirichlet(np.ones(n_states), size=(1, n_features))
+        self.weights = np.random.dirichlet(np.ones(3), size=n_features)
+
+        # The likelihood of each group: mixture of the relevant components with normalized weights
+        w_u, w_c, w_i = self.weights.T[..., np.newaxis]
+        self.likelihood = [
+            self.p_universal,
+            (w_u * self.p_universal + w_c * self.p_contact[0]) / (w_u + w_c),
+            (w_u * self.p_universal + w_i * self.p_inheritance[0]) / (w_u + w_i),
+            (w_u * self.p_universal + w_c * self.p_contact[1] + w_i * self.p_inheritance[0])
+        ]
+
+    def simulate(self, one_hot=True):
+        return simulate_features(self.areas, p_universal=self.p_universal, p_contact=self.p_contact,
+                                 weights=self.weights, inheritance=True, p_inheritance=self.p_inheritance,
+                                 families=self.families, one_hot=one_hot)
+
+    def test_frequencies(self):
+        features, applicable_states, _, state_names = self.simulate()
+        self.assertEqual(features.shape, (len(self.group), 4, 3))
+        np.testing.assert_array_equal(features.sum(axis=-1), 1)
+        np.testing.assert_array_equal(applicable_states, self.p_universal > 0)
+
+        # The state frequencies in each group match the likelihood
+        for g, likelihood in enumerate(self.likelihood):
+            frequencies = features[self.group == g].mean(axis=0)
+            np.testing.assert_allclose(frequencies, likelihood, atol=0.03)
+
+        # The state names list the observed states
+        for f, names in enumerate(state_names['external']):
+            self.assertEqual(names, np.flatnonzero(features[:, f].any(axis=0)).tolist())
+
+    def test_state_indices(self):
+        np.random.seed(2)
+        features, *_ = self.simulate(one_hot=True)
+        np.random.seed(2)
+        states, *_ = self.simulate(one_hot=False)
+
+        self.assertEqual(states.shape, (len(self.group), 4))
+        np.testing.assert_array_equal(states, np.argmax(features, axis=-1))
+
+
+if __name__ == '__main__':
+    unittest.main()
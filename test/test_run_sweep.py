@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import tempfile
+import unittest
+from pathlib import Path
+
+from sbayes.tools.run_sweep import build_cells, cell_name, grid_settings, is_done, run_sweep
+
+
+class TestRunSweep(unittest.TestCase):
+
+    """Test running a small simulation study over a grid of settings."""
+
+    CONFIG = Path('experiments/simulation/sim_exp1/config.json')
+
+    def setUp(self):
+        self.results_dir = tempfile.TemporaryDirectory()
+        self.grid = {
+            'simulation': {
+                'STRENGTH': [{'STRENGTH': 0, 'I_CONTACT': 3, 'E_CONTACT': 0.5}],
+                'AREA': [3, 4],
+                'N_FEATURES': [5]
+            },
+            'mcmc': {
+                'N_STEPS': [40],
+                'N_SAMPLES': [20],
+                'WARM_UP': [{'WARM_UP': {'N_WARM_UP_STEPS': 5, 'N_WARM_UP_CHAINS': 2}}]
+            },
+            'results': {
+                'RESULTS_PATH': [self.results_dir.name]
+            }
+        }
+
+    def tearDown(self):
+        self.results_dir.cleanup()
+
+    def test_grid_settings(self):
+        settings = grid_settings(self.grid)
+        self.assertEqual(len(settings), 2)
+        self.assertEqual([s['simulation']['AREA'] for s in settings], [3, 4])
+        self.assertEqual(settings[0]['simulation']['I_CONTACT'], 3)
+        self.assertEqual(settings[0]['mcmc']['WARM_UP']['N_WARM_UP_CHAINS'], 2)
+
+    def test_seeds(self):
+        cells = build_cells(self.CONFIG, self.grid, n_runs=2)
+        self.assertEqual(len(cells), 4)
+
+        # Runs of a setting share the simulated data, but not the sampler seed
+        self.assertEqual(cells[0]['data_seed'], cells[1]['data_seed'])
+        self.assertNotEqual(cells[0]['mcmc_seed'], cells[1]['mcmc_seed'])
+        self.assertNotEqual(cells[0]['data_seed'], cells[2]['data_seed'])
+
+        # Cells are reproducible
+        self.assertEqual(cells, build_cells(self.CONFIG, self.grid, n_runs=2))
+
+    def test_run_sweep(self):
+        failed = run_sweep(self.CONFIG, self.grid, n_runs=2, n_jobs=2)
+        self.assertEqual(failed, [])
+
+        # Finished cells are skipped when the sweep is restarted
+        cells = build_cells(self.CONFIG, self.grid, n_runs=2)
+        self.assertTrue(all(is_done(self.CONFIG, cell) for cell in cells))
+
+        # Each run has its own results directory (settings, log and results)
+        for cell in cells:
+            path_results = Path(self.results_dir.name) / cell_name(cell)
+            self.assertTrue((path_results / 'settings.json').exists())
+            self.assertTrue((path_results / 'experiment.log').exists())
+            with open(path_results / 'experiment.log') as f:
+                self.assertEqual(f.read().count('Experiment: '), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
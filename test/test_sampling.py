@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+
+from sbayes.sampling.mcmc_generative import MCMCGenerative
+from sbayes.sampling.zone_sampling import Sample, ZoneMCMC
+
+
+def operator(name):
+    """A dummy operator with the given name."""
+    def op(sample):
+        return sample
+    op.__name__ = name
+    return op
+
+
+def sampler_with_statistics(operator_stats):
+    """A sampler (without model or data) with given weights, acceptance and time per operator.
+
+    Args:
+        operator_stats (dict): operator name -> (weight, accepted steps, total steps, time).
+    """
+    sampler = ZoneMCMC.__new__(ZoneMCMC)
+    sampler.fn_operators = [operator(name) for name in operator_stats]
+    sampler.p_operators = [w for w, *_ in operator_stats.values()]
+    sampler.statistics = {'accept_operator': defaultdict(int), 'reject_operator': defaultdict(int),
+                          'time_proposal': defaultdict(float), 'time_likelihood': defaultdict(float),
+                          'time_prior': defaultdict(float), 'cache_usage': {}}
+    for name, (_, accepted, total, time) in operator_stats.items():
+        sampler.statistics['accept_operator'][name] = accepted
+        sampler.statistics['reject_operator'][name] = total - accepted
+        sampler.statistics['time_likelihood'][name] = time
+    return sampler
+
+
+class TestTuneOperatorWeights(unittest.TestCase):
+
+    """Test the adaptation of the operator weights to the warm-up statistics."""
+
+    def test_blocks_keep_their_weight(self):
+        sampler = sampler_with_statistics({
+            'shrink_zone': (0.04, 100, 1000, 2.),
+            'grow_zone': (0.04, 100, 1000, 2.),
+            'swap_zone': (0.02, 10, 1000, 4.),
+            # Cheap, always accepted Gibbs steps and a cheap MH step on the weights
+            'gibbs_sample_sources': (0.2, 1000, 1000, 0.1),
+            'gibbs_sample_p_zones': (0.3, 1000, 1000, 0.1),
+            'alter_weights': (0.4, 900, 1000, 0.1)
+        })
+        weights = sampler.tune_operator_weights(max_factor=4.)
+
+        self.assertAlmostEqual(sum(weights.values()), 1.)
+
+        # The area operators keep their total weight ...
+        area_weight = weights['shrink_zone'] + weights['grow_zone'] + weights['swap_zone']
+        self.assertAlmostEqual(area_weight, 0.1)
+
+        # ... and the less efficient swap operator loses weight (by at most max_factor)
+        self.assertLess(weights['swap_zone'], 0.02)
+        self.assertGreaterEqual(weights['swap_zone'] / weights['grow_zone'], 0.5 / 4 ** 2)
+        self.assertAlmostEqual(weights['shrink_zone'], weights['grow_zone'])
+
+        # Operators which are alone in their block (or Gibbs steps) keep their weight
+        for name, w in [('gibbs_sample_sources', 0.2), ('gibbs_sample_p_zones', 0.3), ('alter_weights', 0.4)]:
+            self.assertAlmostEqual(weights[name], w)
+
+    def test_unused_and_always_accepted_operators(self):
+        sampler = sampler_with_statistics({
+            'shrink_zone': (0.25, 500, 500, 1.),
+            'grow_zone': (0.25, 100, 1000, 1.),
+            'swap_zone': (0.25, 0, 0, 0.),
+            'alter_p_global': (0.25, 100, 1000, 1.)
+        })
+        weights = sampler.tune_operator_weights()
+
+        # Only one area operator is tuned (shrink is always accepted, swap was never used)
+        np.testing.assert_allclose(list(weights.values()), [0.25] * 4)
+
+    def test_operator_block(self):
+        self.assertEqual(ZoneMCMC.operator_block('swap_zone'), 'area')
+        self.assertEqual(ZoneMCMC.operator_block('gibbsish_sample_zones'), 'area')
+        self.assertEqual(ZoneMCMC.operator_block('alter_p_zones'), 'p_zones')
+        self.assertEqual(ZoneMCMC.operator_block('gibbs_sample_p_zones'), 'p_zones')
+
+
+class TestBatchChains(unittest.TestCase):
+
+    """Test that batching the chains is only possible for samplers with a batched likelihood."""
+
+    class UnbatchedSampler(MCMCGenerative):
+
+        def generate_initial_sample(self, c=0):
+            pass
+
+        def get_operators(self, operators):
+            return [], []
+
+    def test_batch_chains_not_supported(self):
+        self.UnbatchedSampler(model=None, data=None, operators={}, n_chains=2)
+        with self.assertRaises(ValueError):
+            self.UnbatchedSampler(model=None, data=None, operators={}, n_chains=2, batch_chains=True)
+
+
+class TestGibbsSamplePGlobalBatch(unittest.TestCase):
+
+    """Test that the batched Gibbs step on p_global only reports the resampled features."""
+
+    def test_changed_features(self):
+        np.random.seed(3)
+        n_sites, n_features, n_states, n_chains = 30, 20, 3, 4
+
+        sampler = ZoneMCMC.__new__(ZoneMCMC)
+        sampler.n_features = n_features
+        sampler.features = np.eye(n_states)[np.random.randint(n_states, size=(n_sites, n_features))]
+        sampler.applicable_states = np.ones((n_features, n_states), dtype=bool)
+        prior = SimpleNamespace(prior_p_global=SimpleNamespace(counts=np.ones((n_features, n_states))))
+        sampler.posterior_per_chain = [SimpleNamespace(prior=prior)]
+
+        samples = [Sample(zones=np.zeros((1, n_sites), dtype=bool),
+                          weights=np.full((n_features, 2), 0.5),
+                          p_global=np.random.dirichlet(np.ones(n_states), size=(1, n_features)),
+                          p_zones=np.random.dirichlet(np.ones(n_states), size=(1, n_features)),
+                          p_families=None,
+                          source=np.random.random((n_sites, n_features, 2)) < 0.5)
+                   for _ in range(n_chains)]
+
+        candidates, _, _, changed_features = sampler.gibbs_sample_p_global_batch(samples)
+        self.assertLess(changed_features.shape[1], n_features)
+
+        for sample, candidate, changed in zip(samples, candidates, changed_features):
+            resampled = np.flatnonzero(np.any(candidate.p_global[0] != sample.p_global[0], axis=-1))
+
+            # All resampled features are evaluated, each feature at most once
+            self.assertTrue(set(resampled) <= set(changed))
+            self.assertEqual(len(set(changed)), len(changed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ import numpy as np
 import unittest
 from pathlib import Path
 
+from scipy.sparse import issparse
+
 from sbayes.experiment_setup import Experiment
 from sbayes.simulation import Simulation
 from sbayes.mcmc_setup import MCMC
@@ -68,6 +70,67 @@ class TestExperiment(unittest.TestCase):
 
         print('Experiment 3 passed\n')
 
+    @staticmethod
+    def with_warm_up(custom_settings, **warm_up):
+        """Add options of the warm-up (e.g. BATCH_CHAINS) to the custom settings."""
+        return {
+            **custom_settings,
+            'mcmc': {
+                **custom_settings['mcmc'],
+                'WARM_UP': {**custom_settings['mcmc']['WARM_UP'], **warm_up}
+            }
+        }
+
+    @staticmethod
+    def test_batch_chains():
+        """Test running the steps of all warm-up chains in one batch."""
+        custom_settings = TestExperiment.with_warm_up(TestExperiment.CUSTOM_SETTINGS, BATCH_CHAINS=True)
+        TestExperiment.run_experiment(path=Path('experiments/simulation/sim_exp1/'),
+                                      custom_settings=custom_settings)
+
+    @staticmethod
+    def test_tune_proposal_precision():
+        """Test tuning the precision of the proposal distributions in the warm-up."""
+        custom_settings = TestExperiment.with_warm_up(TestExperiment.CUSTOM_SETTINGS,
+                                                      TUNE_PROPOSAL_PRECISION=True)
+        custom_settings['model'] = {'INHERITANCE': True}
+        TestExperiment.run_experiment(path=Path('experiments/simulation/sim_exp2/'),
+                                      custom_settings=custom_settings)
+
+    @staticmethod
+    def test_adapt_operators():
+        """Test adapting the operator weights in the warm-up."""
+        custom_settings = TestExperiment.with_warm_up(TestExperiment.CUSTOM_SETTINGS, ADAPT_OPERATORS=True)
+        custom_settings['model'] = {'N_AREAS': 2}
+        TestExperiment.run_experiment(path=Path('experiments/simulation/sim_exp3/'),
+                                      custom_settings=custom_settings)
+
+    @staticmethod
+    def test_sparse_geo_prior():
+        """Test the cost-based geo-prior on the Delaunay neighbours of the sites."""
+        custom_settings = {
+            'model': {'INHERITANCE': True, 'PRIOR': {'geo': {'sparse': 'delaunay'}}},
+            **TestExperiment.CUSTOM_SETTINGS
+        }
+        mc = TestExperiment.run_experiment(path=Path('experiments/simulation/sim_exp2/'),
+                                           custom_settings=custom_settings)
+        assert issparse(mc.model.prior.geo_prior.cost_matrix)
+
+    @staticmethod
+    def test_features_memmap():
+        """Test memory-mapping the simulated features."""
+        custom_settings = {
+            **TestExperiment.CUSTOM_SETTINGS,
+            'simulation': {**TestExperiment.CUSTOM_SETTINGS['simulation'], 'FEATURES_MEMMAP': True}
+        }
+        path = Path('experiments/simulation/sim_exp1/')
+        mc = TestExperiment.run_experiment(path=path, custom_settings=custom_settings)
+
+        # The memory-mapped files are written to the results of the run, not to the data folder
+        assert isinstance(mc.data.features, np.memmap)
+        assert Path(mc.data.features.filename).parent == mc.path_results.resolve()
+        assert not (path / 'data/.sbayes_cache').exists()
+
     @staticmethod
     def run_experiment(path: Path, custom_settings: dict):
         # 1. Initialize the experiment
@@ -94,6 +157,9 @@ class TestExperiment(unittest.TestCase):
 
         # 6. Log sampling statistics and save samples to file
         mc.save_samples(run=0)
+        mc.log_statistics()
+
+        return mc
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import pickle
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from sbayes.shared_data import SharedData, shared_memory
+
+
+def sum_shared_arrays(shared):
+    data = shared.data
+    return data.features.sum(), data.network.dist_mat.sum(), data.network.adj_mat.sum()
+
+
+@unittest.skipIf(shared_memory is None, 'Shared memory requires Python 3.8 or higher.')
+class TestSharedData(unittest.TestCase):
+
+    """Test sharing the arrays of a data object between processes."""
+
+    def setUp(self):
+        n_sites = 20
+        network = SimpleNamespace(dist_mat=np.random.random((n_sites, n_sites)),
+                                  adj_mat=csr_matrix(np.eye(n_sites, k=1)),
+                                  n=n_sites)
+        self.data = SimpleNamespace(features=np.random.random((n_sites, 5, 3)) < 0.5,
+                                    network=network,
+                                    prior_universal={'counts': np.ones((5, 3)), 'states': None},
+                                    geo_prior={},
+                                    is_simulated=True)
+
+    def test_shared_data(self):
+        with SharedData(self.data) as shared:
+            # The original data object is not modified
+            assert shared.data is not self.data
+            assert shared.data.network is not self.data.network
+
+            # Only the small attributes are pickled
+            assert len(pickle.dumps(shared)) < self.data.network.dist_mat.nbytes
+
+            unpickled = pickle.loads(pickle.dumps(shared))
+            assert np.array_equal(unpickled.data.features, self.data.features)
+            assert np.array_equal(unpickled.data.prior_universal['counts'], np.ones((5, 3)))
+            assert (unpickled.data.network.adj_mat != self.data.network.adj_mat).nnz == 0
+            assert unpickled.data.network.n == self.data.network.n
+
+            # Worker processes attach to the shared memory
+            with ProcessPoolExecutor(max_workers=2) as pool:
+                results = list(pool.map(sum_shared_arrays, [shared, shared]))
+
+        expected = (self.data.features.sum(), self.data.network.dist_mat.sum(), self.data.network.adj_mat.sum())
+        for result in results:
+            np.testing.assert_allclose(result, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import tempfile
+import unittest
+from itertools import combinations
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from scipy import spatial
+
+from sbayes.preprocessing import compute_network, read_geo_cost_matrix
+from sbayes.util import (assess_correlation_probabilities, compute_delaunay, encode_states,
+                         gabriel_graph_from_delaunay, load_npz_member_mmap)
+
+
+class TestEncodeStates(unittest.TestCase):
+
+    """Test the encoding of raw feature values to one-hot vectors."""
+
+    def setUp(self):
+        self.feature_states = pd.DataFrame({'f2': ['x', 'y', None],
+                                            'f1': ['A', 'B', 'C']})
+
+    def test_encode_states(self):
+        features_raw = pd.DataFrame({'f1': ['A', 'C', None],
+                                     'f2': ['y', 'x', 'y']})
+
+        features, state_names, applicable_states, na_number = encode_states(features_raw, self.feature_states)
+
+        # Features are ordered as in the feature states file
+        expected = np.array([[[0, 1, 0], [1, 0, 0]],
+                             [[1, 0, 0], [0, 0, 1]],
+                             [[0, 1, 0], [0, 0, 0]]], dtype=bool)
+        assert np.array_equal(features, expected)
+        assert state_names['external'] == [['x', 'y'], ['A', 'B', 'C']]
+        assert np.array_equal(applicable_states, [[True, True, False], [True, True, True]])
+        assert na_number == 1
+
+    def test_unknown_states(self):
+        features_raw = pd.DataFrame({'f1': ['A', 'D', None],
+                                     'f2': ['y', 'x', 'z']})
+
+        with self.assertRaisesRegex(ValueError, 'f1: D, f2: z'):
+            encode_states(features_raw, self.feature_states)
+
+
+class TestReadCostMatrix(unittest.TestCase):
+
+    """Test reading the geo cost matrix from csv and binary files."""
+
+    def setUp(self):
+        n_sites = 30
+        self.site_names = {'external': [f'site_{i}' for i in range(n_sites)],
+                           'internal': list(range(n_sites))}
+        costs = np.random.random((n_sites, n_sites))
+        self.costs = (costs + costs.T) / 2
+
+        # The files list the sites in a different order
+        self.order = np.random.permutation(n_sites)
+        self.file_site_ids = np.array(self.site_names['external'])[self.order]
+        self.file_costs = self.costs[np.ix_(self.order, self.order)]
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_csv(self):
+        file = self.path / 'costs.csv'
+        pd.DataFrame(self.file_costs, index=self.file_site_ids, columns=self.file_site_ids).to_csv(file)
+
+        cost_matrix, _ = read_geo_cost_matrix(self.site_names, file)
+        np.testing.assert_allclose(cost_matrix, self.costs)
+
+    def test_binary(self):
+        np.save(self.path / 'costs.npy', self.costs)
+        np.savez(self.path / 'costs.npz', costs=self.file_costs, site_ids=self.file_site_ids)
+        np.savez_compressed(self.path / 'costs_compressed.npz', costs=self.file_costs, site_ids=self.file_site_ids)
+
+        for file in ['costs.npy', 'costs.npz', 'costs_compressed.npz']:
+            cost_matrix, _ = read_geo_cost_matrix(self.site_names, self.path / file)
+            np.testing.assert_allclose(cost_matrix, self.costs)
+
+        # Costs in the order of the data are memory-mapped
+        np.savez(self.path / 'costs.npz', costs=self.costs, site_ids=self.site_names['external'])
+        cost_matrix, _ = read_geo_cost_matrix(self.site_names, self.path / 'costs.npz')
+        assert isinstance(cost_matrix, np.memmap)
+        np.testing.assert_allclose(cost_matrix, self.costs)
+
+    def test_symmetrize(self):
+        costs = self.costs.copy()
+        costs[0, 1] += 1.
+        np.save(self.path / 'costs.npy', costs)
+
+        cost_matrix, log = read_geo_cost_matrix(self.site_names, self.path / 'costs.npy')
+        np.testing.assert_allclose(cost_matrix, cost_matrix.T)
+        self.assertAlmostEqual(cost_matrix[0, 1], self.costs[0, 1] + 0.5)
+        assert 'not symmetric' in log
+
+    def test_npz_header_versions(self):
+        file = self.path / 'costs.npz'
+        for version in [(1, 0), (2, 0), (3, 0)]:
+            with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_STORED) as zf:
+                with zf.open('costs.npy', 'w') as member:
+                    np.lib.format.write_array(member, self.costs, version=version)
+
+            costs = load_npz_member_mmap(file, 'costs')
+            np.testing.assert_array_equal(costs, self.costs)
+
+            # Version 3.0 headers are not memory-mapped, but read into memory
+            self.assertEqual(isinstance(costs, np.memmap), version != (3, 0))
+            del costs
+
+
+class TestNetwork(unittest.TestCase):
+
+    """Test the Delaunay edges and the Gabriel graph against brute-force references."""
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.locations = rng.uniform(0, 100, size=(200, 2))
+
+    def delaunay_edges(self):
+        """All pairs of vertices of the Delaunay triangles (i < j)."""
+        triangles = spatial.Delaunay(self.locations, qhull_options="QJ Pp").simplices
+        edges = set()
+        for t in triangles:
+            for a in range(3):
+                for b in range(a + 1, 3):
+                    edges.add((min(t[a], t[b]), max(t[a], t[b])))
+        return edges
+
+    def test_network_edges(self):
+        n_sites = len(self.locations)
+        network = compute_network({'id': list(range(n_sites)), 'locations': self.locations,
+                                   'names': [str(i) for i in range(n_sites)]})
+        edges = {(min(i, j), max(i, j)) for i, j in network['edges']}
+        self.assertEqual(edges, self.delaunay_edges())
+
+        # Both directions of each edge, in sorted order
+        self.assertEqual(len(network['edges']), 2 * len(edges))
+        self.assertEqual([tuple(e) for e in network['edges']], sorted(tuple(e) for e in network['edges']))
+
+    def test_gabriel_graph(self):
+        locations = self.locations
+        gabriel = gabriel_graph_from_delaunay(compute_delaunay(locations), locations)
+
+        # Brute force: no other point lies in the circle with the edge as its diameter
+        sq_dist = np.sum((locations[:, np.newaxis] - locations[np.newaxis]) ** 2, axis=-1)
+        expected = set()
+        for i in range(len(locations)):
+            for j in range(i + 1, len(locations)):
+                inside = sq_dist[i] + sq_dist[j] < sq_dist[i, j]
+                if not np.any(inside):
+                    expected.add((i, j))
+
+        self.assertEqual({tuple(e) for e in gabriel}, expected)
+        self.assertTrue(np.all(gabriel[:, 0] < gabriel[:, 1]))
+
+
+def count_correlated_pairs(samples, corr_th):
+    """Count the correlated pairs of probability vectors pair by pair (reference implementation)."""
+    n_samples, n_features, _ = samples.shape
+    count = 0
+    for f in range(n_features):
+        for i, j in combinations(range(n_samples), 2):
+            if np.dot(samples[i, f], samples[j, f]) > corr_th:
+                count += 1
+    return count
+
+
+class TestAssessCorrelation(unittest.TestCase):
+
+    """Test the batched correlation screening against the pairwise loop."""
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        n_candidates, n_areas, n_families, n_features, n_states = 20, 3, 2, 10, 3
+
+        # Low concentration -> many (almost) deterministic, correlated probability vectors
+        self.p_universal = rng.dirichlet(0.3 * np.ones(n_states), size=(n_candidates, n_features))
+        self.p_contact = rng.dirichlet(0.3 * np.ones(n_states), size=(n_candidates, n_areas, n_features))
+        self.p_inheritance = rng.dirichlet(0.3 * np.ones(n_states), size=(n_candidates, n_families, n_features))
+        self.corr_th = 0.6
+
+    def test_pairwise(self):
+        for c in range(len(self.p_universal)):
+            for include_universal in [False, True]:
+                for p_inheritance in [None, self.p_inheritance[c]]:
+                    samples = [self.p_contact[c]] if p_inheritance is None else [self.p_contact[c], p_inheritance]
+                    if include_universal:
+                        samples = [self.p_universal[c][np.newaxis]] + samples
+                    expected = count_correlated_pairs(np.concatenate(samples), self.corr_th)
+
+                    n_correlated = assess_correlation_probabilities(
+                        self.p_universal[c], self.p_contact[c], p_inheritance,
+                        corr_th=self.corr_th, include_universal=include_universal)
+                    self.assertEqual(n_correlated, expected)
+
+    def test_batch(self):
+        for include_universal in [False, True]:
+            for p_inheritance in [None, self.p_inheritance]:
+                n_correlated = assess_correlation_probabilities(
+                    self.p_universal, self.p_contact, p_inheritance,
+                    corr_th=self.corr_th, include_universal=include_universal)
+                self.assertEqual(n_correlated.shape, (len(self.p_universal),))
+                self.assertTrue(np.any(n_correlated > 0))
+
+                for c in range(len(self.p_universal)):
+                    self.assertEqual(n_correlated[c], assess_correlation_probabilities(
+                        self.p_universal[c], self.p_contact[c], None if p_inheritance is None else p_inheritance[c],
+                        corr_th=self.corr_th, include_universal=include_universal))
+
+
+if __name__ == '__main__':
+    unittest.main()